@@ -24,6 +24,11 @@ export const onRequestPost: PagesFunction<Env> = async (context) => {
 
     const url = new URL(request.url);
     const singleSlug = url.searchParams.get('slug');
+    // Comma-separated list, e.g. the changed slugs reported by `python -m mindlab.pipeline`
+    const slugList = url.searchParams.get('slugs');
+    const selectedSlugs = singleSlug
+        ? [singleSlug]
+        : slugList ? slugList.split(',').map(s => s.trim()).filter(Boolean) : null;
 
     const result: SyncResult = {
         testsProcessed: 0,
@@ -31,8 +36,8 @@ export const onRequestPost: PagesFunction<Env> = async (context) => {
     };
 
     try {
-        const testsToSync = singleSlug
-            ? TEST_DEFINITIONS.filter(t => t.slug === singleSlug)
+        const testsToSync = selectedSlugs
+            ? TEST_DEFINITIONS.filter(t => selectedSlugs.includes(t.slug))
             : TEST_DEFINITIONS;
 
         // Process tests one at a time with minimal queries
@@ -32,10 +32,21 @@ export interface TestQuestion {
     options: TestOption[];
 }
 
+export interface ScaleAggregate {
+    type: 'sum' | 'mean' | 'weighted' | 'composite' | 'gsi' | 'pst' | 'psdi';
+    items?: number[];
+    scales?: string[];
+    op?: 'sum' | 'mean';
+    weights?: Record<string, number>;
+    round?: number;
+}
+
 export interface TestScale {
     key: string;
     name: string;
     nameFa: string;
+    // Offline scoring only (mindlab/aggregates.py); sync and finish.ts sum
+    aggregate?: ScaleAggregate;
 }
 
 export interface TestCutoff {
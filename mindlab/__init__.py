@@ -0,0 +1,3 @@
+# MindLab offline tooling
+# Python counterparts of the Pages Functions in apps/web/functions/api,
+# working from the JSON test definitions in apps/web/src/data/tests.
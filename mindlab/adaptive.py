@@ -0,0 +1,495 @@
+"""Adaptive item selection with early stopping, on a graded response model.
+
+SCL-90-R, STAI and ENRICH take 90, 40 and 35 round trips, and users drop
+out partway through. The JSON cutoffs only classify a few scales: GSI,
+state/trait and the ENRICH total. Each classified scale is a linear
+combination of item scores (a sum, a mean or a composite). This engine
+asks only as many items as it takes to settle those levels.
+
+Calibration fits Samejima's graded response model per classified scale:
+a slope and ordered thresholds per item, its categories being the item's
+distinct option scores in ascending order. Reverse-keyed items fit like
+any other, since their scores are already reversed. The fit is marginal
+maximum likelihood by EM over a quadrature grid with a standard normal
+prior, with Newton steps per item in the M step. It runs on the complete
+cases of the stored answers: archived sessions come from the columnar
+archive (mindlab.archive.stored_batches), the rest from the answers
+table.
+
+At run time each classified scale keeps a posterior over the grid. The
+next item is the one with the largest posterior-expected Fisher
+information among the scales not yet settled. After every answer the
+scale's final score is predicted:
+
+    answered part + sum over unanswered items of the model's expected
+    score, with a normal approximation of its spread per grid point,
+    on the scale's score grid (integers, or the aggregate's rounding)
+
+and each JSON cutoff band gets a probability. A scale is settled once one
+band reaches --confidence and it has --min-items answers. Items named in a
+risk rule are always asked first. Items outside every classified scale are
+not asked, and their scales are reported as estimates.
+
+`simulate` calibrates on part of the stored sessions. It replays the
+held-out ones with their recorded answers and reports the items asked
+and the agreement with the full-length classification.
+
+Usage:
+    python -m mindlab.adaptive calibrate local.db [slug ...] [--archive build/archive]
+    python -m mindlab.adaptive simulate local.db [slug ...] [--confidence 0.95] [--min-items 3] [--holdout 0.5]
+"""
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.archive import ARCHIVE_DIR, Archive, stored_batches
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.localdb import connect
+from mindlab.pipeline import write_atomic
+from mindlab.risk_rules import RiskRuleError, parse, references
+from mindlab.scoring import compile_test, score_matrix
+
+CALIBRATION_PATH = os.path.join(ROOT_DIR, 'build', 'irt.json')
+CALIBRATION_VERSION = 1
+DEFAULT_TESTS = ('scl-90-r', 'stai', 'enrich')
+GRID = np.linspace(-4, 4, 49)
+PRIOR = np.exp(-GRID ** 2 / 2) / np.exp(-GRID ** 2 / 2).sum()
+EM_CYCLES = 50
+MAX_VALUES = 2000
+
+
+def normal_cdf(x):
+    """Standard normal CDF via Abramowitz-Stegun 7.1.26 (error below 1.5e-7)."""
+    z = np.abs(x) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1 - poly * np.exp(-z * z)
+    return 0.5 * (1 + np.sign(x) * erf)
+
+
+def cumulative(a, b, grid=GRID):
+    """P(category >= k | theta) for k = 1..m-1, shape (m-1, Q)."""
+    return 1 / (1 + np.exp(-a * (grid[None, :] - b[:, None])))
+
+
+def category_probs(a, b, grid=GRID):
+    """P(category = k | theta), shape (m, Q)."""
+    s = cumulative(a, b, grid)
+    ones, zeros = np.ones((1, len(grid))), np.zeros((1, len(grid)))
+    return np.clip(np.vstack([ones, s]) - np.vstack([s, zeros]), 1e-12, None)
+
+
+def item_information(a, b, grid=GRID):
+    """Fisher information of a graded item over the grid."""
+    s = cumulative(a, b, grid)
+    d = a * s * (1 - s)
+    zeros = np.zeros((1, len(grid)))
+    dp = np.vstack([zeros, d]) - np.vstack([d, zeros])
+    return (dp ** 2 / category_probs(a, b, grid)).sum(axis=0)
+
+
+def _loglik(x, r):
+    return float((r * np.log(category_probs(x[0], x[1:]))).sum())
+
+
+def _gradient(x, r):
+    a, b = x[0], x[1:]
+    s = cumulative(a, b)
+    ratio = r / category_probs(a, b)
+    d_s = (ratio[:-1] - ratio[1:]) * s * (1 - s)
+    return np.concatenate([[(d_s * (GRID[None, :] - b[:, None])).sum()], -a * d_s.sum(axis=1)])
+
+
+def _constrain(x):
+    return np.concatenate([[np.clip(x[0], 0.05, 5.0)], np.sort(np.clip(x[1:], -6, 6))])
+
+
+def fit_item(x, r, steps=3):
+    """Newton steps on (a, b) for the expected category counts r (m x Q)."""
+    for _ in range(steps):
+        g = _gradient(x, r)
+        eps = 1e-4
+        h = np.array([(_gradient(x + eps * e, r) - _gradient(x - eps * e, r)) / (2 * eps) for e in np.eye(len(x))])
+        h = (h + h.T) / 2 - 1e-6 * np.eye(len(x))
+        try:
+            step = np.linalg.solve(h, g)
+        except np.linalg.LinAlgError:
+            break
+        base, scale = _loglik(x, r), 1.0
+        for _ in range(10):
+            candidate = _constrain(x - scale * step)
+            if _loglik(candidate, r) >= base:
+                x = candidate
+                break
+            scale /= 2
+    return x
+
+
+@dataclass
+class ItemModel:
+    order: int
+    a: float
+    b: np.ndarray
+    # Category scores in ascending order
+    scores: np.ndarray
+
+
+def categories(scores, column):
+    """Category index of each score of an item."""
+    return np.searchsorted(scores, column)
+
+
+def calibrate_scale(responses, item_scores, cycles=EM_CYCLES):
+    """EM fit of the graded response model; responses are complete score rows (n x k).
+
+    Returns [(a, b)] per item and the final marginal log-likelihood.
+    """
+    n, k = responses.shape
+    cats = [categories(item_scores[i], responses[:, i]) for i in range(k)]
+    params = []
+    for i in range(k):
+        m = len(item_scores[i])
+        at_least = np.array([(cats[i] >= c).mean() for c in range(1, m)])
+        b = -np.log(np.clip(at_least, 0.01, 0.99) / (1 - np.clip(at_least, 0.01, 0.99)))
+        params.append(np.concatenate([[1.0], np.sort(b)]))
+
+    previous = -np.inf
+    loglik = previous
+    for _ in range(cycles):
+        log_post = np.log(PRIOR)[None, :].repeat(n, axis=0)
+        for i in range(k):
+            log_post += np.log(category_probs(params[i][0], params[i][1:]))[cats[i]]
+        peak = log_post.max(axis=1, keepdims=True)
+        post = np.exp(log_post - peak)
+        marginal = post.sum(axis=1, keepdims=True)
+        loglik = float((np.log(marginal) + peak).sum())
+        post /= marginal
+        for i in range(k):
+            m = len(item_scores[i])
+            onehot = cats[i][:, None] == np.arange(m)[None, :]
+            # A small prior-shaped count keeps unused categories finite
+            r = onehot.T.astype(np.float64) @ post + 0.05 * PRIOR[None, :]
+            params[i] = fit_item(params[i], r)
+        if loglik - previous < 1e-4 * n:
+            break
+        previous = loglik
+    return [(float(p[0]), p[1:]) for p in params], loglik
+
+
+@dataclass
+class Target:
+    """A classified scale as a linear combination of item scores."""
+    key: str
+    position: int
+    # Matrix columns of the items, their weights and the constant term
+    items: np.ndarray
+    weights: np.ndarray
+    const: float
+    # Possible scale scores, their half spacing and cutoff band
+    values: np.ndarray
+    half_step: float
+    value_band: np.ndarray
+    labels: list
+    models: list = None
+
+
+def linear_targets(definition):
+    """Targets for every scale with cutoffs whose score is linear in the items."""
+    compiled = compile_test(definition, aggregates=True)
+    k = compiled.n_items
+    if compiled.aggregation is not None:
+        def f(x):
+            return score_matrix(compiled, x, np.ones(x.shape, dtype=bool)).scale_scores.astype(np.float64)
+    else:
+        def f(x):
+            return x.astype(np.float64) @ compiled.weights
+    big = 1000
+    base = f(np.zeros((1, k), dtype=np.int64))[0]
+    weights = (f(big * np.eye(k, dtype=np.int64)) - base) / big
+    check = f(np.full((1, k), 2, dtype=np.int64))[0]
+
+    specs = {s['key']: s.get('aggregate') or {} for s in definition['scales']}
+    lows = np.array([compiled.option_scores[i, :compiled.option_counts[i]].min() for i in range(k)])
+    highs = np.array([compiled.option_scores[i, :compiled.option_counts[i]].max() for i in range(k)])
+    targets = []
+    for j, key in enumerate(compiled.scale_keys):
+        bands = compiled.bands[j]
+        if not len(bands.bounds):
+            continue
+        w = np.round(weights[:, j], 9)
+        digits = specs[key].get('round')
+        step = 10.0 ** -digits if digits is not None else 1.0
+        if abs(check[j] - base[j] - 2 * w.sum()) > max(step, 1e-6) * 1.01:
+            continue  # pst/psdi and other non-linear aggregates
+        items = np.flatnonzero(w)
+        lo = base[j] + np.minimum(w * lows, w * highs).sum()
+        hi = base[j] + np.maximum(w * lows, w * highs).sum()
+        if digits is None and not (np.allclose(w, np.round(w)) and float(base[j]).is_integer()):
+            step = (hi - lo) / 400 or 1.0
+        values = np.arange(np.floor(lo / step), np.ceil(hi / step) + 1) * step
+        if len(values) > MAX_VALUES:
+            step = (hi - lo) / MAX_VALUES
+            values = lo + np.arange(MAX_VALUES + 1) * step
+        if digits is not None:
+            values = np.round(values, digits)
+        value_band = bands.band(values)
+        targets.append(Target(key, j, items, w[items], float(base[j]), values, step / 2, value_band,
+                              [bands.label(b)[1] for b in range(len(bands.levels))]))
+    return compiled, targets
+
+
+def risk_items(definition, compiled):
+    """Matrix columns of the items that risk rules read, through mindlab.risk_rules.
+
+    A rule on a scale score forces every item of that scale. Raises
+    RiskRuleError when a test has risk rules but none of them reads an
+    item of the test, so a rule can never be silently skipped.
+    """
+    rules = definition.get('risk_rules', [])
+    columns = set()
+    for rule in rules:
+        orders, scales = references(parse(rule['condition']))
+        columns.update(int(c) for c in compiled.item_index(sorted(orders)) if c >= 0)
+        for key in scales:
+            if key in compiled.scale_keys:
+                columns.update(np.flatnonzero(compiled.weights[:, compiled.scale_keys.index(key)]).tolist())
+    if rules and not columns:
+        raise RiskRuleError(f"{definition['slug']}: risk rules {[r['condition'] for r in rules]} read no item of the test")
+    return sorted(columns)
+
+
+class Calibration:
+    """Graded response models of the classified scales of one test."""
+
+    def __init__(self, definition, fitted=None):
+        self.definition = definition
+        self.compiled, self.targets = linear_targets(definition)
+        self.forced = risk_items(definition, self.compiled)
+        self.item_scores = [np.unique(self.compiled.option_scores[i, :self.compiled.option_counts[i]])
+                            for i in range(self.compiled.n_items)]
+        for target in self.targets:
+            if fitted and target.key in fitted:
+                target.models = [ItemModel(m['order'], m['a'], np.array(m['b']), self.item_scores[c])
+                                 for m, c in zip(fitted[target.key], target.items)]
+
+    def fit(self, scores, answered):
+        """Calibrate every target on the complete cases of its items; returns {key: (n, loglik)}."""
+        out = {}
+        for target in self.targets:
+            complete = answered[:, target.items].all(axis=1)
+            responses = scores[complete][:, target.items]
+            fitted, loglik = calibrate_scale(responses, [self.item_scores[c] for c in target.items])
+            target.models = [ItemModel(int(self.compiled.item_orders[c]), a, b, self.item_scores[c])
+                             for (a, b), c in zip(fitted, target.items)]
+            out[target.key] = (int(complete.sum()), loglik)
+        return out
+
+    def to_dict(self):
+        return {t.key: [{'order': m.order, 'a': round(m.a, 5), 'b': [round(float(v), 5) for v in m.b]}
+                        for m in t.models] for t in self.targets if t.models}
+
+
+class TargetState:
+    """Posterior and score prediction of one classified scale during a session."""
+
+    def __init__(self, target):
+        self.target = target
+        models = target.models
+        self.column = {int(c): i for i, c in enumerate(target.items)}
+        self.probs = [category_probs(m.a, m.b) for m in models]
+        self.info = np.array([item_information(m.a, m.b) for m in models])
+        w = target.weights
+        means = np.array([m.scores @ p for m, p in zip(models, self.probs)])
+        second = np.array([(m.scores ** 2) @ p for m, p in zip(models, self.probs)])
+        self.mean = w[:, None] * means
+        self.var = (w ** 2)[:, None] * (second - means ** 2)
+        self.log_post = np.log(PRIOR)
+        self.remaining = np.ones(len(models), dtype=bool)
+        self.known = target.const
+        self.answered = 0
+
+    def posterior(self):
+        p = np.exp(self.log_post - self.log_post.max())
+        return p / p.sum()
+
+    def record(self, column, score):
+        i = self.column[column]
+        if not self.remaining[i]:
+            return
+        self.remaining[i] = False
+        self.answered += 1
+        self.known += self.target.weights[i] * score
+        category = categories(self.target.models[i].scores, np.array([score]))[0]
+        self.log_post = self.log_post + np.log(self.probs[i][category])
+
+    def band_probabilities(self):
+        """{band: probability} of the final score, band -1 meaning no cutoff matched."""
+        t = self.target
+        post = self.posterior()
+        mu = self.known + self.mean[self.remaining].sum(axis=0)
+        sd = np.sqrt(self.var[self.remaining].sum(axis=0))
+        if not self.remaining.any() or sd.max() < 1e-9:
+            value = t.values[np.argmin(np.abs(t.values - self.known))]
+            return {int(t.value_band[t.values == value][0]): 1.0}
+        edges = np.concatenate([[-np.inf], (t.values[1:] + t.values[:-1]) / 2, [np.inf]])
+        cdf = normal_cdf((edges[None, :] - mu[:, None]) / np.maximum(sd, 1e-9)[:, None])
+        p_value = post @ (cdf[:, 1:] - cdf[:, :-1])
+        out = {}
+        for band in np.unique(t.value_band):
+            out[int(band)] = float(p_value[t.value_band == band].sum())
+        return out
+
+    def expected_score(self):
+        return float(self.known + self.posterior() @ self.mean[self.remaining].sum(axis=0))
+
+
+class AdaptiveSession:
+    """Item-by-item administration of one test against a calibration."""
+
+    def __init__(self, calibration, confidence=0.95, min_items=3):
+        self.calibration = calibration
+        self.confidence = confidence
+        self.min_items = min_items
+        self.states = [TargetState(t) for t in calibration.targets]
+        self.asked = []
+        self.forced = list(calibration.forced)
+
+    def settled(self, state):
+        needed = min(self.min_items, len(state.target.items))
+        return state.answered >= needed and max(state.band_probabilities().values()) >= self.confidence
+
+    def next_item(self):
+        """Matrix column of the next item to ask, or None when every level is settled."""
+        while self.forced:
+            column = self.forced.pop(0)
+            if column not in self.asked:
+                return column
+        best, best_info = None, -1.0
+        for state in self.states:
+            if not state.remaining.any() or self.settled(state):
+                continue
+            expected = state.info[state.remaining] @ state.posterior()
+            k = int(np.argmax(expected))
+            if expected[k] > best_info:
+                best, best_info = int(state.target.items[np.flatnonzero(state.remaining)[k]]), float(expected[k])
+        return best
+
+    def record(self, column, score):
+        self.asked.append(column)
+        for state in self.states:
+            if column in state.column:
+                state.record(column, score)
+
+    def levels(self):
+        """{scale key: (band, probability, expected score)}"""
+        out = {}
+        for state in self.states:
+            probs = state.band_probabilities()
+            band = max(probs, key=probs.get)
+            out[state.target.key] = (band, probs[band], state.expected_score())
+        return out
+
+
+def load_responses(conn, definition, archive_root=None):
+    """(sessions, scores, answered) of a test's finished sessions, archived ones from the archive."""
+    compiled = compile_test(definition)
+    archive = Archive(archive_root or ARCHIVE_DIR)
+    row = conn.execute('SELECT id FROM tests WHERE slug = ?', (compiled.slug,)).fetchone()
+    parts = list(stored_batches(conn, compiled, row[0], archive)) if row else []
+    if not parts:
+        return (np.zeros(0, dtype=np.int64), np.zeros((0, compiled.n_items), dtype=np.int64),
+                np.zeros((0, compiled.n_items), dtype=bool))
+    sessions, scores, answered = (np.concatenate([p[i] for p in parts]) for i in range(3))
+    order = np.argsort(sessions, kind='stable')
+    return sessions[order], scores[order].astype(np.int64), answered[order]
+
+
+def simulate(calibration, scores, answered, confidence=0.95, min_items=3):
+    """Replay complete sessions; returns per-session asked counts and level agreement per scale."""
+    targets = calibration.targets
+    relevant = np.unique(np.concatenate([t.items for t in targets] + [np.array(calibration.forced, dtype=np.int64)]))
+    complete = answered[:, relevant].all(axis=1)
+    scores = scores[complete]
+    truth = score_matrix(calibration.compiled, scores, np.ones(scores.shape, dtype=bool)).bands
+    asked, agree = [], np.zeros((len(scores), len(targets)), dtype=bool)
+    for n, row in enumerate(scores):
+        session = AdaptiveSession(calibration, confidence, min_items)
+        while (column := session.next_item()) is not None:
+            session.record(column, int(row[column]))
+        asked.append(len(session.asked))
+        levels = session.levels()
+        for j, t in enumerate(targets):
+            agree[n, j] = levels[t.key][0] == truth[n, t.position]
+    return np.array(asked), agree, len(relevant)
+
+
+def load_calibrations(path=CALIBRATION_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get('tests', {}) if data.get('version') == CALIBRATION_VERSION else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Graded response calibration and adaptive administration')
+    sub = parser.add_subparsers(dest='command', required=True)
+    c = sub.add_parser('calibrate', help='fit item parameters from the stored answers')
+    s = sub.add_parser('simulate', help='replay held-out sessions adaptively')
+    for p in (c, s):
+        p.add_argument('db')
+        p.add_argument('slugs', nargs='*')
+        p.add_argument('--archive', help='mindlab.archive root of archived sessions (default build/archive)')
+    c.add_argument('--out', default=CALIBRATION_PATH)
+    s.add_argument('--confidence', type=float, default=0.95)
+    s.add_argument('--min-items', type=int, default=3)
+    s.add_argument('--holdout', type=float, default=0.5, help='share of sessions replayed instead of fitted')
+    s.add_argument('--limit', type=int, default=1000, help='most held-out sessions replayed per test')
+    s.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    definitions = load_definitions(args.slugs or list(DEFAULT_TESTS))
+    fitted = load_calibrations(args.out) if args.command == 'calibrate' else {}
+    for slug, definition in definitions.items():
+        _, scores, answered = load_responses(conn, definition, args.archive)
+        calibration = Calibration(definition)
+        if not calibration.targets:
+            print(f"{slug}: no scale with cutoffs that is linear in the items")
+            continue
+        start = time.perf_counter()
+        if args.command == 'calibrate':
+            fit = calibration.fit(scores, answered)
+            fitted[slug] = calibration.to_dict()
+            for t in calibration.targets:
+                slopes = np.array([m.a for m in t.models])
+                print(f"{slug:12s} {t.key:14s} {len(t.items):>3d} items  n={fit[t.key][0]:<7d} "
+                      f"slope mean {slopes.mean():.2f} min {slopes.min():.2f}  ({time.perf_counter() - start:.1f}s)")
+            continue
+
+        rng = np.random.default_rng(args.seed)
+        test = rng.random(len(scores)) < args.holdout
+        calibration.fit(scores[~test], answered[~test])
+        replay = np.flatnonzero(test)[:args.limit]
+        asked, agree, length = simulate(calibration, scores[replay], answered[replay], args.confidence,
+                                        args.min_items)
+        if not len(asked):
+            print(f"{slug}: no complete held-out sessions")
+            continue
+        per_scale = '  '.join(f"{t.key} {agree[:, j].mean():.1%}" for j, t in enumerate(calibration.targets))
+        print(f"{slug:12s} {len(asked)} sessions  items {asked.mean():.1f}/{length} "
+              f"(saved {1 - asked.mean() / length:.1%}, p90 {np.percentile(asked, 90):.0f})  "
+              f"all levels agree {agree.all(axis=1).mean():.1%}  [{per_scale}]  {time.perf_counter() - start:.1f}s")
+    conn.close()
+    if args.command == 'calibrate':
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        write_atomic(args.out, json.dumps({'version': CALIBRATION_VERSION, 'tests': fitted}) + '\n')
+        print(f"Wrote {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""Per-scale aggregations declared in the test JSON.
+
+finish.ts only knows one aggregation: the integer SUM of the answers of
+the questions mapped to a scale. A scale can instead declare
+
+    "aggregate": {"type": "sum"}                       the default
+    "aggregate": {"type": "mean"}                      mean of the answered items
+    "aggregate": {"type": "weighted", "weights": {"3": 2, "7": 0.5}}
+    "aggregate": {"type": "composite", "scales": ["a", "b"], "op": "sum" | "mean",
+                  "weights": {"a": 1, "b": 2}}         built from other scales
+    "aggregate": {"type": "gsi"}                       SCL-90 Global Severity Index
+    "aggregate": {"type": "pst"}                       Positive Symptom Total
+    "aggregate": {"type": "psdi"}                      Positive Symptom Distress Index
+
+sum, mean, weighted, gsi, pst and psdi work on the scale's own questions
+(scaleKey), on every question for gsi/pst/psdi, or on an explicit "items"
+list of question orders. Any of them may add "round": <digits>.
+
+All item-level aggregations of a test share one matrix product of the
+answer matrix with a weight matrix, plus one product of the answered
+(and positive-score) mask for the columns that divide by n (or PST);
+composites are then one product per dependency
+level over the scale results, so they never re-scan answers.
+
+Sync and finish.ts ignore the field, so the live API keeps summing;
+compile_test(definition, aggregates=True) opts the Python scorer in.
+
+Usage:
+    python -m mindlab.aggregates [--sessions N] [slug ...]
+"""
+import argparse
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.definitions import load_definitions
+
+TYPES = ('sum', 'mean', 'weighted', 'composite', 'gsi', 'pst', 'psdi')
+ALL_ITEMS = ('gsi', 'pst', 'psdi')
+
+
+class AggregateError(ValueError):
+    pass
+
+
+def aggregate_spec(scale):
+    spec = scale.get('aggregate') or {'type': 'sum'}
+    if spec.get('type') not in TYPES:
+        raise AggregateError(f"scale {scale['key']!r}: unknown aggregate type {spec.get('type')!r}")
+    return spec
+
+
+def has_aggregates(definition):
+    return any(s.get('aggregate') for s in definition['scales'])
+
+
+def spec_items(definition, scale, spec):
+    """Question orders an item-level aggregate reads."""
+    questions = definition['questions']
+    orders = {q['order'] for q in questions}
+    if 'items' in spec:
+        items = [int(o) for o in spec['items']]
+    elif spec['type'] == 'weighted':
+        items = [int(o) for o in spec.get('weights', {})]
+    elif spec['type'] in ALL_ITEMS:
+        items = [q['order'] for q in questions]
+    else:
+        items = [q['order'] for q in questions if q.get('scaleKey') == scale['key']]
+    missing = sorted(set(items) - orders)
+    if missing:
+        raise AggregateError(f"scale {scale['key']!r}: aggregate references missing items "
+                             + ', '.join(f'q{o}' for o in missing))
+    return items
+
+
+def composite_order(definition):
+    """Composite scale keys grouped by dependency depth; raises on cycles or unknown keys."""
+    specs = {s['key']: aggregate_spec(s) for s in definition['scales']}
+    depth = {}
+
+    def visit(key, path):
+        if key in depth:
+            return depth[key]
+        if key in path:
+            raise AggregateError(f"composite cycle: {' -> '.join(path + (key,))}")
+        spec = specs[key]
+        if spec['type'] != 'composite':
+            depth[key] = 0
+            return 0
+        parts = spec.get('scales') or []
+        if not parts:
+            raise AggregateError(f"scale {key!r}: composite without scales")
+        for part in parts:
+            if part not in specs:
+                raise AggregateError(f"scale {key!r}: composite references unknown scale {part!r}")
+        depth[key] = 1 + max(visit(part, path + (key,)) for part in parts)
+        return depth[key]
+
+    for key in specs:
+        visit(key, ())
+    levels = {}
+    for key, d in depth.items():
+        if d:
+            levels.setdefault(d, []).append(key)
+    return [levels[d] for d in sorted(levels)]
+
+
+@dataclass
+class Aggregation:
+    """Compiled aggregations of one test; columns follow the scale order."""
+    weights: np.ndarray       # items x scales, numerator weights
+    mask: np.ndarray          # items x scales, 1 where an item counts toward n / PST
+    kinds: list               # per scale: 'sum', 'mean', 'pst', 'psdi' or 'composite'
+    composites: list          # per depth level: (target columns, scales x targets matrix)
+    digits: list              # per scale: round() digits or None
+
+    def apply(self, scores, answered):
+        """Sessions x scales float matrix of aggregated scale scores."""
+        scores = np.asarray(scores, dtype=np.float64)
+        answered = np.asarray(answered, dtype=bool)
+        out = scores @ self.weights
+
+        # Count products only for the columns that divide by n or PST
+        mean = [j for j, kind in enumerate(self.kinds) if kind == 'mean']
+        if mean:
+            counts = answered.astype(np.float64) @ self.mask[:, mean]
+            out[:, mean] = np.divide(out[:, mean], counts, out=np.zeros_like(counts), where=counts > 0)
+        pst = [j for j, kind in enumerate(self.kinds) if kind in ('pst', 'psdi')]
+        if pst:
+            positive = (answered & (scores > 0)).astype(np.float64) @ self.mask[:, pst]
+            psdi = np.divide(out[:, pst], positive, out=np.zeros_like(positive), where=positive > 0)
+            is_pst = np.array([self.kinds[j] == 'pst' for j in pst])
+            out[:, pst] = np.where(is_pst, positive, psdi)
+
+        # Composites read their parts after rounding, like the row-wise reference
+        self._round(out, [j for j, kind in enumerate(self.kinds) if kind != 'composite'])
+        for targets, matrix in self.composites:
+            out[:, targets] = out @ matrix
+            self._round(out, targets)
+        return out
+
+    def _round(self, out, columns):
+        for j in columns:
+            if self.digits[j] is not None:
+                out[:, j] = round_half_up(out[:, j], self.digits[j])
+
+
+def round_half_up(values, digits):
+    """Math.round(x * 10^d) / 10^d, so results match what the TS side would print.
+
+    np.round and round() both round half to even on the binary value, which
+    disagree with each other and with JS on inputs like 2.675.
+    """
+    scale = 10.0 ** digits
+    return np.floor(np.asarray(values) * scale + 0.5) / scale
+
+
+def compile_aggregation(definition, item_orders=None):
+    """Compile the aggregate declarations of a definition into an Aggregation."""
+    scales = definition['scales']
+    if item_orders is None:
+        item_orders = [q['order'] for q in definition['questions']]
+    column = {int(order): i for i, order in enumerate(item_orders)}
+    position = {s['key']: j for j, s in enumerate(scales)}
+    n_items, n_scales = len(item_orders), len(scales)
+
+    weights = np.zeros((n_items, n_scales))
+    mask = np.zeros((n_items, n_scales))
+    kinds, digits = [], []
+    for j, scale in enumerate(scales):
+        spec = aggregate_spec(scale)
+        kind = spec['type']
+        digits.append(spec.get('round'))
+        if kind == 'composite':
+            kinds.append('composite')
+            continue
+        kinds.append({'weighted': 'sum', 'gsi': 'mean'}.get(kind, kind))
+        given = {int(o): float(w) for o, w in spec.get('weights', {}).items()}
+        for order in spec_items(definition, scale, spec):
+            weights[column[order], j] = given.get(order, 1.0)
+            mask[column[order], j] = 1.0
+
+    composites = []
+    for keys in composite_order(definition):
+        targets = [position[k] for k in keys]
+        matrix = np.zeros((n_scales, len(targets)))
+        for t, key in enumerate(keys):
+            spec = aggregate_spec(scales[position[key]])
+            parts = spec['scales']
+            given = spec.get('weights', {})
+            for part in parts:
+                w = float(given.get(part, 1.0))
+                matrix[position[part], t] += w / len(parts) if spec.get('op') == 'mean' else w
+        composites.append((targets, matrix))
+
+    return Aggregation(weights, mask, kinds, composites, digits)
+
+
+def reference_aggregate(definition, answers):
+    """Row-at-a-time aggregation, used to cross-check the compiled path.
+
+    `answers` maps question order to the stored answer score; returns
+    {scale key: value}.
+    """
+    values = {}
+    specs = {s['key']: aggregate_spec(s) for s in definition['scales']}
+
+    def value(scale):
+        key = scale['key']
+        if key in values:
+            return values[key]
+        spec = specs[key]
+        kind = spec['type']
+        if kind == 'composite':
+            by_key = {s['key']: s for s in definition['scales']}
+            given = spec.get('weights', {})
+            parts = [float(given.get(p, 1.0)) * value(by_key[p]) for p in spec['scales']]
+            result = sum(parts) / len(parts) if spec.get('op') == 'mean' else sum(parts)
+        else:
+            items = spec_items(definition, scale, spec)
+            given = {int(o): float(w) for o, w in spec.get('weights', {}).items()}
+            answered = [o for o in items if o in answers]
+            total = sum(given.get(o, 1.0) * answers[o] for o in answered)
+            positive = sum(1 for o in answered if answers[o] > 0)
+            if kind in ('mean', 'gsi'):
+                result = total / len(answered) if answered else 0.0
+            elif kind == 'pst':
+                result = positive
+            elif kind == 'psdi':
+                result = total / positive if positive else 0.0
+            else:
+                result = total
+        if spec.get('round') is not None:
+            result = float(round_half_up(result, spec['round']))
+        values[key] = result
+        return result
+
+    return {s['key']: value(s) for s in definition['scales']}
+
+
+def main():
+    from mindlab.scoring import compile_test, option_matrix_scores, random_choices, score_matrix
+
+    parser = argparse.ArgumentParser(description='Score declared aggregations and cross-check them row by row')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--check', type=int, default=500)
+    args = parser.parse_args()
+
+    for slug, definition in load_definitions(args.slugs or None).items():
+        if not has_aggregates(definition):
+            continue
+        compiled = compile_test(definition, aggregates=True)
+        choices = random_choices(compiled, args.sessions, skip_rate=0.02)
+        scores, answered = option_matrix_scores(compiled, choices)
+
+        start = time.perf_counter()
+        batch = score_matrix(compiled, scores, answered)
+        elapsed = time.perf_counter() - start
+
+        mismatches = 0
+        for row in random.Random(0).sample(range(args.sessions), min(args.check, args.sessions)):
+            answers = {int(compiled.item_orders[i]): int(scores[row, i]) for i in np.flatnonzero(answered[row])}
+            expected = reference_aggregate(definition, answers)
+            if not np.allclose([expected[k] for k in compiled.scale_keys], batch.scale_scores[row]):
+                mismatches += 1
+
+        declared = ', '.join(f"{s['key']}={s['aggregate']['type']}" for s in definition['scales'] if s.get('aggregate'))
+        print(f"{slug:12s} {args.sessions} sessions in {elapsed * 1000:7.1f} ms, mismatches: {mismatches}  ({declared})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,446 @@
+"""Deduplicating queue and persistent cache in front of the AI analysis model.
+
+POST /api/ai/analyze builds a prompt from a session's results and
+result_reports and calls the Llama model on every request, writing
+ai_analyses only afterwards, so repeated clicks and sessions with the same
+score profile each pay a full inference. This worker keys every request
+by a normalized profile:
+
+    test slug, each scale's interpretation (level) and its score binned
+    into SCORE_BINS equal-width bins of the scale's possible range, the
+    binned total and the standard overall analysis
+
+and renders the prompt from that profile alone (scores appear as the bin
+range), so equal keys really get the same answer. A request is served
+
+    from the cache     build/ai-cache.db, entries expire after the TTL and
+                       the least recently used are evicted past
+                       --max-entries
+    by coalescing      an identical request already in flight is awaited
+                       instead of sent again
+    from a batch       pending misses are grouped up to --batch prompts
+                       (or --max-wait seconds) per backend call
+
+Backends implement `async generate(prompts) -> texts`. StubBackend answers
+offline after a simulated latency; WorkersAIBackend calls the same
+Cloudflare REST endpoint as analyze.ts, one request per prompt since the
+text models have no batch input. A failed batch is not cached; all its
+waiters get the error.
+
+Usage:
+    python -m mindlab.ai_analysis local.db [--limit 2000] [--repeat 2] [--latency 0.5] [--write]
+    python -m mindlab.ai_analysis local.db --workers-ai   # CF_ACCOUNT_ID, CF_API_TOKEN
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import time
+import urllib.request
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.compact import ReportStore
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.scoring import compile_test
+
+CACHE_PATH = os.path.join(ROOT_DIR, 'build', 'ai-cache.db')
+MODEL = '@cf/meta/llama-3.1-8b-instruct'
+PROMPT_VERSION = 1
+SCORE_BINS = 5
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_ENTRIES = 50_000
+NO_DATA = 'اطلاعاتی موجود نیست'
+
+CACHE_SCHEMA = '''
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE IF NOT EXISTS ai_cache (
+  key TEXT PRIMARY KEY,
+  analysis_text TEXT NOT NULL,
+  model TEXT NOT NULL,
+  created_at REAL NOT NULL,
+  used_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_ai_cache_used_at ON ai_cache(used_at);
+'''
+
+# Same reads as analyze.ts
+FINISHED_SESSIONS = '''
+SELECT s.id, t.slug, t.name, t.category
+FROM sessions s JOIN tests t ON s.test_id = t.id
+WHERE s.finished_at IS NOT NULL
+ORDER BY s.id DESC LIMIT ?
+'''
+SESSION_RESULTS = 'SELECT scale_id, score, interpretation FROM results WHERE session_id = ? ORDER BY id'
+SESSION_TOTAL = 'SELECT COALESCE(SUM(score), 0) FROM answers WHERE session_id = ?'
+
+UPSERT_ANALYSIS = '''
+INSERT INTO ai_analyses (session_id, analysis_text, model, created_at)
+VALUES (?, ?, ?, datetime('now'))
+ON CONFLICT(session_id) DO UPDATE SET
+  analysis_text = excluded.analysis_text,
+  model = excluded.model,
+  created_at = datetime('now')
+'''
+
+PROMPT = '''تو یک روان‌شناس بالینی ایرانی هستی. لطفاً فقط و فقط به زبان فارسی پاسخ بده. از هیچ کلمه انگلیسی یا زبان دیگری استفاده نکن.
+
+اطلاعات آزمون روان‌شناختی:
+نام آزمون: {test_name}
+دسته‌بندی: {category}
+نمره کل: {total}
+
+نتایج زیرمقیاس‌ها:
+{scales}
+
+تفسیر استاندارد: {overall}
+
+جزئیات تفسیر: {details}
+
+توصیه‌های استاندارد: {recommendations}
+
+لطفاً یک تحلیل شخصی‌سازی‌شده و حمایتی ارائه بده که شامل این موارد باشد:
+۱. توضیح ساده و قابل فهم نتایج
+۲. نقاط قوت فرد بر اساس این نتایج
+۳. پیشنهادات عملی و کاربردی
+۴. پیام امیدبخش و دلگرم‌کننده
+
+قوانین مهم:
+- فقط به زبان فارسی بنویس
+- از اعداد فارسی استفاده کن (۱، ۲، ۳)
+- حداکثر ۲۰۰ کلمه
+- لحن گرم و حمایتی داشته باش
+- از اصطلاحات پزشکی پیچیده استفاده نکن'''
+
+
+def score_bin(score, low, high, bins=SCORE_BINS):
+    """(from, to) of the equal-width bin of [low, high] holding score; exact on narrow ranges."""
+    if high - low < bins:
+        return score, score
+    width = (high - low) / bins
+    k = min(max(int((score - low) // width), 0), bins - 1)
+    return round(low + k * width), round(low + (k + 1) * width)
+
+
+def format_range(bounds):
+    return str(bounds[0]) if bounds[0] == bounds[1] else f'{bounds[0]} تا {bounds[1]}'
+
+
+@dataclass(frozen=True)
+class Profile:
+    """The normalized inputs of one analysis prompt."""
+    slug: str
+    test_name: str
+    category: str
+    total: tuple
+    # ((scale name, interpretation, (from, to)), ...)
+    scales: tuple
+    # (overall, details, recommendations) of the stored report
+    standard: tuple
+
+    def key(self, model):
+        data = json.dumps([PROMPT_VERSION, model, self.slug, self.total, self.scales, self.standard],
+                          ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def prompt(self):
+        scales = '\n'.join(f'- {name}: نمره {format_range(bounds)} ({level})' for name, level, bounds in self.scales)
+        overall, details, recommendations = self.standard
+        return PROMPT.format(test_name=self.test_name, category=self.category, total=format_range(self.total),
+                             scales=scales or NO_DATA, overall=overall or NO_DATA, details=details or NO_DATA,
+                             recommendations=recommendations or NO_DATA)
+
+
+def standard_analysis(report_json):
+    """(overall, details, recommendations) the way analyze.ts reads them."""
+    try:
+        overall = json.loads(report_json)['analysis']['overall']
+    except (TypeError, ValueError, KeyError):
+        return '', '', ''
+    if not overall:
+        return '', '', ''
+    return (f"{overall.get('title')}: {overall.get('summary')}", overall.get('details') or '',
+            overall.get('recommendations') or '')
+
+
+class ScoreRanges:
+    """Possible score range of every synced scale and test total, for binning."""
+
+    def __init__(self, conn, definitions):
+        self.scales = {}
+        self.totals = {}
+        for slug, ids in read_catalog(conn, definitions).items():
+            c = compile_test(definitions[slug])
+            mask = np.arange(c.option_scores.shape[1])[None, :] < c.option_counts[:, None]
+            low = np.where(mask, c.option_scores, np.iinfo(np.int64).max).min(axis=1)
+            high = np.where(mask, c.option_scores, np.iinfo(np.int64).min).max(axis=1)
+            self.totals[slug] = (int(low.sum()), int(high.sum()))
+            for j, scale_id in enumerate(ids.scale_ids):
+                items = c.weights[:, j] > 0
+                if scale_id is not None:
+                    self.scales[scale_id] = (int(low[items].sum()), int(high[items].sum()))
+
+
+def session_profiles(conn, definitions, limit):
+    """[(session id, Profile)] for the latest finished sessions."""
+    ranges = ScoreRanges(conn, definitions)
+    names = dict(conn.execute('SELECT id, name FROM scales'))
+    reports = ReportStore(conn)
+    out = []
+    for session_id, slug, test_name, category in conn.execute(FINISHED_SESSIONS, (limit,)).fetchall():
+        if slug not in ranges.totals:
+            continue
+        scales = tuple((names[scale_id], interpretation, score_bin(score, *ranges.scales.get(scale_id, (score, score))))
+                       for scale_id, score, interpretation in conn.execute(SESSION_RESULTS, (session_id,)))
+        total = conn.execute(SESSION_TOTAL, (session_id,)).fetchone()[0]
+        report = reports.read(session_id)
+        out.append((session_id, Profile(slug, test_name, category, score_bin(total, *ranges.totals[slug]), scales,
+                                        standard_analysis(report) if report else ('', '', ''))))
+    return out
+
+
+class AnalysisCache:
+    """Persistent key -> analysis text with a TTL and least-recently-used eviction."""
+
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL_DAYS * 86400, max_entries=DEFAULT_MAX_ENTRIES):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.executescript(CACHE_SCHEMA)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        row = self.conn.execute('SELECT analysis_text FROM ai_cache WHERE key = ? AND created_at >= ?',
+                                (key, now - self.ttl)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute('UPDATE ai_cache SET used_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def put(self, entries, model, now=None):
+        """Store [(key, text)], then drop expired entries and evict past max_entries."""
+        now = time.time() if now is None else now
+        self.conn.execute('BEGIN')
+        self.conn.executemany('INSERT OR REPLACE INTO ai_cache VALUES (?, ?, ?, ?, ?)',
+                              [(key, text, model, now, now) for key, text in entries])
+        self.evictions += self.conn.execute('DELETE FROM ai_cache WHERE created_at < ?', (now - self.ttl,)).rowcount
+        excess = self.conn.execute('SELECT COUNT(*) FROM ai_cache').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.evictions += self.conn.execute(
+                'DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache ORDER BY used_at LIMIT ?)',
+                (excess,)).rowcount
+        self.conn.execute('COMMIT')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM ai_cache').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+class StubBackend:
+    """Offline model: a deterministic text per prompt after a simulated latency."""
+
+    def __init__(self, latency=0.5, per_prompt=0.02, fail_rate=0.0, model='stub'):
+        self.latency = latency
+        self.per_prompt = per_prompt
+        self.fail_rate = fail_rate
+        self.model = model
+        self.calls = self.prompts = 0
+
+    async def generate(self, prompts):
+        self.calls += 1
+        self.prompts += len(prompts)
+        await asyncio.sleep(self.latency + self.per_prompt * len(prompts))
+        if random.random() < self.fail_rate:
+            raise RuntimeError('stub backend failure')
+        return [f"تحلیل آزمایشی {hashlib.sha256(p.encode('utf-8')).hexdigest()[:8]}" for p in prompts]
+
+
+class WorkersAIBackend:
+    """Cloudflare Workers AI over its REST API, as analyze.ts calls it."""
+
+    def __init__(self, account_id, token, model=MODEL, max_tokens=500, temperature=0.7):
+        self.url = f'https://api.cloudflare.com/client/v4/accounts/{account_id}/ai/run/{model}'
+        self.token = token
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.calls = self.prompts = 0
+
+    def _run(self, prompt):
+        body = json.dumps({'prompt': prompt, 'max_tokens': self.max_tokens, 'temperature': self.temperature})
+        request = urllib.request.Request(self.url, data=body.encode('utf-8'), method='POST', headers={
+            'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return json.load(response)['result']['response']
+
+    async def generate(self, prompts):
+        self.calls += 1
+        self.prompts += len(prompts)
+        return await asyncio.gather(*(asyncio.to_thread(self._run, p) for p in prompts))
+
+
+class AnalysisQueue:
+    """Serves analyses from the cache, coalesces in-flight duplicates and batches misses."""
+
+    def __init__(self, backend, cache, max_batch=8, max_wait=0.05, concurrency=4):
+        self.backend = backend
+        self.cache = cache
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.slots = asyncio.Semaphore(concurrency)
+        self.pending = []
+        self.inflight = {}
+        self.wakeup = asyncio.Event()
+        self.batches = set()
+        self.worker = None
+        self.requests = self.cache_hits = self.coalesced = self.failed = 0
+
+    def start(self):
+        self.worker = asyncio.create_task(self._run())
+        return self
+
+    async def close(self):
+        while self.pending or self.batches:
+            await asyncio.gather(*self.batches) if self.batches else await asyncio.sleep(self.max_wait)
+        self.worker.cancel()
+
+    async def analyze(self, profile):
+        """The analysis text for profile."""
+        self.requests += 1
+        key = profile.key(self.backend.model)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return cached
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.inflight[key] = future
+            self.pending.append((key, profile.prompt(), future))
+            self.wakeup.set()
+        # A cancelled caller must not cancel the shared future
+        return await asyncio.shield(future)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < self.max_batch and loop.time() < deadline:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            if not self.pending:
+                self.wakeup.clear()
+            if batch:
+                await self.slots.acquire()
+                task = asyncio.create_task(self._dispatch(batch))
+                self.batches.add(task)
+                task.add_done_callback(self.batches.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            texts = await self.backend.generate([prompt for _, prompt, _ in batch])
+            self.cache.put([(key, text) for (key, _, _), text in zip(batch, texts)], self.backend.model)
+            for (_, _, future), text in zip(batch, texts):
+                future.set_result(text)
+        except Exception as e:
+            self.failed += len(batch)
+            for _, _, future in batch:
+                future.set_exception(e)
+        finally:
+            for key, _, _ in batch:
+                self.inflight.pop(key, None)
+            self.slots.release()
+
+
+async def simulate(queue, requests, clients):
+    """Fire (session id, Profile) requests from `clients` concurrent callers; [(session id, text)]."""
+    gate = asyncio.Semaphore(clients)
+
+    async def one(session_id, profile):
+        async with gate:
+            try:
+                return session_id, await queue.analyze(profile)
+            except Exception:
+                return session_id, None
+
+    queue.start()
+    results = await asyncio.gather(*(one(s, p) for s, p in requests))
+    await queue.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deduplicated, cached and batched AI analyses for stored sessions')
+    parser.add_argument('db')
+    parser.add_argument('--limit', type=int, default=2000, help='latest finished sessions to analyze')
+    parser.add_argument('--repeat', type=int, default=2, help='requests per session, as from repeated clicks')
+    parser.add_argument('--clients', type=int, default=64, help='concurrent callers')
+    parser.add_argument('--batch', type=int, default=8, help='prompts per backend call')
+    parser.add_argument('--max-wait', type=float, default=0.05, help='seconds to wait for a batch to fill')
+    parser.add_argument('--concurrency', type=int, default=4, help='backend calls in flight')
+    parser.add_argument('--cache', default=CACHE_PATH)
+    parser.add_argument('--ttl-days', type=float, default=DEFAULT_TTL_DAYS)
+    parser.add_argument('--max-entries', type=int, default=DEFAULT_MAX_ENTRIES)
+    parser.add_argument('--latency', type=float, default=0.5, help='stub backend seconds per call')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='stub backend failure rate per call')
+    parser.add_argument('--workers-ai', action='store_true', help='call Workers AI with CF_ACCOUNT_ID/CF_API_TOKEN')
+    parser.add_argument('--write', action='store_true', help='store the analyses in ai_analyses')
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    profiles = session_profiles(conn, load_definitions(), args.limit)
+    requests = [r for r in profiles for _ in range(args.repeat)]
+    random.Random(0).shuffle(requests)
+
+    if args.workers_ai:
+        backend = WorkersAIBackend(os.environ['CF_ACCOUNT_ID'], os.environ['CF_API_TOKEN'])
+    else:
+        backend = StubBackend(args.latency, fail_rate=args.fail_rate)
+    cache = AnalysisCache(args.cache, args.ttl_days * 86400, args.max_entries)
+
+    async def run():
+        queue = AnalysisQueue(backend, cache, args.batch, args.max_wait, args.concurrency)
+        return queue, await simulate(queue, requests, args.clients)
+
+    start = time.perf_counter()
+    queue, results = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+
+    if args.write:
+        stored = {s: text for s, text in results if text is not None}
+        with conn:
+            conn.executemany(UPSERT_ANALYSIS, [(s, text, backend.model) for s, text in stored.items()])
+        print(f"Stored {len(stored)} analyses in ai_analyses")
+    conn.close()
+
+    distinct = len({p.key(backend.model) for _, p in profiles})
+    print(f"{len(requests)} requests for {len(profiles)} sessions, {distinct} distinct profiles, {elapsed:.2f}s")
+    print(f"  cache hits {queue.cache_hits}, coalesced {queue.coalesced}, failed {queue.failed}")
+    print(f"  backend: {backend.prompts} prompts in {backend.calls} calls "
+          f"(analyze.ts: {len(requests)} prompts in {len(requests)} calls)")
+    print(f"  cache: {len(cache)} entries, {cache.evictions} evicted")
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,454 @@
+"""Columnar archive of finished sessions' answers, partitioned by test and month.
+
+`answers` holds a row per answer, and cohort analytics scan and pivot
+all of them. This archiver moves the answers of finished sessions older
+than --older-than days into an append-only store under build/archive:
+
+    <slug>/<YYYY-MM>/<segment>/     month of finished_at
+        sessions.npy    int64   session ids, ascending
+        finished.npy    int64   finished_at, epoch seconds
+        users.npy       str     user_uid
+        scores.npy      int8    sessions x items answer scores, MISSING if unanswered
+        options.npy     int8    sessions x items option order_index, -1 if unanswered
+        items.npy       int64   question order of every column
+
+A run adds one segment per partition it touches. manifest.json lists the
+segments with their zone maps: min/max finished_at and session id, plus
+session count. Queries prune on slug and on the zone maps before opening
+a file, then memory-map the arrays. Sessions, results and result_reports
+rows stay in the database. answered_at is not archived, and option_id can
+be recovered from the option order.
+
+Each segment is written to disk first. Then one transaction marks its
+sessions in archived_sessions and, unless --copy is given, deletes their
+answers. The segment is added to the manifest last. After an
+interrupted run, recover() keeps unlisted segments whose sessions were
+marked and removes the others.
+
+Archive.batches()/matrix() return dense (sessions, scores, answered)
+matrices aligned with a compiled test's items, the shape
+mindlab.scoring.answer_matrix produces, so score_matrix and the
+psychometrics accumulators take them directly.
+
+Once a session is archived, readers must not score it from `answers`,
+which is empty after a move:
+- stored_batches() serves a test's archived sessions from the archive and
+  the rest from the answers table. mindlab.psychometrics and
+  mindlab.adaptive read through it.
+- mindlab.rescore takes archived sessions from ArchivedAnswers. It skips
+  the ones the archive does not hold.
+- The Worker is not archive-aware. For an archived session,
+  /api/me/sessions/:id returns an empty `answers` list and a totalScore
+  of 0. Its results and report stay intact.
+
+Usage:
+    python -m mindlab.archive archive local.db [slug ...] [--older-than 90] [--copy]
+    python -m mindlab.archive query [slug ...] [--from 2025-03] [--to 2025-06] [--compare local.db]
+    python -m mindlab.archive stats
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.pipeline import write_atomic
+from mindlab.rescore import CHUNK_ANSWERS, SESSION_PAGE
+from mindlab.scoring import answer_matrix, compile_test, score_matrix
+
+ARCHIVE_DIR = os.path.join(ROOT_DIR, 'build', 'archive')
+MANIFEST_NAME = 'manifest.json'
+ARCHIVE_VERSION = 1
+MISSING = np.iinfo(np.int8).min
+COLUMNS = ('sessions', 'finished', 'users', 'scores', 'options', 'items')
+
+ARCHIVED_TABLE = """
+CREATE TABLE IF NOT EXISTS archived_sessions (
+    session_id INTEGER PRIMARY KEY,
+    segment TEXT NOT NULL,
+    archived_at TEXT DEFAULT (datetime('now'))
+)
+"""
+
+PENDING_SESSIONS = """
+SELECT s.id, s.user_uid, CAST(strftime('%s', s.finished_at) AS INTEGER)
+FROM sessions s
+LEFT JOIN archived_sessions a ON a.session_id = s.id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.finished_at < ? AND a.session_id IS NULL
+ORDER BY s.id
+"""
+
+ARCHIVED_RANGE = """
+SELECT a.session_id
+FROM sessions s
+JOIN archived_sessions a ON a.session_id = s.id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.id > ? AND s.id <= ?
+ORDER BY a.session_id
+"""
+
+BATCH_ANSWERS = """
+SELECT a.session_id, q.order_index, o.order_index, a.score
+FROM archive_batch b
+JOIN answers a ON a.session_id = b.session_id
+LEFT JOIN questions q ON q.id = a.question_id
+LEFT JOIN options o ON o.id = a.option_id
+"""
+
+
+def month_of(seconds):
+    return np.datetime_as_string(np.asarray(seconds, dtype='datetime64[s]').astype('datetime64[M]'))
+
+
+def epoch(text):
+    """'YYYY-MM' or 'YYYY-MM-DD[ HH:MM:SS]' -> epoch seconds."""
+    return int(np.datetime64(text.replace(' ', 'T'), 's').astype(np.int64))
+
+
+def next_month(text):
+    return str(np.datetime64(text, 'M') + 1)
+
+
+def to_int8(values, what):
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) and (values.min() <= MISSING or values.max() > np.iinfo(np.int8).max):
+        raise ValueError(f'{what} outside the int8 range cannot be archived')
+    return values.astype(np.int8)
+
+
+@dataclass
+class Segment:
+    """One written segment and its zone map."""
+    slug: str
+    month: str
+    name: str
+    n: int
+    finished_min: int
+    finished_max: int
+    session_min: int
+    session_max: int
+
+    @property
+    def path(self):
+        return os.path.join(self.slug, self.month, self.name)
+
+    def overlaps(self, start, end):
+        """Whether any finished_at in [start, end) can be in this segment."""
+        return (start is None or self.finished_max >= start) and (end is None or self.finished_min < end)
+
+
+class Archive:
+    """The manifest of an archive directory and queries over it."""
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        path = os.path.join(root, MANIFEST_NAME)
+        data = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        if data.get('version') != ARCHIVE_VERSION:
+            data = {'version': ARCHIVE_VERSION, 'next_segment': 1, 'segments': []}
+        self.next_segment = data['next_segment']
+        self.segments = [Segment(**s) for s in data['segments']]
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        write_atomic(os.path.join(self.root, MANIFEST_NAME), json.dumps({
+            'version': ARCHIVE_VERSION,
+            'next_segment': self.next_segment,
+            'segments': [vars(s) for s in self.segments],
+        }, indent=1) + '\n')
+
+    def prune(self, slug, start=None, end=None):
+        """Segments of slug that can hold sessions finished in [start, end), epoch seconds."""
+        return [s for s in self.segments if s.slug == slug and s.overlaps(start, end)]
+
+    def load(self, segment, columns=COLUMNS):
+        base = os.path.join(self.root, segment.path)
+        return {c: np.load(os.path.join(base, f'{c}.npy'), mmap_mode='r' if c != 'users' else None)
+                for c in columns}
+
+    def batches(self, compiled, start=None, end=None):
+        """Yield (sessions, scores, answered) per pruned segment, columns aligned with compiled.
+
+        Sessions whose finished_at falls outside [start, end) are filtered
+        out of partially overlapping segments.
+        """
+        for segment in self.prune(compiled.slug, start, end):
+            data = self.load(segment, ('sessions', 'finished', 'scores', 'items'))
+            rows = slice(None)
+            if not (start is None or segment.finished_min >= start) or not (end is None or segment.finished_max < end):
+                finished = data['finished']
+                rows = np.flatnonzero(((finished >= start) if start is not None else True)
+                                      & ((finished < end) if end is not None else True))
+            scores = data['scores'][rows]
+            items = np.asarray(data['items'])
+            if np.array_equal(items, compiled.item_orders):
+                answered = scores != MISSING
+                aligned = np.where(answered, scores, 0).astype(np.int8)
+            else:
+                # Questions were added or removed since the segment was written
+                cols = compiled.item_index(items)
+                keep = cols >= 0
+                aligned = np.zeros((len(scores), compiled.n_items), dtype=np.int8)
+                answered = np.zeros(aligned.shape, dtype=bool)
+                hit = scores[:, keep] != MISSING
+                aligned[:, cols[keep]] = np.where(hit, scores[:, keep], 0)
+                answered[:, cols[keep]] = hit
+            yield np.asarray(data['sessions'][rows]), aligned, answered
+
+    def matrix(self, compiled, start=None, end=None):
+        """(sessions, scores, answered) over every pruned segment, ordered by session id."""
+        parts = list(self.batches(compiled, start, end))
+        if not parts:
+            return (np.zeros(0, dtype=np.int64), np.zeros((0, compiled.n_items), dtype=np.int8),
+                    np.zeros((0, compiled.n_items), dtype=bool))
+        sessions = np.concatenate([p[0] for p in parts])
+        order = np.argsort(sessions, kind='stable')
+        return (sessions[order], np.concatenate([p[1] for p in parts])[order],
+                np.concatenate([p[2] for p in parts])[order])
+
+    def write_segment(self, slug, month, item_orders, columns):
+        """Write the arrays of a new segment; returns its Segment (not yet in the manifest)."""
+        name = f'{self.next_segment:06d}'
+        self.next_segment += 1
+        segment = Segment(slug, month, name, len(columns['sessions']),
+                          int(columns['finished'].min()), int(columns['finished'].max()),
+                          int(columns['sessions'].min()), int(columns['sessions'].max()))
+        final = os.path.join(self.root, segment.path)
+        tmp = final + '.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for c, values in {**columns, 'items': item_orders}.items():
+            np.save(os.path.join(tmp, f'{c}.npy'), values)
+        os.replace(tmp, final)
+        return segment
+
+    def recover(self, conn):
+        """Settle segments left outside the manifest by an interrupted run."""
+        listed = {s.path for s in self.segments}
+        marked = {row[0] for row in conn.execute('SELECT DISTINCT segment FROM archived_sessions')}
+        changed = False
+        for slug in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            for month in os.listdir(os.path.join(self.root, slug)) if os.path.isdir(os.path.join(self.root, slug)) else []:
+                for name in os.listdir(os.path.join(self.root, slug, month)):
+                    path = os.path.join(slug, month, name)
+                    if path in listed:
+                        continue
+                    full = os.path.join(self.root, path)
+                    if path in marked:
+                        data = {c: np.load(os.path.join(full, f'{c}.npy')) for c in ('sessions', 'finished')}
+                        self.segments.append(Segment(slug, month, name, len(data['sessions']),
+                                                     int(data['finished'].min()), int(data['finished'].max()),
+                                                     int(data['sessions'].min()), int(data['sessions'].max())))
+                        self.next_segment = max(self.next_segment, int(name) + 1)
+                    else:
+                        shutil.rmtree(full)
+                    changed = True
+        if changed:
+            self.save()
+
+
+class ArchivedAnswers:
+    """One test's archived answers, looked up by session id in answers-table form."""
+
+    def __init__(self, archive, compiled):
+        self.item_orders = compiled.item_orders
+        self.sessions, self.scores, self.answered = archive.matrix(compiled)
+
+    def rows(self, session_ids):
+        """(found, session_ids, orders, scores) for the archived ones among sorted session_ids."""
+        session_ids = np.asarray(session_ids, dtype=np.int64)
+        if not len(self.sessions):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty, empty
+        pos = np.minimum(np.searchsorted(self.sessions, session_ids), len(self.sessions) - 1)
+        hit = self.sessions[pos] == session_ids
+        found, pos = session_ids[hit], pos[hit]
+        rows, cols = np.nonzero(self.answered[pos])
+        return found, found[rows], self.item_orders[cols], self.scores[pos][rows, cols].astype(np.int64)
+
+
+def archived_in_range(conn, params):
+    """Sorted ids of archived sessions in a (test_id, after, last) range; empty before the first archive run."""
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archived_sessions'").fetchone():
+        return np.zeros(0, dtype=np.int64)
+    return np.array([r[0] for r in conn.execute(ARCHIVED_RANGE, params)], dtype=np.int64)
+
+
+def stored_batches(conn, compiled, test_id, archive=None, page=5000):
+    """Yield (sessions, scores, answered) for every finished session of a test.
+
+    Archived sessions come from `archive`, or are left out without one;
+    the rest are read from the answers table one page at a time.
+    """
+    if archive is not None:
+        yield from archive.batches(compiled)
+    after = 0
+    while True:
+        sessions = [r[0] for r in conn.execute(SESSION_PAGE, (test_id, after, page))]
+        if not sessions:
+            return
+        params = (test_id, after, sessions[-1])
+        after = sessions[-1]
+        rows = conn.execute(CHUNK_ANSWERS, params).fetchall()
+        if not rows:
+            continue
+        data = np.array([(s, -1 if o is None else o, sc) for s, o, sc in rows], dtype=np.int64)
+        data = data[~np.isin(data[:, 0], archived_in_range(conn, params))]
+        if len(data):
+            yield answer_matrix(compiled, data[:, 0], data[:, 1], data[:, 2])
+
+
+def archive_test(conn, archive, compiled, test_id, before, copy=False):
+    """Move finished sessions of one test finished before `before` into new segments."""
+    pending = conn.execute(PENDING_SESSIONS, (test_id, before)).fetchall()
+    if not pending:
+        return 0, 0
+    sessions = np.array([r[0] for r in pending], dtype=np.int64)
+    users = np.array([r[1] for r in pending])
+    finished = np.array([r[2] for r in pending], dtype=np.int64)
+
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS archive_batch (session_id INTEGER PRIMARY KEY)')
+    conn.execute('DELETE FROM archive_batch')
+    conn.executemany('INSERT INTO archive_batch VALUES (?)', ((int(s),) for s in sessions))
+    rows = conn.execute(BATCH_ANSWERS).fetchall()
+    data = np.array([(s, -1 if q is None else q, -1 if o is None else o, sc) for s, q, o, sc in rows],
+                    dtype=np.int64).reshape(-1, 4)
+
+    # Pivot like answer_matrix, but into int8 with sentinels and keeping answerless sessions
+    cols = compiled.item_index(data[:, 1])
+    keep = cols >= 0
+    rows_of = np.searchsorted(sessions, data[keep, 0])
+    scores = np.full((len(sessions), compiled.n_items), MISSING, dtype=np.int8)
+    options = np.full(scores.shape, -1, dtype=np.int8)
+    scores[rows_of, cols[keep]] = to_int8(data[keep, 3], 'answer scores')
+    options[rows_of, cols[keep]] = to_int8(data[keep, 2], 'option order')
+
+    months = month_of(finished)
+    written = []
+    for month in np.unique(months):
+        pick = months == month
+        written.append(archive.write_segment(compiled.slug, str(month), compiled.item_orders, {
+            'sessions': sessions[pick], 'finished': finished[pick], 'users': users[pick],
+            'scores': scores[pick], 'options': options[pick],
+        }))
+
+    segment_of = dict(zip(np.unique(months).tolist(), (s.path for s in written)))
+    with conn:
+        conn.executemany('INSERT INTO archived_sessions (session_id, segment) VALUES (?, ?)',
+                         zip(sessions.tolist(), (segment_of[m] for m in months.tolist())))
+        moved = 0 if copy else conn.execute(
+            'DELETE FROM answers WHERE session_id IN (SELECT session_id FROM archive_batch)').rowcount
+    archive.segments.extend(written)
+    archive.save()
+    return len(sessions), moved
+
+
+def run_archive(conn, definitions, archive, older_than_days=90, copy=False):
+    conn.execute(ARCHIVED_TABLE)
+    archive.recover(conn)
+    newest = conn.execute('SELECT MAX(finished_at) FROM sessions').fetchone()[0]
+    if newest is None:
+        return {}
+    # Relative to the newest finished session, so synthetic databases archive too
+    before = np.datetime_as_string(np.datetime64(epoch(newest) - older_than_days * 86400, 's')).replace('T', ' ')
+    counts = {}
+    for slug, ids in read_catalog(conn, definitions).items():
+        counts[slug] = archive_test(conn, archive, compile_test(definitions[slug]), ids.test_id, before, copy)
+    return counts
+
+
+def sql_matrix(conn, compiled, test_id, start, end):
+    """The same matrix read from the answers table, for --compare.
+
+    Only archived sessions are read, so sessions finished after the last
+    archive run do not count as a difference.
+    """
+    rows = conn.execute(
+        'SELECT a.session_id, q.order_index, a.score FROM sessions s '
+        'JOIN archived_sessions x ON x.session_id = s.id JOIN answers a ON a.session_id = s.id '
+        'LEFT JOIN questions q ON q.id = a.question_id WHERE s.test_id = ? AND s.finished_at IS NOT NULL '
+        "AND CAST(strftime('%s', s.finished_at) AS INTEGER) >= ? AND CAST(strftime('%s', s.finished_at) AS INTEGER) < ?",
+        (test_id, start if start is not None else 0, end if end is not None else 1 << 62)).fetchall()
+    data = np.array([(s, -1 if o is None else o, sc) for s, o, sc in rows], dtype=np.int64).reshape(-1, 3)
+    return answer_matrix(compiled, data[:, 0], data[:, 1], data[:, 2])
+
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Columnar, month-partitioned archive of finished sessions')
+    sub = parser.add_subparsers(dest='command', required=True)
+    a = sub.add_parser('archive', help='move old finished sessions into new segments')
+    a.add_argument('db')
+    a.add_argument('slugs', nargs='*')
+    a.add_argument('--older-than', type=int, default=90, help='days before the newest finished session')
+    a.add_argument('--copy', action='store_true', help='keep the answers rows')
+    q = sub.add_parser('query', help='load pruned answer matrices and score them')
+    q.add_argument('slugs', nargs='*')
+    q.add_argument('--from', dest='start', help='YYYY-MM[-DD]; finished at or after')
+    q.add_argument('--to', dest='end', help='YYYY-MM; finished before the end of this month')
+    q.add_argument('--compare', metavar='DB', help='check against the answers table (archive with --copy)')
+    sub.add_parser('stats', help='segments and bytes per partition')
+    for p in (a, q, sub.choices['stats']):
+        p.add_argument('--root', default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    archive = Archive(args.root)
+    if args.command == 'archive':
+        conn = connect(args.db)
+        start = time.perf_counter()
+        counts = run_archive(conn, load_definitions(args.slugs or None), archive, args.older_than, args.copy)
+        conn.close()
+        sessions = sum(c[0] for c in counts.values())
+        print(f"Archived {sessions} sessions ({sum(c[1] for c in counts.values())} answer rows removed) "
+              f"in {time.perf_counter() - start:.2f}s; {len(archive.segments)} segments")
+    elif args.command == 'query':
+        start = epoch(args.start) if args.start else None
+        end = epoch(next_month(args.end)) if args.end else None
+        conn = connect(args.compare) if args.compare else None
+        if conn:
+            conn.execute(ARCHIVED_TABLE)
+        catalog = read_catalog(conn, load_definitions(args.slugs or None)) if conn else {}
+        for slug, definition in load_definitions(args.slugs or None).items():
+            compiled = compile_test(definition)
+            scanned = len(archive.prune(slug, start, end))
+            total = sum(s.slug == slug for s in archive.segments)
+            t = time.perf_counter()
+            sessions, scores, answered = archive.matrix(compiled, start, end)
+            batch = score_matrix(compiled, scores, answered)
+            elapsed = time.perf_counter() - t
+            line = (f"{slug:12s} {scanned:>3d}/{total:<3d} segments  {len(sessions):>7d} sessions  "
+                    f"mean total {batch.total.mean() if len(sessions) else 0:7.2f}  {elapsed * 1000:7.1f} ms")
+            if conn and slug in catalog:
+                t = time.perf_counter()
+                expected = sql_matrix(conn, compiled, catalog[slug].test_id, start, end)
+                sql_ms = (time.perf_counter() - t) * 1000
+                same = (np.array_equal(expected[0], sessions) and np.array_equal(expected[1], scores)
+                        and np.array_equal(expected[2], answered))
+                line += f"  | answers table {sql_ms:7.1f} ms, {'identical' if same else 'DIFFERENT'}"
+            print(line)
+        if conn:
+            conn.close()
+    else:
+        partitions = {}
+        for s in archive.segments:
+            p = partitions.setdefault((s.slug, s.month), [0, 0, 0])
+            p[0] += 1
+            p[1] += s.n
+            p[2] += directory_bytes(os.path.join(archive.root, s.path))
+        for (slug, month), (n_segments, n, size) in sorted(partitions.items()):
+            print(f"{slug:12s} {month}  {n_segments:>3d} segments  {n:>7d} sessions  {size:>10,d} bytes")
+        print(f"{len(archive.segments)} segments, {directory_bytes(archive.root):,d} bytes in {archive.root}")
+
+
+if __name__ == '__main__':
+    main()
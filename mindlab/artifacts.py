@@ -0,0 +1,375 @@
+"""Compact binary scoring artifacts, one per test definition.
+
+Each artifact packs what finish.ts re-derives from the catalog tables on
+every request: question order -> scale index, option scores, reverse
+flags, the cutoff bands of mindlab.scoring and the analysis template
+linked to each cutoff. Layout (little-endian):
+
+    header   4s magic 'MLSA', u16 format version, u16 array count,
+             32s sha256 of the definition (pipeline.content_hash)
+    table    (u32 offset, u32 count) per entry of ARRAYS
+    arrays   8-byte aligned, in ARRAYS order
+
+Strings (slug, scale keys, scale names, cutoff labels) live in a UTF-8
+blob indexed by `string_offsets`. Loading maps the file and wraps each
+array with np.frombuffer, so nothing is parsed or copied until used.
+
+Declared aggregations (mindlab.aggregates) are packed as the compiled
+Aggregation: the item weight and mask matrices, a kind, round() digits
+and composite depth per scale, and a scales x scales composite matrix.
+The `agg_*` arrays are empty for a test without aggregates.
+compiled(aggregates=True) scores like compile_test(..., aggregates=True).
+
+Templates are linked on the English cutoff label, which is what
+analysis_templates.level_label holds in the JSON. finish.ts looks them up
+with cutoffs.label, where sync stores labelFa, so the live lookup misses.
+
+Usage:
+    python -m mindlab.artifacts [--out DIR] [--force] [--check] [slug ...]
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from mindlab.aggregates import Aggregation, compile_aggregation, has_aggregates
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.pipeline import content_hash
+from mindlab.scoring import (CompiledTest, CutoffBands, compile_bands, compile_test, option_matrix_scores,
+                             random_choices, score_matrix)
+
+ARTIFACTS_DIR = os.path.join(ROOT_DIR, 'build', 'scoring')
+EXTENSION = '.mlsa'
+MAGIC = b'MLSA'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct('<4sHH32s')
+ENTRY = struct.Struct('<II')
+
+ARRAYS = (
+    ('item_orders', '<i4'),
+    ('item_scale', '<i2'),        # -1 when scaleKey has no scale
+    ('reverse', 'u1'),
+    ('option_counts', 'u1'),
+    ('option_scores', '<i2'),     # n_items x n_options
+    ('bound_offsets', '<i4'),     # n_scales + 1, into bounds/point_band
+    ('bounds', '<f8'),
+    ('point_band', '<i2'),
+    ('gap_band', '<i2'),          # scale j starts at bound_offsets[j] + j
+    ('cutoff_offsets', '<i4'),    # n_scales + 1, into cutoff_template
+    ('cutoff_template', '<i4'),   # index into analysis_templates, -1 if none
+    ('string_offsets', '<i4'),
+    ('strings', 'u1'),
+    ('agg_weights', '<f8'),       # n_items x n_scales
+    ('agg_mask', '<f8'),          # n_items x n_scales
+    ('agg_kind', 'u1'),           # index into AGGREGATE_KINDS per scale
+    ('agg_digits', 'i1'),         # round() digits, -1 for none
+    ('agg_depth', 'u1'),          # composite dependency depth, 0 otherwise
+    ('agg_composite', '<f8'),     # n_scales x n_scales, column = composite target
+)
+
+AGGREGATE_KINDS = ('sum', 'mean', 'pst', 'psdi', 'composite')
+
+
+def artifact_path(slug, out_dir=ARTIFACTS_DIR):
+    return os.path.join(out_dir, f'{slug}{EXTENSION}')
+
+
+def _strings_blob(strings):
+    encoded = [(s or '').encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i4')
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return offsets, np.frombuffer(b''.join(encoded), dtype='u1')
+
+
+def build_artifact(definition):
+    """Pack one definition into artifact bytes."""
+    scales = definition['scales']
+    questions = definition['questions']
+    scale_pos = {s['key']: i for i, s in enumerate(scales)}
+    compiled = compile_test(definition)
+
+    cutoffs_by_scale = {s['key']: [] for s in scales}
+    for c in definition.get('cutoffs', []):
+        if c['scaleKey'] in cutoffs_by_scale:
+            cutoffs_by_scale[c['scaleKey']].append(c)
+    templates = {(t.get('scaleKey'), t.get('level_label')): i
+                 for i, t in reversed(list(enumerate(definition.get('analysis_templates', []))))}
+
+    bounds, point_band, gap_band, cutoff_template = [], [], [], []
+    bound_offsets, cutoff_offsets = [0], [0]
+    levels, levels_fa = [], []
+    for scale in scales:
+        cutoffs = cutoffs_by_scale[scale['key']]
+        bands = compile_bands(cutoffs)
+        bounds.extend(bands.bounds)
+        point_band.extend(bands.point_band)
+        # compile_bands gives a scale without cutoffs two gap entries; the
+        # layout reserves len(bounds) + 1 per scale
+        gap_band.extend(bands.gap_band[:len(bands.bounds) + 1])
+        bound_offsets.append(len(bounds))
+        cutoff_template.extend(templates.get((scale['key'], c.get('label')), -1) for c in cutoffs)
+        cutoff_offsets.append(len(cutoff_template))
+        levels.extend(bands.levels)
+        levels_fa.extend(bands.levels_fa)
+
+    aggregation = compile_aggregation(definition) if has_aggregates(definition) else None
+    if aggregation:
+        composite = np.zeros((len(scales), len(scales)))
+        depth = np.zeros(len(scales), dtype=int)
+        for d, (targets, matrix) in enumerate(aggregation.composites, 1):
+            composite[:, targets] = matrix
+            depth[targets] = d
+        packed = {
+            'agg_weights': aggregation.weights.ravel(),
+            'agg_mask': aggregation.mask.ravel(),
+            'agg_kind': [AGGREGATE_KINDS.index(kind) for kind in aggregation.kinds],
+            'agg_digits': [-1 if d is None else d for d in aggregation.digits],
+            'agg_depth': depth,
+            'agg_composite': composite.ravel(),
+        }
+    else:
+        packed = {name: [] for name, _ in ARRAYS if name.startswith('agg_')}
+
+    strings = [definition['slug']] + compiled.scale_keys + compiled.scale_names + levels + levels_fa
+    string_offsets, blob = _strings_blob(strings)
+
+    arrays = {
+        'item_orders': compiled.item_orders,
+        'item_scale': [scale_pos.get(q.get('scaleKey'), -1) for q in questions],
+        'reverse': [bool(q.get('reverse')) for q in questions],
+        'option_counts': compiled.option_counts,
+        'option_scores': compiled.option_scores.ravel(),
+        'bound_offsets': bound_offsets,
+        'bounds': bounds,
+        'point_band': point_band,
+        'gap_band': gap_band,
+        'cutoff_offsets': cutoff_offsets,
+        'cutoff_template': cutoff_template,
+        'string_offsets': string_offsets,
+        'strings': blob,
+        **packed,
+    }
+
+    offset = HEADER.size + ENTRY.size * len(ARRAYS)
+    table, chunks = [], []
+    for name, dtype in ARRAYS:
+        data = np.asarray(arrays[name], dtype=dtype).tobytes()
+        pad = -offset % 8
+        chunks.append(b'\0' * pad + data)
+        offset += pad
+        table.append(ENTRY.pack(offset, len(arrays[name])))
+        offset += len(data)
+
+    digest = bytes.fromhex(content_hash(definition))
+    return HEADER.pack(MAGIC, FORMAT_VERSION, len(ARRAYS), digest) + b''.join(table) + b''.join(chunks)
+
+
+def read_digest(path):
+    """Source hash stored in an artifact, or None if missing or another format version."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(head) < HEADER.size:
+        return None
+    magic, version, _, digest = HEADER.unpack(head)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    return digest.hex()
+
+
+class ScoringArtifact:
+    """Read-only, memory-mapped view of one artifact."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_arrays, digest = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{path}: not a scoring artifact')
+        if version != FORMAT_VERSION or n_arrays != len(ARRAYS):
+            raise ValueError(f'{path}: format version {version}, expected {FORMAT_VERSION}')
+        self.path = path
+        self.digest = digest.hex()
+        for i, (name, dtype) in enumerate(ARRAYS):
+            offset, count = ENTRY.unpack_from(self._mm, HEADER.size + i * ENTRY.size)
+            setattr(self, name, np.frombuffer(self._mm, dtype=dtype, count=count, offset=offset))
+        self.n_items = len(self.item_orders)
+        self.n_scales = len(self.bound_offsets) - 1
+        self.n_cutoffs = len(self.cutoff_template)
+
+    def string(self, i):
+        start, end = self.string_offsets[i], self.string_offsets[i + 1]
+        return self.strings[start:end].tobytes().decode('utf-8')
+
+    @property
+    def slug(self):
+        return self.string(0)
+
+    def scale_key(self, j):
+        return self.string(1 + j)
+
+    def scale_name(self, j):
+        return self.string(1 + self.n_scales + j)
+
+    def level(self, cutoff):
+        """(level, levelFa) strings of a global cutoff index."""
+        base = 1 + 2 * self.n_scales
+        return self.string(base + cutoff), self.string(base + self.n_cutoffs + cutoff)
+
+    def template_id(self, scale, band):
+        """Index into analysis_templates for a scale's band, or -1."""
+        if band < 0:
+            return -1
+        return int(self.cutoff_template[self.cutoff_offsets[scale] + band])
+
+    def bands(self, j):
+        lo, hi = self.bound_offsets[j], self.bound_offsets[j + 1]
+        first, last = self.cutoff_offsets[j], self.cutoff_offsets[j + 1]
+        labels = [self.level(c) for c in range(first, last)]
+        return CutoffBands(
+            bounds=self.bounds[lo:hi].astype(np.float64),
+            point_band=self.point_band[lo:hi].astype(np.int32),
+            gap_band=self.gap_band[lo + j:hi + j + 1].astype(np.int32),
+            levels=[level for level, _ in labels],
+            levels_fa=[level_fa for _, level_fa in labels],
+        )
+
+    def aggregation(self):
+        """mindlab.aggregates.Aggregation of the packed specs, or None."""
+        if not len(self.agg_kind):
+            return None
+        shape = (self.n_items, self.n_scales)
+        composite = self.agg_composite.reshape(self.n_scales, self.n_scales)
+        composites = []
+        for d in range(1, int(self.agg_depth.max()) + 1):
+            targets = np.flatnonzero(self.agg_depth == d).tolist()
+            composites.append((targets, composite[:, targets].copy()))
+        return Aggregation(
+            weights=self.agg_weights.reshape(shape).copy(),
+            mask=self.agg_mask.reshape(shape).copy(),
+            kinds=[AGGREGATE_KINDS[k] for k in self.agg_kind],
+            composites=composites,
+            digits=[None if d < 0 else int(d) for d in self.agg_digits],
+        )
+
+    def compiled(self, aggregates=False):
+        """CompiledTest for mindlab.scoring, built from the mapped arrays.
+
+        Every array is copied, so the result outlives close(). With
+        aggregates=True the packed aggregations are used, as in compile_test.
+        """
+        n_options = len(self.option_scores) // max(self.n_items, 1)
+        weights = np.zeros((self.n_items, self.n_scales), dtype=np.float64)
+        mapped = np.flatnonzero(self.item_scale >= 0)
+        weights[mapped, self.item_scale[mapped]] = 1.0
+        return CompiledTest(
+            slug=self.slug,
+            scale_keys=[self.scale_key(j) for j in range(self.n_scales)],
+            scale_names=[self.scale_name(j) for j in range(self.n_scales)],
+            item_orders=self.item_orders.astype(np.int64),
+            option_scores=self.option_scores.reshape(self.n_items, n_options).astype(np.int64),
+            option_counts=self.option_counts.astype(np.int64),
+            weights=weights,
+            bands=[self.bands(j) for j in range(self.n_scales)],
+            aggregation=self.aggregation() if aggregates else None,
+        )
+
+    def close(self):
+        # mmap.close() refuses while a view exported from it is alive. Views
+        # the caller still holds keep the mapping open; the GC unmaps it
+        # once they are gone.
+        for name, _ in ARRAYS:
+            setattr(self, name, None)
+        try:
+            self._mm.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_artifacts(definitions=None, out_dir=ARTIFACTS_DIR, force=False):
+    """Build artifacts whose source hash changed. Returns the slugs written."""
+    definitions = definitions or load_definitions()
+    os.makedirs(out_dir, exist_ok=True)
+    written = []
+    for slug, definition in definitions.items():
+        path = artifact_path(slug, out_dir)
+        if not force and read_digest(path) == content_hash(definition):
+            continue
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(build_artifact(definition))
+        os.replace(tmp, path)
+        written.append(slug)
+    return written
+
+
+def load_artifacts(out_dir=ARTIFACTS_DIR, slugs=None):
+    """{slug: ScoringArtifact} for every artifact in out_dir (or the given slugs)."""
+    if slugs is None:
+        slugs = sorted(name[:-len(EXTENSION)] for name in os.listdir(out_dir) if name.endswith(EXTENSION))
+    return {slug: ScoringArtifact(artifact_path(slug, out_dir)) for slug in slugs}
+
+
+def check(definitions, artifacts, n_sessions=2000):
+    """Score random sessions through both the JSON and the artifact path."""
+    mismatches = {}
+    for slug, definition in definitions.items():
+        mismatches[slug] = 0
+        for aggregates in (False, True):
+            expected = compile_test(definition, aggregates)
+            actual = artifacts[slug].compiled(aggregates)
+            choices = random_choices(expected, n_sessions, skip_rate=0.02)
+            scores, answered = option_matrix_scores(expected, choices)
+            a, b = score_matrix(expected, scores, answered), score_matrix(actual, scores, answered)
+            same = (np.array_equal(a.total, b.total) and np.array_equal(a.scale_scores, b.scale_scores)
+                    and np.array_equal(a.bands, b.bands)
+                    and [bands.levels for bands in expected.bands] == [bands.levels for bands in actual.bands]
+                    and [bands.levels_fa for bands in expected.bands] == [bands.levels_fa for bands in actual.bands])
+            mismatches[slug] += 0 if same else 1
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile test definitions into binary scoring artifacts')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--out', default=ARTIFACTS_DIR)
+    parser.add_argument('--force', action='store_true', help='rebuild even when the source hash matches')
+    parser.add_argument('--check', action='store_true', help='verify artifacts against the JSON scorer')
+    args = parser.parse_args()
+
+    definitions = load_definitions(args.slugs or None)
+    written = write_artifacts(definitions, args.out, args.force)
+    print(f"Wrote {len(written)} artifact(s)" + (f": {', '.join(written)}" if written else ''))
+
+    start = time.perf_counter()
+    artifacts = load_artifacts(args.out, list(definitions))
+    mapped = time.perf_counter() - start
+    start = time.perf_counter()
+    for artifact in artifacts.values():
+        artifact.compiled()
+    unpacked = time.perf_counter() - start
+    size = sum(os.path.getsize(a.path) for a in artifacts.values())
+    print(f"Mapped {len(artifacts)} artifact(s), {size / 1024:.1f} KiB, in {mapped * 1e6:.0f} us; "
+          f"unpacked for scoring in {unpacked * 1e6:.0f} us")
+
+    if args.check:
+        for slug, bad in check(definitions, artifacts).items():
+            print(f"{slug:12s} {'OK' if not bad else 'MISMATCH'}")
+    for artifact in artifacts.values():
+        artifact.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Session lifecycle benchmark against a local database.
+
+Replays start -> answer x N -> finish for every test definition through
+the handler ports in mindlab/handlers.py, so every statement is the one
+D1 would run. Reports p50/p95/p99 latency per phase and per whole
+session, plus statements, rows returned and rows written per session.
+The JSON output is deterministic apart from timings, so two runs before
+and after a migration or scoring change can be diffed directly.
+
+Usage:
+    python -m mindlab.bench_lifecycle [--db local.db] [--sessions 50] [--out bench.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import numpy as np
+
+from mindlab import handlers
+from mindlab.d1 import Counters, TracingD1
+from mindlab.definitions import load_definitions
+from mindlab.localdb import build_database, connect, migration_files
+
+PHASES = ('start', 'answer', 'finish')
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    p50, p95, p99 = np.percentile(np.asarray(values) * 1000, [50, 95, 99])
+    return {'p50': round(float(p50), 3), 'p95': round(float(p95), 3), 'p99': round(float(p99), 3)}
+
+
+def replay_session(db, uid, test_id, rng, skip_rate=0.0):
+    """Run one lifecycle. Returns ({phase: seconds}, {phase: Counters})."""
+    seconds = dict.fromkeys(PHASES, 0.0)
+    counters = {phase: Counters() for phase in PHASES}
+
+    def timed(phase, fn, *args):
+        db.reset()
+        db.handler = phase
+        start = time.perf_counter()
+        status, body = fn(db, *args)
+        seconds[phase] += time.perf_counter() - start
+        counters[phase].add(db.by_handler[phase])
+        if status >= 400:
+            raise RuntimeError(f"{phase} failed with {status}: {body}")
+        return body
+
+    body = timed('start', handlers.start, uid, test_id)
+    session_id = body['sessionId']
+    for q in body['questions']:
+        if skip_rate and rng.random() < skip_rate:
+            continue
+        option = rng.choice(q['options'])
+        timed('answer', handlers.answer, uid, session_id, q['id'], option['id'])
+    timed('finish', handlers.finish, uid, session_id)
+    return seconds, counters
+
+
+def run(conn, definitions, sessions_per_test=50, seed=0, skip_rate=0.0):
+    db = TracingD1(conn)
+    rng = random.Random(seed)
+    report = {}
+    for slug in definitions:
+        row = conn.execute('SELECT id FROM tests WHERE slug = ?', (slug,)).fetchone()
+        if not row:
+            continue
+        test_id = row[0]
+        samples = {phase: [] for phase in PHASES + ('session',)}
+        totals = Counters()
+        per_phase = {phase: Counters() for phase in PHASES}
+
+        for i in range(sessions_per_test):
+            seconds, counters = replay_session(db, f'bench-{slug}-{i}', test_id, rng, skip_rate)
+            for phase in PHASES:
+                samples[phase].append(seconds[phase])
+                per_phase[phase].add(counters[phase])
+                totals.add(counters[phase])
+            samples['session'].append(sum(seconds.values()))
+
+        n = sessions_per_test
+        report[slug] = {
+            'questions': len(definitions[slug]['questions']),
+            'scales': len(definitions[slug]['scales']),
+            'latency_ms': {name: percentiles(values) for name, values in samples.items()},
+            'per_session': {
+                'statements': totals.statements / n,
+                'rows_returned': totals.rows_returned / n,
+                'rows_written': totals.rows_written / n,
+                'by_phase': {phase: {
+                    'statements': c.statements / n,
+                    'rows_returned': c.rows_returned / n,
+                    'rows_written': c.rows_written / n,
+                } for phase, c in per_phase.items()},
+            },
+        }
+    return report
+
+
+def environment():
+    digest = hashlib.sha256()
+    for path in migration_files():
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return {
+        'sqlite': sqlite3.sqlite_version,
+        'migrations': [os.path.basename(p) for p in migration_files()],
+        'migrations_sha256': digest.hexdigest(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the start/answer/finish lifecycle on local SQLite')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--db', help='existing database from mindlab.localdb (default: fresh temporary one)')
+    parser.add_argument('--background-answers', type=int, default=200_000,
+                        help='synthetic answers in the fresh database so indexes carry real volume')
+    parser.add_argument('--sessions', type=int, default=50, help='sessions replayed per test')
+    parser.add_argument('--skip-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    definitions = load_definitions(args.slugs or None)
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.db:
+            conn = connect(args.db)
+        else:
+            conn, _ = build_database(os.path.join(tmp, 'bench.db'), n_answers=args.background_answers,
+                                     seed=args.seed, definitions=load_definitions())
+        report = {
+            'environment': environment(),
+            'sessions_per_test': args.sessions,
+            'tests': run(conn, definitions, args.sessions, args.seed, args.skip_rate),
+        }
+        conn.close()
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(text)
+        for slug, r in report['tests'].items():
+            lat, per = r['latency_ms']['session'], r['per_session']
+            print(f"{slug:12s} p50 {lat['p50']:7.2f} ms  p95 {lat['p95']:7.2f} ms  p99 {lat['p99']:7.2f} ms  "
+                  f"{per['statements']:6.0f} stmts  {per['rows_returned']:6.0f} rows returned  {per['rows_written']:5.0f} written")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Split the test definitions into lazily loaded, content-hashed bundles.
+
+data/tests/index.ts imports all 15 definitions eagerly, templates and
+recommendations included. This step splits every definition into
+
+    meta        slug, names, category, description, warning, timeMinutes,
+                question count and scale names; also inlined in the manifest
+    questions   questions with their options, needed while taking the test
+    results     scales, cutoffs, analysis templates and risk rules, needed
+                only once a session finishes
+
+and writes each part as <slug>.<part>.<hash>.json, where the hash covers
+the file's bytes, so the files can be served with an immutable
+Cache-Control and only a changed part gets a new URL. manifest.json
+(short-lived cache) lists every part with its path, hash and sizes. Files
+of the previous manifest are kept for clients still holding it; older
+generations are removed. A run limited to some slugs updates their entries
+in the existing manifest and only removes old files of those tests.
+
+Deploy after `npm run build`:
+
+    python -m mindlab.bundles --out apps/web/dist/tests --headers apps/web/dist/_headers
+
+Usage:
+    python -m mindlab.bundles [--out build/bundles] [--headers FILE] [--report sizes.json] [slug ...]
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.pipeline import write_atomic
+
+BUNDLES_DIR = os.path.join(ROOT_DIR, 'build', 'bundles')
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+HASH_LENGTH = 12
+
+META_FIELDS = ('slug', 'name', 'nameFa', 'category', 'categoryFa', 'description', 'descriptionFa',
+               'analysis_type', 'warning', 'timeMinutes')
+RESULTS_FIELDS = ('scales', 'cutoffs', 'analysis_templates', 'risk_rules')
+PARTS = ('meta', 'questions', 'results')
+
+HEADERS_BEGIN = '# mindlab.bundles begin'
+HEADERS_END = '# mindlab.bundles end'
+
+
+def split_definition(definition):
+    """{part: JSON-ready value} for one definition."""
+    meta = {k: definition[k] for k in META_FIELDS if k in definition}
+    meta['questionCount'] = len(definition['questions'])
+    meta['scales'] = [{'key': s['key'], 'name': s['name'], 'nameFa': s['nameFa']} for s in definition['scales']]
+    return {
+        'meta': meta,
+        'questions': {'slug': definition['slug'], 'questions': definition['questions']},
+        'results': {'slug': definition['slug'], **{k: definition.get(k, []) for k in RESULTS_FIELDS}},
+    }
+
+
+def encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def content_digest(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def build_bundles(definitions, out_dir, merge=False):
+    """Write every part and the manifest; returns the manifest.
+
+    With merge=True, tests of the previous manifest that are not in
+    `definitions` are kept as they are.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    previous = load_manifest(out_dir)
+    tests = dict(previous['tests']) if merge else {}
+    for slug, definition in definitions.items():
+        parts = {}
+        split = split_definition(definition)
+        for part in PARTS:
+            data = encode(split[part])
+            digest = content_digest(data)
+            name = f'{slug}.{part}.{digest}.json'
+            path = os.path.join(out_dir, name)
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(data)
+            parts[part] = {'file': name, 'hash': digest, 'bytes': len(data),
+                           'gzipBytes': len(gzip.compress(data, compresslevel=9))}
+        tests[slug] = {'meta': split['meta'], 'parts': parts}
+
+    manifest = {'version': MANIFEST_VERSION, 'tests': tests}
+    write_atomic(os.path.join(out_dir, MANIFEST_NAME), json.dumps(manifest, ensure_ascii=False, indent=2) + '\n')
+
+    keep = manifest_files(manifest) | manifest_files(previous) | {MANIFEST_NAME}
+    for name in os.listdir(out_dir):
+        if name.endswith('.json') and name not in keep and name.count('.') == 3:
+            if merge and name.split('.')[0] not in definitions:
+                continue
+            os.remove(os.path.join(out_dir, name))
+    return manifest
+
+
+def load_manifest(out_dir):
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'version': MANIFEST_VERSION, 'tests': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def manifest_files(manifest):
+    return {p['file'] for test in manifest.get('tests', {}).values() for p in test['parts'].values()}
+
+
+def write_headers(path, url_prefix):
+    """Add Cloudflare Pages cache rules for the bundles to a _headers file, replacing earlier ones."""
+    rules = (f'{HEADERS_BEGIN}\n{url_prefix}/*\n  Cache-Control: public, max-age=31536000, immutable\n'
+             f'{url_prefix}/{MANIFEST_NAME}\n  ! Cache-Control\n  Cache-Control: public, max-age=60, must-revalidate\n'
+             f'{HEADERS_END}\n')
+    text = ''
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        if HEADERS_BEGIN in text:
+            head, _, rest = text.partition(HEADERS_BEGIN)
+            text = head + rest.partition(HEADERS_END + '\n')[2]
+    write_atomic(path, text + rules)
+
+
+def size_report(definitions, manifest):
+    """Rows of (slug, eager bytes, eager gzip, {part: (bytes, gzip)})."""
+    rows = []
+    for slug, definition in definitions.items():
+        # index.ts bundles the file as parsed JSON, so compare against compact JSON
+        eager = encode(definition)
+        parts = {part: (p['bytes'], p['gzipBytes']) for part, p in manifest['tests'][slug]['parts'].items()}
+        rows.append((slug, len(eager), len(gzip.compress(eager, compresslevel=9)), parts))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split test definitions into lazy, content-hashed bundles')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--out', default=BUNDLES_DIR)
+    parser.add_argument('--headers', help='Cloudflare Pages _headers file to add immutable cache rules to')
+    parser.add_argument('--url-prefix', default='/tests', help='URL the --out directory is served under')
+    parser.add_argument('--report', help='write the size report as JSON')
+    args = parser.parse_args()
+
+    definitions = load_definitions(args.slugs or None)
+    manifest = build_bundles(definitions, args.out, merge=bool(args.slugs))
+    if args.headers:
+        write_headers(args.headers, args.url_prefix)
+
+    rows = size_report(definitions, manifest)
+    print(f"{'test':12s} {'eager':>9s} {'gzip':>7s} | {'meta':>7s} {'gzip':>6s} | {'questions':>9s} {'gzip':>6s} | "
+          f"{'results':>8s} {'gzip':>6s} | take-test share")
+    totals = [0] * 8
+    for slug, eager, eager_gz, parts in rows:
+        take = parts['meta'][1] + parts['questions'][1]
+        print(f"{slug:12s} {eager:>9,d} {eager_gz:>7,d} | {parts['meta'][0]:>7,d} {parts['meta'][1]:>6,d} | "
+              f"{parts['questions'][0]:>9,d} {parts['questions'][1]:>6,d} | {parts['results'][0]:>8,d} "
+              f"{parts['results'][1]:>6,d} | {take / eager_gz:6.1%}")
+        values = (eager, eager_gz) + parts['meta'] + parts['questions'] + parts['results']
+        totals = [t + v for t, v in zip(totals, values)]
+    print(f"{'total':12s} {totals[0]:>9,d} {totals[1]:>7,d} | {totals[2]:>7,d} {totals[3]:>6,d} | "
+          f"{totals[4]:>9,d} {totals[5]:>6,d} | {totals[6]:>8,d} {totals[7]:>6,d} |")
+    manifest_size = os.path.getsize(os.path.join(args.out, MANIFEST_NAME))
+    print(f"\nmanifest.json {manifest_size:,d} bytes; listing the catalog needs only the manifest, "
+          f"taking one test its questions part ({totals[5] / len(rows) / 1024:.1f} KB gzip on average)")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump([{'slug': slug, 'eager': eager, 'eagerGzip': eager_gz,
+                        **{part: {'bytes': b, 'gzipBytes': g} for part, (b, g) in parts.items()}}
+                       for slug, eager, eager_gz, parts in rows], f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
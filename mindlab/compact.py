@@ -0,0 +1,489 @@
+"""Compact storage for old result_reports rows.
+
+finish.ts stores the whole ResultReport of every session. Most of its
+bytes repeat across sessions: the test block, the Persian disclaimer,
+the analysis template paragraphs and the risk messages. Only the
+scores, levels and completedAt vary. This job moves the reports of
+sessions finished more than --older-than days ago into compact_reports:
+
+    1. interning: every string value of the report found in the
+       dictionary's string table becomes "\\x00<index>"
+    2. the interned JSON is deflated with zlib against a preset
+       dictionary of representative interned reports, one per test
+
+A dictionary (report_dictionaries) is trained once from a sample of the
+stored reports and the catalog strings, and is never modified. Each
+compact row names its dictionary, so retraining only affects rows
+compacted later. Every row is decoded before it is written. A report
+that does not decode back to the same text (not JSON.stringify output,
+or holding a \\x00 string) is stored as zlib of the raw text instead.
+Decoding always returns the stored text, byte for byte.
+
+The Worker still reads result_reports only. Compaction is therefore
+meant for cold sessions, like mindlab.archive. Python readers go through
+ReportStore.read()/read_report(), which check both tables, and `restore`
+moves rows back. Each batch is one transaction that inserts compact
+rows and deletes the originals, so an interrupted run just continues.
+Deleted rows leave free pages behind: with auto_vacuum=INCREMENTAL
+(--incremental-vacuum converts the database once) every batch releases
+up to --vacuum-pages of them. Otherwise a full VACUUM runs at the end
+when the free share of the file exceeds --vacuum-threshold.
+
+Usage:
+    python -m mindlab.compact seed local.db [slug ...] [--english-templates]
+    python -m mindlab.compact compact local.db [--older-than 90] [--batch 2000] [--retrain]
+    python -m mindlab.compact stats local.db
+    python -m mindlab.compact restore local.db
+"""
+import argparse
+import json
+import os
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from mindlab.definitions import load_definitions
+from mindlab.handlers import DEFAULT_WARNING, to_json
+from mindlab.localdb import connect, read_catalog
+from mindlab.reports import ReportRenderer
+from mindlab.rescore import CHUNK_ANSWERS, SESSION_PAGE
+from mindlab.scoring import answer_matrix, compile_test, score_matrix
+
+COMPACT_TABLES = """
+CREATE TABLE IF NOT EXISTS report_dictionaries (
+    id INTEGER PRIMARY KEY,
+    strings TEXT NOT NULL,
+    zdict BLOB NOT NULL,
+    created_at TEXT DEFAULT (datetime('now'))
+);
+CREATE TABLE IF NOT EXISTS compact_reports (
+    session_id INTEGER PRIMARY KEY,
+    dictionary_id INTEGER NOT NULL REFERENCES report_dictionaries(id),
+    codec INTEGER NOT NULL,
+    body BLOB NOT NULL,
+    raw_bytes INTEGER NOT NULL,
+    created_at TEXT,
+    FOREIGN KEY (session_id) REFERENCES sessions(id) ON DELETE CASCADE
+);
+"""
+
+# Codecs of compact_reports.body, both deflated against the dictionary
+INTERNED = 1
+RAW = 2
+
+MARK = '\x00'
+MIN_INTERNED = 16
+ZDICT_BYTES = 32 * 1024
+SAMPLE_REPORTS = 2000
+
+SAMPLE = 'SELECT report_json FROM result_reports ORDER BY random() LIMIT ?'
+CATALOG_STRINGS = """
+SELECT title FROM analysis_templates UNION ALL SELECT summary FROM analysis_templates
+UNION ALL SELECT details FROM analysis_templates UNION ALL SELECT recommendations FROM analysis_templates
+UNION ALL SELECT disclaimer FROM analysis_templates UNION ALL SELECT warning FROM tests
+UNION ALL SELECT name FROM tests UNION ALL SELECT message FROM risk_rules
+"""
+COLD_REPORTS = """
+SELECT rr.session_id, rr.report_json, rr.created_at
+FROM result_reports rr
+JOIN sessions s ON s.id = rr.session_id
+WHERE s.finished_at < ? AND rr.session_id > ?
+ORDER BY rr.session_id
+LIMIT ?
+"""
+INSERT_COMPACT = """
+INSERT OR REPLACE INTO compact_reports (session_id, dictionary_id, codec, body, raw_bytes, created_at)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+# Dictionaries with an empty preset were trained on no reports
+NEWEST_DICTIONARY = 'SELECT MAX(id) FROM report_dictionaries WHERE length(zdict) > 0'
+READ_COMPACT = 'SELECT dictionary_id, codec, body FROM compact_reports WHERE session_id = ?'
+CHUNK_COMPACT_REPORTS = """
+SELECT c.session_id, c.dictionary_id, c.codec, c.body
+FROM sessions s
+JOIN compact_reports c ON c.session_id = s.id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.id > ? AND s.id <= ?
+"""
+RESTORE_REPORTS = """
+INSERT INTO result_reports (session_id, report_json, created_at) VALUES (?, ?, ?)
+ON CONFLICT(session_id) DO UPDATE SET report_json = excluded.report_json
+"""
+
+
+def strings_of(value, out):
+    if isinstance(value, str):
+        out.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            strings_of(v, out)
+    elif isinstance(value, list):
+        for v in value:
+            strings_of(v, out)
+    return out
+
+
+def _replace(value, lookup):
+    if isinstance(value, str):
+        return lookup(value)
+    if isinstance(value, dict):
+        return {k: _replace(v, lookup) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_replace(v, lookup) for v in value]
+    return value
+
+
+class ReportCodec:
+    """Interning plus preset-dictionary deflate for one report_dictionaries row."""
+
+    def __init__(self, dictionary_id, strings, zdict):
+        self.id = dictionary_id
+        self.strings = strings
+        self.zdict = zdict
+        self.index = {s: f'{MARK}{i}' for i, s in enumerate(strings)}
+
+    def intern(self, text):
+        return to_json(_replace(json.loads(text), lambda s: self.index.get(s, s)))
+
+    def expand(self, text):
+        strings = self.strings
+        return to_json(_replace(json.loads(text), lambda s: strings[int(s[1:])] if s[:1] == MARK else s))
+
+    def deflate(self, text):
+        c = zlib.compressobj(9, zdict=self.zdict)
+        return c.compress(text.encode('utf-8')) + c.flush()
+
+    def inflate(self, body):
+        d = zlib.decompressobj(zdict=self.zdict)
+        return (d.decompress(body) + d.flush()).decode('utf-8')
+
+    def encode(self, text):
+        """(codec, body) of a report_json text."""
+        try:
+            interned = self.intern(text)
+            if self.expand(interned) == text:
+                return INTERNED, self.deflate(interned)
+        except (ValueError, IndexError):
+            pass
+        return RAW, self.deflate(text)
+
+    def decode(self, codec, body):
+        text = self.inflate(body)
+        return self.expand(text) if codec == INTERNED else text
+
+
+def train(conn, sample=SAMPLE_REPORTS, min_count=2):
+    """Build a ReportCodec from a sample of stored reports and the catalog strings; saves it.
+
+    Returns None, saving nothing, when there are no reports to sample.
+    """
+    texts = [r[0] for r in conn.execute(SAMPLE, (sample,))]
+    if not texts:
+        return None
+    counts = Counter(s for text in texts for s in strings_of(json.loads(text), []) if len(s) >= MIN_INTERNED)
+    # Catalog strings are kept even when the sample misses them
+    catalog = {s for s, in conn.execute(CATALOG_STRINGS) if s and len(s) >= MIN_INTERNED} | {DEFAULT_WARNING}
+    strings = [s for s, n in counts.most_common() if n >= min_count or s in catalog]
+    strings += sorted(catalog - set(strings))
+    codec = ReportCodec(None, strings, b'')
+
+    # One interned report per test, the most frequent tests last: deflate
+    # finds the closest matches at the end of the preset dictionary
+    by_test, frequency = {}, Counter()
+    for text in texts:
+        slug = json.loads(text).get('test', {}).get('slug')
+        frequency[slug] += 1
+        by_test.setdefault(slug, codec.intern(text))
+    zdict = ''.join(by_test[slug] for slug, _ in reversed(frequency.most_common())).encode('utf-8')[-ZDICT_BYTES:]
+
+    conn.executescript(COMPACT_TABLES)
+    cursor = conn.execute('INSERT INTO report_dictionaries (strings, zdict) VALUES (?, ?)',
+                          (to_json(strings), zdict))
+    return ReportCodec(cursor.lastrowid, strings, zdict)
+
+
+class ReportStore:
+    """Reads report_json from result_reports or compact_reports, whichever holds it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.codecs = {}
+        self.enabled = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'compact_reports'").fetchone() is not None
+
+    def codec(self, dictionary_id=None):
+        """Codec of a dictionary, the newest one by default (None before any training)."""
+        if dictionary_id is None:
+            row = self.conn.execute(NEWEST_DICTIONARY).fetchone() if self.enabled else None
+            if not row or row[0] is None:
+                return None
+            dictionary_id = row[0]
+        if dictionary_id not in self.codecs:
+            strings, zdict = self.conn.execute('SELECT strings, zdict FROM report_dictionaries WHERE id = ?',
+                                               (dictionary_id,)).fetchone()
+            self.codecs[dictionary_id] = ReportCodec(dictionary_id, json.loads(strings), zdict)
+        return self.codecs[dictionary_id]
+
+    def decode(self, dictionary_id, codec, body):
+        return self.codec(dictionary_id).decode(codec, body)
+
+    def read(self, session_id):
+        """The session's report_json text, or None."""
+        row = self.conn.execute('SELECT report_json FROM result_reports WHERE session_id = ?', (session_id,)).fetchone()
+        if row or not self.enabled:
+            return row[0] if row else None
+        row = self.conn.execute(READ_COMPACT, (session_id,)).fetchone()
+        return self.decode(*row) if row else None
+
+    def chunk(self, params):
+        """{session_id: report_json} of the compacted reports in a mindlab.rescore chunk."""
+        if not self.enabled:
+            return {}
+        return {s: self.decode(d, c, body) for s, d, c, body in self.conn.execute(CHUNK_COMPACT_REPORTS, params)}
+
+    def rewrite(self, report_rows):
+        """Re-encode the compacted ones among [(report_json, session_id)]; call inside a transaction."""
+        if not self.enabled or not report_rows:
+            return 0
+        rows = []
+        for text, session_id in report_rows:
+            row = self.conn.execute('SELECT dictionary_id FROM compact_reports WHERE session_id = ?',
+                                    (session_id,)).fetchone()
+            if row:
+                codec = self.codec(row[0])
+                rows.append((*codec.encode(text), len(text.encode('utf-8')), session_id))
+        self.conn.executemany('UPDATE compact_reports SET codec = ?, body = ?, raw_bytes = ? WHERE session_id = ?', rows)
+        return len(rows)
+
+
+def read_report(conn, session_id):
+    return ReportStore(conn).read(session_id)
+
+
+def free_share(conn):
+    pages, free = (conn.execute(f'PRAGMA {p}').fetchone()[0] for p in ('page_count', 'freelist_count'))
+    return free / pages if pages else 0.0
+
+
+def file_bytes(path):
+    return sum(os.path.getsize(path + s) for s in ('', '-wal') if os.path.exists(path + s))
+
+
+def compact(conn, codec, older_than_days=90, batch=2000, vacuum_pages=2000, progress=print):
+    """Move cold reports into compact_reports batch by batch. Returns the run's statistics."""
+    newest = conn.execute('SELECT MAX(finished_at) FROM sessions').fetchone()[0]
+    if newest is None:
+        return {'reports': 0}
+    cutoff = conn.execute("SELECT datetime(?, ?)", (newest, f'-{older_than_days} days')).fetchone()[0]
+    incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    stats = Counter()
+    after, start = 0, time.perf_counter()
+    while True:
+        rows = conn.execute(COLD_REPORTS, (cutoff, after, batch)).fetchall()
+        if not rows:
+            break
+        t = time.perf_counter()
+        out = []
+        for session_id, text, created_at in rows:
+            kind, body = codec.encode(text)
+            raw = len(text.encode('utf-8'))
+            out.append((session_id, codec.id, kind, body, raw, created_at))
+            stats['raw_bytes'] += raw
+            stats['compact_bytes'] += len(body)
+            stats['raw_codec'] += kind == RAW
+        stats['encode_seconds'] += time.perf_counter() - t
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(INSERT_COMPACT, out)
+            conn.executemany('DELETE FROM result_reports WHERE session_id = ?', [(r[0],) for r in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if incremental and vacuum_pages:
+            conn.execute(f'PRAGMA incremental_vacuum({vacuum_pages})').fetchall()
+        stats['reports'] += len(rows)
+        after = rows[-1][0]
+        elapsed = time.perf_counter() - start
+        progress(f"{stats['reports']} reports, {stats['reports'] / elapsed:,.0f}/s, "
+                 f"{stats['raw_bytes'] / max(stats['compact_bytes'], 1):.1f}x")
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def vacuum(conn, threshold):
+    """VACUUM when the free pages exceed threshold of the file; returns the share before."""
+    share = free_share(conn)
+    if share >= threshold:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            conn.execute('PRAGMA incremental_vacuum').fetchall()
+        else:
+            conn.execute('VACUUM')
+    return share
+
+
+def restore(conn, batch=2000):
+    """Move every compacted report back into result_reports."""
+    store, moved = ReportStore(conn), 0
+    while store.enabled:
+        rows = conn.execute('SELECT session_id, dictionary_id, codec, body, created_at FROM compact_reports '
+                            'ORDER BY session_id LIMIT ?', (batch,)).fetchall()
+        if not rows:
+            break
+        conn.execute('BEGIN')
+        try:
+            conn.executemany(RESTORE_REPORTS, [(s, store.decode(d, c, b), created) for s, d, c, b, created in rows])
+            conn.executemany('DELETE FROM compact_reports WHERE session_id = ?', [(r[0],) for r in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        moved += len(rows)
+    return moved
+
+
+def seed(conn, definitions, chunk=5000, template_field='level'):
+    """Render a finish.ts report for every finished session without one. Returns rows written.
+
+    Sessions whose report was moved to compact_reports already have one.
+
+    Templates are matched on finish.ts's `level` by default, like
+    mindlab.rescore, so a later rescore leaves the reports as they are.
+    template_field='levelFa' (--english-templates on both) fills the
+    analysis block the way a fixed level lookup would.
+    """
+    reported = 'SELECT session_id FROM result_reports'
+    if ReportStore(conn).enabled:
+        reported += ' UNION ALL SELECT session_id FROM compact_reports'
+    written = 0
+    for slug, ids in read_catalog(conn, definitions).items():
+        compiled = compile_test(definitions[slug])
+        test = {'id': ids.test_id, 'slug': slug, 'name': definitions[slug]['nameFa'],
+                'category': definitions[slug]['category']}
+        renderer = ReportRenderer(definitions[slug], compiled, ids.scale_ids, test, template_field=template_field)
+        after = 0
+        while True:
+            sessions = [r[0] for r in conn.execute(SESSION_PAGE, (ids.test_id, after, chunk))]
+            if not sessions:
+                break
+            rows = conn.execute(CHUNK_ANSWERS, (ids.test_id, after, sessions[-1])).fetchall()
+            after = sessions[-1]
+            data = np.array([(s, -1 if o is None else o, sc) for s, o, sc in rows], dtype=np.int64).reshape(-1, 3)
+            found, matrix, answered = answer_matrix(compiled, data[:, 0], data[:, 1], data[:, 2])
+            batch = score_matrix(compiled, matrix, answered)
+            finished = dict(conn.execute(
+                'SELECT id, finished_at FROM sessions WHERE id IN ({}) AND id NOT IN ({})'
+                .format(','.join('?' * len(found)), reported), found.tolist()))
+            out = [(int(s), renderer.render_json(batch, i, matrix[i], answered[i],
+                                                 completed_at=finished[s].replace(' ', 'T') + '.000Z'),
+                    finished[s]) for i, s in enumerate(found.tolist()) if s in finished]
+            conn.execute('BEGIN')
+            conn.executemany('INSERT INTO result_reports (session_id, report_json, created_at) VALUES (?, ?, ?)', out)
+            conn.execute('COMMIT')
+            written += len(out)
+    return written
+
+
+def report_stats(conn, sample=2000):
+    """Sizes per test and codec timings over a sample of compacted rows."""
+    store = ReportStore(conn)
+    plain = conn.execute('SELECT COUNT(*), COALESCE(SUM(length(CAST(report_json AS BLOB))), 0) FROM result_reports').fetchone()
+    print(f"result_reports   {plain[0]:>8d} rows  {plain[1] / 1e6:8.2f} MB")
+    if not store.enabled:
+        return
+    rows = conn.execute("""
+        SELECT t.slug, COUNT(*), SUM(c.raw_bytes), SUM(length(c.body)), SUM(c.codec = ?)
+        FROM compact_reports c JOIN sessions s ON s.id = c.session_id JOIN tests t ON t.id = s.test_id
+        GROUP BY t.slug ORDER BY t.slug
+    """, (RAW,)).fetchall()
+    total = np.array([r[1:] for r in rows], dtype=np.int64).sum(axis=0) if rows else np.zeros(4, dtype=np.int64)
+    print(f"compact_reports  {total[0]:>8d} rows  {total[1] / 1e6:8.2f} MB raw -> {total[2] / 1e6:6.2f} MB "
+          f"({total[1] / max(total[2], 1):.1f}x, {total[3]} raw-codec rows)")
+    for slug, n, raw, body, fallback in rows:
+        print(f"  {slug:14s} {n:>7d} rows  {raw / n:7.0f} -> {body / n:5.0f} bytes/report  ({raw / body:5.1f}x)")
+
+    bodies = conn.execute('SELECT dictionary_id, codec, body FROM compact_reports ORDER BY random() LIMIT ?',
+                          (sample,)).fetchall()
+    if not bodies:
+        return
+    start = time.perf_counter()
+    texts = [store.decode(*b) for b in bodies]
+    decode = time.perf_counter() - start
+    codec = store.codec()
+    start = time.perf_counter()
+    for text in texts:
+        codec.encode(text)
+    encode = time.perf_counter() - start
+    raw = sum(len(t.encode('utf-8')) for t in texts)
+    print(f"decode {len(texts) / decode:,.0f} reports/s ({raw / decode / 1e6:.1f} MB/s)  "
+          f"encode {len(texts) / encode:,.0f} reports/s ({raw / encode / 1e6:.1f} MB/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact cold result_reports rows')
+    sub = parser.add_subparsers(dest='command', required=True)
+    s = sub.add_parser('seed', help='render finish.ts reports for finished sessions that have none')
+    c = sub.add_parser('compact', help='move cold reports into compact_reports')
+    st = sub.add_parser('stats', help='sizes and codec throughput')
+    r = sub.add_parser('restore', help='move compacted reports back into result_reports')
+    for p in (s, c, st, r):
+        p.add_argument('db')
+    s.add_argument('slugs', nargs='*')
+    s.add_argument('--english-templates', action='store_true',
+                   help='match templates on the English label; rescore needs the same flag')
+    c.add_argument('--older-than', type=int, default=90, help='days before the newest finished session')
+    c.add_argument('--batch', type=int, default=2000)
+    c.add_argument('--retrain', action='store_true', help='train a new dictionary first')
+    c.add_argument('--incremental-vacuum', action='store_true',
+                   help='switch the database to auto_vacuum=INCREMENTAL (one full VACUUM)')
+    c.add_argument('--vacuum-pages', type=int, default=2000, help='free pages released after each batch')
+    c.add_argument('--vacuum-threshold', type=float, default=0.2,
+                   help='free share of the file that triggers a VACUUM at the end')
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    start = time.perf_counter()
+    if args.command == 'seed':
+        written = seed(conn, load_definitions(args.slugs or None),
+                       template_field='levelFa' if args.english_templates else 'level')
+        print(f"Wrote {written} reports in {time.perf_counter() - start:.2f}s")
+
+    elif args.command == 'compact':
+        if args.incremental_vacuum:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        size = file_bytes(args.db)
+        store = ReportStore(conn)
+        codec = None if args.retrain else store.codec()
+        if codec is None:
+            codec = train(conn)
+            if codec:
+                print(f"Trained dictionary {codec.id}: {len(codec.strings)} strings, {len(codec.zdict)} byte preset "
+                      f"in {time.perf_counter() - start:.2f}s")
+            else:
+                print("No reports in result_reports to train a dictionary on; nothing to compact")
+        stats = compact(conn, codec, args.older_than, args.batch, args.vacuum_pages,
+                        progress=lambda line: print(f"\r{line}", end='', flush=True)) if codec else {'reports': 0}
+        if stats['reports']:
+            print()
+            print(f"Compacted {stats['reports']} reports in {stats['seconds']:.2f}s "
+                  f"({stats['reports'] / stats['seconds']:,.0f}/s, encode {stats['raw_bytes'] / stats['encode_seconds'] / 1e6:.1f} MB/s): "
+                  f"{stats['raw_bytes'] / 1e6:.2f} MB -> {stats['compact_bytes'] / 1e6:.2f} MB "
+                  f"({stats['raw_bytes'] / stats['compact_bytes']:.1f}x, {stats['raw_codec']} raw-codec rows)")
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        share = vacuum(conn, args.vacuum_threshold)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        print(f"Database {size / 1e6:.1f} MB -> {file_bytes(args.db) / 1e6:.1f} MB "
+              f"(free pages were {share:.0%} of the file, vacuum threshold {args.vacuum_threshold:.0%})")
+
+    elif args.command == 'stats':
+        report_stats(conn)
+
+    elif args.command == 'restore':
+        print(f"Restored {restore(conn)} reports in {time.perf_counter() - start:.2f}s")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
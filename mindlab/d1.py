@@ -0,0 +1,142 @@
+"""Minimal D1-style wrapper around a sqlite3 connection.
+
+Mirrors the shape handlers use in apps/web/functions/api:
+`env.DB.prepare(sql).bind(...).first()` becomes `db.first(sql, ...)`,
+`.all()` returns the result rows and `.run()` returns the meta object.
+Every statement autocommits, as it does on D1. TracingD1 additionally
+counts statements and rows per handler and per statement fingerprint.
+"""
+import re
+import sqlite3
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Progress handler granularity when counting VM steps
+STEP_INTERVAL = 100
+
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_IN_LIST_RE = re.compile(r'IN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+
+
+@lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """SQL with whitespace collapsed, literals replaced by ? and IN lists folded to IN (?...)."""
+    text = _LITERAL_RE.sub('?', ' '.join(sql.split()))
+    return _IN_LIST_RE.sub('IN (?...)', text)
+
+
+@dataclass
+class Meta:
+    last_row_id: int
+    changes: int
+
+
+class LocalD1:
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.row_factory = sqlite3.Row
+
+    def execute(self, sql, params):
+        return self.conn.execute(sql, params)
+
+    def first(self, sql, *params):
+        row = self.execute(sql, params).fetchone()
+        return dict(row) if row is not None else None
+
+    def all(self, sql, *params):
+        return [dict(row) for row in self.execute(sql, params).fetchall()]
+
+    def run(self, sql, *params):
+        cursor = self.execute(sql, params)
+        return Meta(cursor.lastrowid, cursor.rowcount)
+
+    def batch(self, statements):
+        """Run [(sql, params), ...] in one transaction, like D1 batch()."""
+        self.conn.execute('BEGIN')
+        try:
+            metas = [self.run(sql, *params) for sql, params in statements]
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return metas
+
+
+@dataclass
+class Counters:
+    statements: int = 0
+    rows_returned: int = 0
+    rows_written: int = 0
+    seconds: float = 0.0
+    vm_steps: int = 0
+
+    def add(self, other):
+        self.statements += other.statements
+        self.rows_returned += other.rows_returned
+        self.rows_written += other.rows_written
+        self.seconds += other.seconds
+        self.vm_steps += other.vm_steps
+
+
+class TracingD1(LocalD1):
+    """LocalD1 that attributes statement and row counts to the current handler.
+
+    The sqlite3 module does not expose how many rows a statement scanned,
+    which is what D1 bills as rows read; rows returned to the handler is
+    reported instead, next to rows written (sqlite3 total_changes). With
+    count_steps=True, virtual machine steps (in units of STEP_INTERVAL)
+    are counted through a progress handler as a proxy for the rows a
+    statement visited.
+
+    `by_statement` holds the same counters keyed by (handler, fingerprint).
+    """
+
+    def __init__(self, conn, count_steps=False):
+        super().__init__(conn)
+        self.handler = None
+        self.by_handler = defaultdict(Counters)
+        self.by_statement = defaultdict(Counters)
+        self.steps = 0
+        if count_steps:
+            conn.set_progress_handler(self._step, STEP_INTERVAL)
+
+    def _step(self):
+        self.steps += 1
+        return 0
+
+    def execute(self, sql, params):
+        changes = self.conn.total_changes
+        steps = self.steps
+        start = time.perf_counter()
+        cursor = self.conn.execute(sql, params)
+        rows = cursor.fetchall()
+        elapsed = time.perf_counter() - start
+        written = self.conn.total_changes - changes
+        for counters in (self.by_handler[self.handler], self.by_statement[self.handler, fingerprint(sql)]):
+            counters.seconds += elapsed
+            counters.statements += 1
+            counters.rows_returned += len(rows)
+            counters.rows_written += written
+            counters.vm_steps += self.steps - steps
+        return _Fetched(rows, cursor)
+
+    def reset(self):
+        self.by_handler.clear()
+        self.by_statement.clear()
+
+
+class _Fetched:
+    """Cursor stand-in over already fetched rows."""
+
+    def __init__(self, rows, cursor):
+        self.rows = rows
+        self.lastrowid = cursor.lastrowid
+        self.rowcount = cursor.rowcount
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
@@ -0,0 +1,172 @@
+"""Local stand-in for the D1 HTTP query API, backed by SQLite.
+
+Answers POST /accounts/<account>/d1/database/<database>/query with either
+body form of the Cloudflare API
+
+    {"sql": "...", "params": [...]}                        one statement
+    {"batch": [{"sql": "...", "params": [...]}, ...]}      one transaction
+
+and the usual envelope
+
+    {"success": true, "errors": [], "messages": [],
+     "result": [{"success": true, "results": [...], "meta": {"last_row_id": ..., "changes": ...}}]}
+
+A failing statement rolls the whole batch back and returns HTTP 400 with
+success false. Like D1, a statement may bind at most 100 parameters and
+writes go through a single connection, one request at a time.
+
+--latency delays every request and --fail-rate answers that fraction of
+requests with a 503 before touching the database, so client concurrency
+and retries can be measured offline.
+
+Usage:
+    python -m mindlab.d1_server local.db [--port 8787] [--latency 20] [--fail-rate 0.05]
+"""
+import argparse
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mindlab.localdb import apply_migrations, connect
+
+QUERY_PATH = re.compile(r'^/(?:client/v4/)?accounts/[^/]+/d1/database/[^/]+/query$')
+MAX_PARAMS = 100
+
+
+class D1Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this Nagle holds the body for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        if not QUERY_PATH.match(self.path):
+            self.reply(404, envelope(error=f'no route for {self.path}'))
+            return
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fail_rate and server.rng.random() < server.fail_rate:
+            server.count('injected_failures')
+            self.reply(503, envelope(error='injected failure'))
+            return
+        try:
+            request = json.loads(body)
+            statements = request['batch'] if 'batch' in request else [request]
+        except (ValueError, KeyError, TypeError) as e:
+            self.reply(400, envelope(error=f'malformed request: {e}'))
+            return
+        try:
+            results = server.run(statements)
+        except (sqlite3.Error, ValueError) as e:
+            server.count('failed_batches')
+            self.reply(400, envelope(error=str(e)))
+            return
+        self.reply(200, envelope(results))
+
+
+def envelope(results=None, error=None):
+    if error is not None:
+        return {'success': False, 'errors': [{'code': 7500, 'message': error}], 'messages': [], 'result': []}
+    return {'success': True, 'errors': [], 'messages': [], 'result': results}
+
+
+class D1Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path, latency=0.0, fail_rate=0.0, seed=None):
+        super().__init__(address, D1Handler)
+        # Handler threads share the connection; self.lock serializes its use
+        self.conn = connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'statements': 0, 'injected_failures': 0, 'failed_batches': 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/accounts/local/d1/database/local/query'
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def run(self, statements):
+        """Run statements in one transaction; returns the per-statement results."""
+        out = []
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['statements'] += len(statements)
+            self.conn.execute('BEGIN')
+            try:
+                for statement in statements:
+                    params = statement.get('params') or []
+                    if len(params) > MAX_PARAMS:
+                        raise ValueError(f'too many SQL variables: {len(params)} > {MAX_PARAMS}')
+                    changes = self.conn.total_changes
+                    start = time.perf_counter()
+                    cursor = self.conn.execute(statement['sql'], params)
+                    rows = [dict(row) for row in cursor.fetchall()]
+                    out.append({'success': True, 'results': rows, 'meta': {
+                        'last_row_id': cursor.lastrowid,
+                        'changes': self.conn.total_changes - changes,
+                        'duration': (time.perf_counter() - start) * 1000,
+                        'rows_written': self.conn.total_changes - changes,
+                    }})
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return out
+
+
+def serve(path, host='127.0.0.1', port=0, latency=0.0, fail_rate=0.0, seed=None):
+    """Start a D1Server in a background thread; port 0 picks a free one."""
+    server = D1Server((host, port), path, latency, fail_rate, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a SQLite database through a D1-style HTTP query API')
+    parser.add_argument('path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8787)
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds added to every request')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--migrate', action='store_true', help='apply the migrations first')
+    args = parser.parse_args()
+
+    if args.migrate:
+        conn = connect(args.path)
+        apply_migrations(conn)
+        conn.close()
+    server = D1Server((args.host, args.port), args.path, args.latency / 1000, args.fail_rate)
+    print(f"Serving {args.path} at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(', '.join(f'{k} {v}' for k, v in server.stats.items()))
+
+
+if __name__ == '__main__':
+    main()
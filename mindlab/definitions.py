@@ -0,0 +1,45 @@
+import json
+import os
+import re
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.join(ROOT_DIR, 'apps', 'web', 'src', 'data', 'tests')
+MIGRATIONS_DIR = os.path.join(ROOT_DIR, 'migrations')
+
+# The four sections of a definition that maintenance scripts touch
+SECTIONS = ('questions', 'cutoffs', 'analysis_templates', 'risk_rules')
+
+
+def definition_path(slug):
+    return os.path.join(TESTS_DIR, f'{slug}.json')
+
+
+def load_definition(slug):
+    with open(definition_path(slug), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def definition_slugs():
+    """Slugs in the order of TEST_DEFINITIONS in data/tests/index.ts.
+
+    Sync inserts tests in that order, so ids in a freshly synced database
+    follow it too. Files that index.ts does not import are appended sorted.
+    """
+    with open(os.path.join(TESTS_DIR, 'index.ts'), 'r', encoding='utf-8') as f:
+        source = f.read()
+
+    imports = dict(re.findall(r"import (\w+) from '\./([\w-]+)\.json';", source))
+    listed = re.search(r'TEST_DEFINITIONS: TestDefinition\[\] = \[(.*?)\];', source, re.S)
+    slugs = []
+    if listed:
+        for var in re.findall(r'(\w+) as TestDefinition', listed.group(1)):
+            if var in imports and imports[var] not in slugs:
+                slugs.append(imports[var])
+
+    on_disk = sorted(name[:-5] for name in os.listdir(TESTS_DIR) if name.endswith('.json'))
+    return slugs + [slug for slug in on_disk if slug not in slugs]
+
+
+def load_definitions(slugs=None):
+    """Load definitions keyed by slug, in TEST_DEFINITIONS order."""
+    return {slug: load_definition(slug) for slug in (slugs or definition_slugs())}
@@ -0,0 +1,293 @@
+"""Statement-for-statement Python ports of the API handlers.
+
+Each function issues the same queries, in the same order, as the matching
+Pages Function and returns (status, body). They run against any object
+with the LocalD1 interface (mindlab/d1.py), which is what the local
+benchmarks and tracing tools replay.
+"""
+import json
+import re
+from datetime import datetime, timezone
+
+from mindlab import statements as sql
+
+DEFAULT_WARNING = 'این نتیجه جایگزین ارزیابی تخصصی توسط روان‌شناس یا روان‌پزشک نیست.'
+
+
+def _options_by_question(db, questions):
+    """Options of all questions in one IN query, grouped like start.ts and tests/[id].ts."""
+    question_ids = [q['id'] for q in questions]
+    by_question = {}
+    for opt in db.all(sql.start_options(len(question_ids)), *question_ids):
+        by_question.setdefault(opt['question_id'], []).append(
+            {'id': opt['id'], 'text': opt['text'], 'order_index': opt['order_index']})
+    return [{
+        'id': q['id'],
+        'text': q['text'],
+        'order_index': q['order_index'],
+        'options': by_question.get(q['id'], []),
+    } for q in questions]
+
+
+def start(db, uid, test_id):
+    """POST /api/sessions/start"""
+    if not uid:
+        return 401, {'error': 'Unauthorized'}
+    if not test_id:
+        return 400, {'error': 'testId is required'}
+
+    if not db.first(sql.START_TEST_EXISTS, test_id):
+        return 404, {'error': 'Test not found'}
+
+    existing_answers = {}
+    resumed = False
+    existing = db.first(sql.START_EXISTING_SESSION, test_id, uid)
+    if existing and existing['id']:
+        session_id = existing['id']
+        resumed = True
+        for answer in db.all(sql.START_EXISTING_ANSWERS, session_id):
+            existing_answers[str(answer['question_id'])] = answer['option_id']
+    else:
+        session_id = db.run(sql.START_INSERT_SESSION, test_id, uid).last_row_id
+
+    questions = db.all(sql.START_QUESTIONS, test_id)
+    questions_with_options = _options_by_question(db, questions) if questions else []
+
+    return (200 if resumed else 201), {
+        'sessionId': session_id,
+        'questions': questions_with_options,
+        'existingAnswers': existing_answers,
+        'resumed': resumed,
+    }
+
+
+def answer(db, uid, session_id, question_id, option_id):
+    """POST /api/sessions/answer"""
+    if not uid:
+        return 401, {'error': 'Unauthorized'}
+    if not session_id or not question_id or not option_id:
+        return 400, {'error': 'sessionId, questionId, and optionId are required'}
+
+    session = db.first(sql.ANSWER_SESSION, session_id, uid)
+    if not session:
+        return 404, {'error': 'Session not found'}
+    if session['finished_at']:
+        return 400, {'error': 'Session already finished'}
+
+    option = db.first(sql.ANSWER_OPTION, option_id, question_id)
+    if not option:
+        return 400, {'error': 'Invalid option for question'}
+
+    db.run(sql.ANSWER_UPSERT, session_id, question_id, option_id, option['score'])
+    return 200, {'success': True}
+
+
+RISK_RE = re.compile(r'q(\d+)_score\s*(>=|>|<=|<|==|=)\s*(\d+)', re.I)
+
+
+def evaluate_risk_condition(condition, answers):
+    """Port of evaluateRiskCondition, including its regex-only matching."""
+    match = RISK_RE.search(condition)
+    if not match:
+        return False
+    order, op, threshold = int(match.group(1)), match.group(2), int(match.group(3))
+    answer_row = next((a for a in answers if a['order_index'] == order), None)
+    if answer_row is None:
+        return False
+    score = answer_row['score']
+    return {
+        '>=': score >= threshold, '>': score > threshold,
+        '<=': score <= threshold, '<': score < threshold,
+        '==': score == threshold, '=': score == threshold,
+    }[op]
+
+
+def iso_now():
+    """new Date().toISOString()"""
+    now = datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%dT%H:%M:%S.') + f'{now.microsecond // 1000:03d}Z'
+
+
+def to_json(value):
+    """JSON.stringify(value)"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def finish(db, uid, session_id):
+    """POST /api/sessions/finish"""
+    if not uid:
+        return 401, {'error': 'Unauthorized'}
+    if not session_id:
+        return 400, {'error': 'sessionId is required'}
+
+    session = db.first(sql.FINISH_SESSION, session_id, uid)
+    if not session:
+        return 404, {'error': 'Session not found'}
+    if session['finished_at']:
+        return 400, {'error': 'Session already finished'}
+
+    scales = db.all(sql.FINISH_SCALES, session['test_id'])
+    answers = db.all(sql.FINISH_ANSWERS, session_id)
+    total_score = sum(a['score'] or 0 for a in answers)
+
+    scale_results = []
+    for scale in scales:
+        row = db.first(sql.FINISH_SCALE_SCORE, session_id, scale['id'])
+        scale_score = (row and row['total_score']) or 0
+        cutoff = db.first(sql.FINISH_CUTOFF, scale['id'], scale_score, scale_score)
+        level = (cutoff and cutoff['label']) or 'Unknown'
+        level_fa = (cutoff and cutoff['description']) or level
+        db.run(sql.FINISH_INSERT_RESULT, session_id, scale['id'], scale_score, f'{level}: {level_fa}')
+        scale_results.append({
+            'scale_id': scale['id'],
+            'scale_name': scale['name'],
+            'score': scale_score,
+            'level': level,
+            'levelFa': level_fa,
+        })
+
+    highlights = []
+    overall = None
+    for sr in scale_results:
+        template = db.first(sql.FINISH_TEMPLATE, session['test_id'], sr['scale_id'], sr['level'])
+        if template:
+            if len(scale_results) == 1:
+                overall = template
+            else:
+                highlights.append({
+                    'title': f"{sr['scale_name']}: {template['title']}",
+                    'summary': template['summary'],
+                    'details': template['details'],
+                    'recommendations': template['recommendations'],
+                })
+
+    if not overall and not highlights and scale_results:
+        template = db.first(sql.FINISH_OVERALL_TEMPLATE, session['test_id'], scale_results[0]['level'])
+        if template:
+            overall = template
+
+    risk_flags = [{'message': rule['message'], 'severity': rule['severity']}
+                  for rule in db.all(sql.FINISH_RISK_RULES, session['test_id'])
+                  if evaluate_risk_condition(rule['condition_expr'], answers)]
+
+    report = {
+        'test': {
+            'id': session['test_id'],
+            'slug': session['test_slug'],
+            'name': session['test_name'],
+            'category': session['test_category'],
+        },
+        'scores': {'total': total_score, 'scales': scale_results},
+        'analysis': {'overall': overall, 'highlights': highlights},
+        'riskFlags': risk_flags,
+        'disclaimer': session['warning'] or DEFAULT_WARNING,
+        'completedAt': iso_now(),
+    }
+
+    db.run(sql.FINISH_SAVE_REPORT, session_id, to_json(report))
+    db.run(sql.FINISH_MARK_FINISHED, session_id)
+
+    return 200, {
+        'success': True,
+        'totalScore': total_score,
+        'results': [{
+            'scaleName': sr['scale_name'],
+            'score': sr['score'],
+            'interpretation': f"{sr['level']}: {sr['levelFa']}",
+        } for sr in scale_results],
+        'report': report,
+    }
+
+
+def list_tests(db):
+    """GET /api/tests"""
+    return 200, {'tests': db.all(sql.TESTS_LIST)}
+
+
+def get_test(db, test_id):
+    """GET /api/tests/:id"""
+    if not test_id:
+        return 400, {'error': 'Test ID is required'}
+    test = db.first(sql.TEST_DETAIL, test_id)
+    if not test:
+        return 404, {'error': 'Test not found'}
+    questions = db.all(sql.TEST_DETAIL_QUESTIONS, test_id)
+    return 200, {'test': {**test, 'questions': _options_by_question(db, questions) if questions else []}}
+
+
+def my_sessions(db, uid):
+    """GET /api/me/sessions"""
+    if not uid:
+        return 401, {'error': 'Unauthorized'}
+    return 200, {'sessions': db.all(sql.ME_SESSIONS, uid)}
+
+
+def my_session(db, uid, session_id):
+    """GET /api/me/sessions/:id"""
+    if not uid:
+        return 401, {'error': 'Unauthorized'}
+    if not session_id:
+        return 400, {'error': 'Session ID is required'}
+
+    session = db.first(sql.ME_SESSION, session_id, uid)
+    if not session:
+        return 404, {'error': 'Session not found'}
+    scale_results = db.all(sql.ME_SESSION_RESULTS, session_id)
+    total = db.first(sql.ME_SESSION_TOTAL, session_id)
+    answers = db.all(sql.ME_SESSION_ANSWERS, session_id)
+    report = db.first(sql.ME_SESSION_REPORT, session_id)
+    report_json = None
+    if report and report['report_json']:
+        try:
+            report_json = json.loads(report['report_json'])
+        except ValueError:
+            report_json = report['report_json']
+    return 200, {'session': {
+        **session,
+        'totalScore': (total and total['total']) or 0,
+        'results': scale_results,
+        'answers': answers,
+        'report_json': report_json,
+    }}
+
+
+def export(db, is_admin=True):
+    """GET /api/admin/export"""
+    if not is_admin:
+        return 403, {'error': 'Forbidden'}
+
+    tests = []
+    for test in db.all(sql.EXPORT_TESTS):
+        scales = []
+        scale_names = {}
+        for scale in db.all(sql.EXPORT_SCALES, test['id']):
+            scale_names[scale['id']] = scale['name']
+            cutoffs = db.all(sql.EXPORT_CUTOFFS, scale['id'])
+            scales.append({
+                'name': scale['name'],
+                'description': scale['description'],
+                'cutoffs': [{'minScore': c['min_score'], 'maxScore': c['max_score'],
+                             'label': c['label'], 'description': c['description']} for c in cutoffs],
+            })
+
+        questions = []
+        for question in db.all(sql.EXPORT_QUESTIONS, test['id']):
+            options = db.all(sql.EXPORT_OPTIONS, question['id'])
+            mapped = [scale_names[m['scale_id']] for m in db.all(sql.EXPORT_SCALE_MAPPINGS, question['id'])
+                      if scale_names.get(m['scale_id'])]
+            entry = {'text': question['text'], 'orderIndex': question['order_index']}
+            if mapped:
+                entry['scaleNames'] = mapped
+            entry['options'] = [{'text': o['text'], 'score': o['score'], 'orderIndex': o['order_index']}
+                                for o in options]
+            questions.append(entry)
+
+        tests.append({
+            'name': test['name'],
+            'description': test['description'],
+            'category': test['category'],
+            'warning': test['warning'],
+            'scales': scales,
+            'questions': questions,
+        })
+    return 200, {'exportedAt': iso_now(), 'tests': tests}
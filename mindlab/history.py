@@ -0,0 +1,292 @@
+"""Materialized per-user score history with incremental refresh.
+
+me/sessions.ts and me/sessions/[id].ts join sessions, tests, results and
+reports on every page view, so a trend over repeated takes of a test
+costs one report fetch per session. This job maintains, in the local
+database:
+
+    user_test_history   one row per (user, test, finished session, scale):
+                        score, level, the previous take's score and level,
+                        whether the level changed and the reliable change
+                        index against the previous take
+    user_test_summary   one row per (user, test): takes, first/last finish
+    scale_norms         running count, sum and sum of squares per scale
+    history_watermark   (finished_at, session_id) of the last session folded in
+
+The history primary key is (user_uid, test_id, finished_at, session_id,
+scale_id), so a user's trend for a test is one range read of the
+clustered WITHOUT ROWID index, already in time order.
+
+Each refresh reads only sessions finished after the watermark, in
+(finished_at, id) order, joins them with the latest stored take of the
+same user and test, and appends. The reliable change index follows
+Jacobson & Truax: RCI = (x2 - x1) / (SD * sqrt(2 * (1 - r))), with SD the
+population SD of the scale's stored scores and r the scale's
+"reliability" in the JSON, DEFAULT_RELIABILITY without one; |RCI| >= 1.96
+is flagged with the sign of the change. Sessions that finish with a
+timestamp older than the watermark are not picked up; --full rebuilds.
+
+Usage:
+    python -m mindlab.history local.db [--full] [--user UID --test SLUG]
+"""
+import argparse
+import math
+import time
+
+from mindlab.definitions import load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.scoring import UNKNOWN_LEVEL
+
+DEFAULT_RELIABILITY = 0.8
+RCI_THRESHOLD = 1.96
+
+TABLES = """
+CREATE TABLE IF NOT EXISTS user_test_history (
+    user_uid TEXT NOT NULL,
+    test_id INTEGER NOT NULL,
+    finished_at TEXT NOT NULL,
+    session_id INTEGER NOT NULL,
+    scale_id INTEGER NOT NULL,
+    score REAL NOT NULL,
+    level TEXT,
+    level_fa TEXT,
+    previous_score REAL,
+    previous_level TEXT,
+    level_changed INTEGER NOT NULL DEFAULT 0,
+    rci REAL,
+    reliable_change INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_uid, test_id, finished_at, session_id, scale_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS user_test_summary (
+    user_uid TEXT NOT NULL,
+    test_id INTEGER NOT NULL,
+    takes INTEGER NOT NULL,
+    first_finished_at TEXT NOT NULL,
+    last_finished_at TEXT NOT NULL,
+    last_session_id INTEGER NOT NULL,
+    PRIMARY KEY (user_uid, test_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS scale_norms (
+    scale_id INTEGER PRIMARY KEY,
+    n INTEGER NOT NULL,
+    total REAL NOT NULL,
+    total_sq REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS history_watermark (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    finished_at TEXT NOT NULL,
+    session_id INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_sessions_finished ON sessions(finished_at, id);
+"""
+
+# The cutoff is looked up like FINISH_CUTOFF: after the sync column swap
+# cutoffs.label holds labelFa and cutoffs.description the English label
+NEW_RESULTS = """
+SELECT s.user_uid, s.test_id, s.finished_at, s.id, r.scale_id, r.score, c.description, c.label
+FROM sessions s
+JOIN results r ON r.session_id = s.id
+LEFT JOIN cutoffs c ON c.id = (
+    SELECT id FROM cutoffs WHERE scale_id = r.scale_id AND min_score <= r.score AND max_score >= r.score LIMIT 1
+)
+WHERE s.finished_at IS NOT NULL AND (s.finished_at > ? OR (s.finished_at = ? AND s.id > ?))
+ORDER BY s.finished_at, s.id, r.scale_id
+"""
+
+# Latest stored take of every (user, test) that has new sessions
+LATEST = """
+SELECT h.user_uid, h.test_id, h.scale_id, h.score, h.level
+FROM temp.history_pairs p
+JOIN user_test_summary u ON u.user_uid = p.user_uid AND u.test_id = p.test_id
+JOIN user_test_history h ON h.user_uid = u.user_uid AND h.test_id = u.test_id
+     AND h.finished_at = u.last_finished_at AND h.session_id = u.last_session_id
+"""
+
+INSERT_HISTORY = 'INSERT OR REPLACE INTO user_test_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+UPSERT_SUMMARY = """
+INSERT INTO user_test_summary (user_uid, test_id, takes, first_finished_at, last_finished_at, last_session_id)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_uid, test_id) DO UPDATE SET
+    takes = takes + excluded.takes,
+    last_finished_at = excluded.last_finished_at,
+    last_session_id = excluded.last_session_id
+"""
+
+UPSERT_NORMS = """
+INSERT INTO scale_norms (scale_id, n, total, total_sq) VALUES (?, ?, ?, ?)
+ON CONFLICT(scale_id) DO UPDATE SET
+    n = n + excluded.n, total = total + excluded.total, total_sq = total_sq + excluded.total_sq
+"""
+
+SAVE_WATERMARK = """
+INSERT INTO history_watermark (id, finished_at, session_id) VALUES (1, ?, ?)
+ON CONFLICT(id) DO UPDATE SET finished_at = excluded.finished_at, session_id = excluded.session_id
+"""
+
+USER_HISTORY = """
+SELECT finished_at, session_id, scale_id, score, level, level_fa, previous_score, previous_level,
+       level_changed, rci, reliable_change
+FROM user_test_history
+WHERE user_uid = ? AND test_id = ?
+ORDER BY finished_at, session_id, scale_id
+"""
+
+
+def cutoff_level(english, persian):
+    """(level, level_fa) of the cutoff a score falls in, with finish.ts's 'Unknown' fallback.
+
+    results.interpretation (`${label}: ${description}`) is not split back:
+    a label may itself contain ': '.
+    """
+    persian = persian or UNKNOWN_LEVEL
+    return english or persian, persian
+
+
+def reliabilities(conn, definitions=None):
+    """{scale_id: reliability} from the JSON definitions of the synced tests."""
+    definitions = definitions or load_definitions()
+    out = {}
+    for slug, ids in read_catalog(conn, definitions).items():
+        for scale, scale_id in zip(definitions[slug]['scales'], ids.scale_ids):
+            if scale_id is not None:
+                out[scale_id] = float(scale.get('reliability', DEFAULT_RELIABILITY))
+    return out
+
+
+def create_tables(conn):
+    conn.executescript(TABLES)
+
+
+def watermark(conn):
+    row = conn.execute('SELECT finished_at, session_id FROM history_watermark WHERE id = 1').fetchone()
+    return row or ('', 0)
+
+
+def scale_sd(norms, scale_id):
+    n, total, total_sq = norms.get(scale_id, (0, 0.0, 0.0))
+    if n < 2:
+        return 0.0
+    variance = (total_sq - total * total / n) / (n - 1)
+    return math.sqrt(max(variance, 0.0))
+
+
+def refresh(conn, definitions=None, full=False):
+    """Fold sessions finished since the watermark into the history tables.
+
+    Returns {'sessions', 'rows', 'level_changes', 'reliable_changes'} for
+    the new sessions.
+    """
+    create_tables(conn)
+    conn.execute('BEGIN')
+    try:
+        if full:
+            for table in ('user_test_history', 'user_test_summary', 'scale_norms', 'history_watermark'):
+                conn.execute(f'DELETE FROM {table}')
+        finished_at, session_id = watermark(conn)
+        rows = conn.execute(NEW_RESULTS, (finished_at, finished_at, session_id)).fetchall()
+        stats = {'sessions': 0, 'rows': len(rows), 'level_changes': 0, 'reliable_changes': 0}
+        if not rows:
+            conn.execute('COMMIT')
+            return stats
+
+        # Norms include the new scores, so a first refresh flags against the
+        # whole population rather than the sessions seen so far
+        added = {}
+        for row in rows:
+            n, total, total_sq = added.get(row[4], (0, 0.0, 0.0))
+            added[row[4]] = (n + 1, total + row[5], total_sq + row[5] * row[5])
+        conn.executemany(UPSERT_NORMS, [(k, *v) for k, v in added.items()])
+        norms = {k: (n, total, total_sq) for k, n, total, total_sq in conn.execute('SELECT * FROM scale_norms')}
+        sd = {k: scale_sd(norms, k) for k in norms}
+        reliability = reliabilities(conn, definitions)
+
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS history_pairs (user_uid TEXT, test_id INTEGER, '
+                     'PRIMARY KEY (user_uid, test_id)) WITHOUT ROWID')
+        conn.execute('DELETE FROM temp.history_pairs')
+        conn.executemany('INSERT OR IGNORE INTO temp.history_pairs VALUES (?, ?)', ((r[0], r[1]) for r in rows))
+        latest = {(u, t, scale): (score, level) for u, t, scale, score, level in conn.execute(LATEST)}
+
+        history, summary = [], {}
+        last_session = None
+        for user_uid, test_id, finished, sid, scale_id, score, english, persian in rows:
+            level, level_fa = cutoff_level(english, persian)
+            previous = latest.get((user_uid, test_id, scale_id))
+            level_changed, rci, reliable = 0, None, 0
+            if previous:
+                previous_score, previous_level = previous
+                level_changed = int(level != previous_level)
+                r = reliability.get(scale_id, DEFAULT_RELIABILITY)
+                s_diff = sd.get(scale_id, 0.0) * math.sqrt(2 * (1 - r))
+                if s_diff > 0:
+                    rci = (score - previous_score) / s_diff
+                    if abs(rci) >= RCI_THRESHOLD:
+                        reliable = 1 if rci > 0 else -1
+            else:
+                previous_score = previous_level = None
+            history.append((user_uid, test_id, finished, sid, scale_id, score, level, level_fa,
+                            previous_score, previous_level, level_changed, rci, reliable))
+            latest[user_uid, test_id, scale_id] = (score, level)
+            stats['level_changes'] += level_changed
+            stats['reliable_changes'] += reliable != 0
+
+            if sid != last_session:
+                last_session = sid
+                stats['sessions'] += 1
+                takes, first = summary.get((user_uid, test_id), (0, finished))[:2]
+                summary[user_uid, test_id] = (takes + 1, first, finished, sid)
+
+        conn.executemany(INSERT_HISTORY, history)
+        conn.executemany(UPSERT_SUMMARY, [(u, t, *v) for (u, t), v in summary.items()])
+        conn.execute(SAVE_WATERMARK, rows[-1][2:4])
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return stats
+
+
+def user_history(conn, user_uid, test_id):
+    """The trend rows of one user and test, oldest first."""
+    return conn.execute(USER_HISTORY, (user_uid, test_id)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Refresh the per-user history tables of a local database')
+    parser.add_argument('path')
+    parser.add_argument('--full', action='store_true', help='rebuild from scratch instead of from the watermark')
+    parser.add_argument('--user', help='print the history of this user_uid after refreshing')
+    parser.add_argument('--test', help='slug of the test for --user')
+    args = parser.parse_args()
+
+    conn = connect(args.path)
+    start = time.perf_counter()
+    stats = refresh(conn, full=args.full)
+    elapsed = time.perf_counter() - start
+    print(f"Folded in {stats['sessions']} sessions ({stats['rows']} scale rows) in {elapsed:.2f}s: "
+          f"{stats['level_changes']} level changes, {stats['reliable_changes']} reliable changes")
+    print(f"Watermark: {' / '.join(str(v) for v in watermark(conn))}")
+
+    if args.user:
+        row = conn.execute('SELECT id FROM tests WHERE slug = ?', (args.test,)).fetchone()
+        if not row:
+            parser.error(f'unknown test {args.test!r}')
+        scales = dict(conn.execute('SELECT id, name FROM scales WHERE test_id = ?', (row[0],)))
+        start = time.perf_counter()
+        rows = user_history(conn, args.user, row[0])
+        print(f"\n{len(rows)} rows in {(time.perf_counter() - start) * 1000:.2f} ms")
+        for finished, sid, scale_id, score, level, _, prev, _, changed, rci, reliable in rows:
+            delta = '' if prev is None else f"{score - prev:+g}"
+            flags = ('level changed ' if changed else '') + ({1: 'reliable increase', -1: 'reliable decrease'}.get(reliable, ''))
+            rci_text = f'{rci:+.2f}' if rci is not None else ''
+            print(f"{finished}  #{sid:<7d} {scales.get(scale_id, scale_id)!s:24.24s} {score:>6g} {delta:>5s} "
+                  f"{rci_text:>6s}  {level or ''}  {flags}")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+"""Write-coalescing answer ingestion with durable acknowledgements.
+
+sessions/answer.ts runs three statements per click: the session lookup,
+the option lookup and a one-row upsert, each its own D1 write
+transaction. A 90-item SCL-90-R session costs 270 statements and 90
+commits, and at peak the commits queue up behind each other. This
+service accepts the same answer events on asyncio and keeps the per-click
+reads in memory:
+
+    option index    option id -> (question id, score), built once from
+                    the test JSONs and the synced catalog ids
+    session cache   session id -> (user_uid, finished), read with answer.ts's
+                    query once per session and kept in an LRU
+
+A validated event goes into its session's buffer. A second answer to the
+same question replaces the first, and both callers are acked with the
+write. The buffers are flushed as one executemany of answer.ts's upsert
+in one transaction when --max-batch events are pending or the oldest has
+waited --max-delay ms. A single writer runs flushes in a thread, so
+events keep arriving during a commit and join the next group.
+
+An event's future resolves only after its transaction committed on a
+WAL connection with synchronous=FULL, so an ack means the answer is on
+disk. Rejections use answer.ts's status codes and messages, without
+touching the database. Over --port every event line gets a reply: 400
+for lines that are not a JSON object, and answer.ts's 500 with the
+event id when the write fails. finish must call flush_session() first, so its
+scoring sees every acked answer, then mark_finished().
+
+Metrics: flush latency, rows per flush and event-to-ack latency, as
+p50/p95/p99.
+
+--bench replays concurrent sessions through handlers.answer, one
+statement sequence per click, and through this service on two copies of
+a database. It compares the throughput and checks that the resulting
+answers tables match.
+
+Usage:
+    python -m mindlab.ingest local.db --bench [--sessions 200] [--max-batch 512] [--max-delay 5]
+    python -m mindlab.ingest local.db --port 8788    # NDJSON over TCP, one ack line per event
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from mindlab import handlers
+from mindlab import statements as sql
+from mindlab.bench_lifecycle import percentiles
+from mindlab.d1 import LocalD1
+from mindlab.definitions import load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.reports import LRUCache
+
+
+class Rejected(Exception):
+    def __init__(self, status, error):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+
+def option_index(conn, definitions=None):
+    """{option id: (question id, score)} from the JSON scores and the synced ids.
+
+    Options of tests without a JSON definition (the seeded ones) keep
+    their stored score.
+    """
+    definitions = definitions or load_definitions()
+    index = {}
+    for slug, ids in read_catalog(conn, definitions).items():
+        for q, question_id, option_ids in zip(definitions[slug]['questions'], ids.question_ids, ids.option_ids):
+            for o, option_id in zip(q['options'], option_ids):
+                index[option_id] = (question_id, o['score'])
+    for option_id, question_id, score in conn.execute('SELECT id, question_id, score FROM options'):
+        index.setdefault(option_id, (question_id, score))
+    return index
+
+
+class Metrics:
+    def __init__(self):
+        self.flush_seconds = []
+        self.batch_rows = []
+        self.ack_seconds = []
+        self.accepted = self.rejected = self.coalesced = 0
+
+    def summary(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'coalesced': self.coalesced,
+            'flushes': len(self.batch_rows),
+            'rows_per_flush': {'mean': float(np.mean(self.batch_rows)) if self.batch_rows else 0.0,
+                               'max': max(self.batch_rows, default=0)},
+            'flush_ms': percentiles(self.flush_seconds),
+            'ack_ms': percentiles(self.ack_seconds),
+        }
+
+
+class AnswerIngest:
+    """Validates answer events in memory and writes them in grouped transactions."""
+
+    def __init__(self, path, options, max_batch=512, max_delay=0.005, session_cache=65536):
+        self.conn = connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous = FULL')
+        self.options = options
+        self.sessions = LRUCache(session_cache)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        # {session id: {question id: [option id, score, futures, received]}}
+        self.buffers = {}
+        self.pending = 0
+        self.oldest = None
+        # Sessions of the flush being written
+        self.writing = set()
+        self.wakeup = asyncio.Event()
+        self.flushed = asyncio.Event()
+        self.metrics = Metrics()
+        self.writer = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._run())
+        return self
+
+    async def close(self):
+        while self.pending or self.writing:
+            self.wakeup.set()
+            await self._wait_flush()
+        self.writer.cancel()
+        self.conn.close()
+
+    def _read_session(self, session_id):
+        row = self.conn.execute('SELECT user_uid, finished_at FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        return None if row is None else [row[0], row[1] is not None]
+
+    def validate(self, uid, session_id, question_id, option_id):
+        """The option's score, or Rejected with answer.ts's status and message."""
+        if not uid:
+            raise Rejected(401, 'Unauthorized')
+        if not session_id or not question_id or not option_id:
+            raise Rejected(400, 'sessionId, questionId, and optionId are required')
+        if not all(isinstance(v, (int, str)) for v in (session_id, question_id, option_id)):
+            raise Rejected(400, 'sessionId, questionId, and optionId must be ids')
+        session = self.sessions.get(session_id, lambda: self._read_session(session_id))
+        if session is None:
+            # Not cached: the session may be created right after
+            self.sessions.data.pop(session_id, None)
+            raise Rejected(404, 'Session not found')
+        if session[0] != uid:
+            raise Rejected(404, 'Session not found')
+        if session[1]:
+            raise Rejected(400, 'Session already finished')
+        option = self.options.get(option_id)
+        if option is None or option[0] != question_id:
+            raise Rejected(400, 'Invalid option for question')
+        return option[1]
+
+    async def answer(self, uid, session_id, question_id, option_id):
+        """Resolve once the answer is committed; raises Rejected on invalid input."""
+        received = time.perf_counter()
+        try:
+            score = self.validate(uid, session_id, question_id, option_id)
+        except Rejected:
+            self.metrics.rejected += 1
+            raise
+        self.metrics.accepted += 1
+        future = asyncio.get_running_loop().create_future()
+        buffer = self.buffers.setdefault(session_id, {})
+        entry = buffer.get(question_id)
+        if entry is None:
+            buffer[question_id] = [option_id, score, [future], received]
+            self.pending += 1
+            if self.oldest is None:
+                self.oldest = received
+        else:
+            self.metrics.coalesced += 1
+            entry[0], entry[1] = option_id, score
+            entry[2].append(future)
+        if self.pending == 1 or self.pending >= self.max_batch:
+            self.wakeup.set()
+        # A cancelled caller must not cancel the future the writer resolves;
+        # the answer is still written
+        await asyncio.shield(future)
+        self.metrics.ack_seconds.append(time.perf_counter() - received)
+
+    async def flush_session(self, session_id):
+        """Wait until every buffered answer of the session is committed."""
+        while session_id in self.buffers or session_id in self.writing:
+            self.wakeup.set()
+            await self._wait_flush()
+
+    def mark_finished(self, session_id):
+        session = self.sessions.data.get(session_id)
+        if session is not None:
+            session[1] = True
+
+    async def _wait_flush(self):
+        self.flushed.clear()
+        await self.flushed.wait()
+
+    async def _run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.pending:
+                continue
+            if self.pending < self.max_batch:
+                delay = self.oldest + self.max_delay - time.perf_counter()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._until_full(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            try:
+                await self._flush()
+            finally:
+                self.writing = set()
+                self.flushed.set()
+            if self.pending:
+                self.wakeup.set()
+
+    async def _flush(self):
+        """Write every buffered answer in one transaction and settle its futures.
+
+        A failed write rejects the futures of that group only; the writer
+        keeps running for the next one.
+        """
+        buffers, self.buffers = self.buffers, {}
+        self.pending, self.oldest = 0, None
+        self.writing = set(buffers)
+        rows, futures = [], []
+        for session_id, answers in buffers.items():
+            for question_id, (option_id, score, waiting, _) in answers.items():
+                rows.append((session_id, question_id, option_id, score))
+                futures.extend(waiting)
+        start = time.perf_counter()
+        error = None
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, rows)
+        except Exception as e:
+            error = e
+        for future in futures:
+            # The caller may have given up; nobody is left to resolve
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        self.metrics.flush_seconds.append(time.perf_counter() - start)
+        self.metrics.batch_rows.append(len(rows))
+
+    async def _until_full(self):
+        while self.pending < self.max_batch:
+            self.wakeup.clear()
+            await self.wakeup.wait()
+
+    def _write(self, rows):
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(sql.ANSWER_UPSERT, rows)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+
+async def serve(service, port):
+    """NDJSON over TCP: {"uid", "sessionId", "questionId", "optionId"} in, {"status", ...} out per line."""
+
+    async def client(reader, writer):
+        lock = asyncio.Lock()
+
+        async def handle(line):
+            event = None
+            try:
+                event = json.loads(line)
+                if not isinstance(event, dict):
+                    raise Rejected(400, 'invalid event')
+                await service.answer(event.get('uid'), event.get('sessionId'), event.get('questionId'),
+                                     event.get('optionId'))
+                reply = {'status': 200, 'success': True}
+            except Rejected as e:
+                reply = {'status': e.status, 'error': e.error}
+            except ValueError:
+                reply = {'status': 400, 'error': 'invalid JSON'}
+            except Exception as e:
+                # A failed flush, or a bug: the client still gets its ack line
+                print(f"Error recording answer: {e!r}")
+                reply = {'status': 500, 'error': 'Failed to record answer'}
+            if isinstance(event, dict) and 'id' in event:
+                reply['id'] = event['id']
+            async with lock:
+                writer.write((json.dumps(reply) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        tasks = set()
+        while line := await reader.readline():
+            task = asyncio.create_task(handle(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        writer.close()
+
+    server = await asyncio.start_server(client, '127.0.0.1', port)
+    print(f"Ingesting answers on 127.0.0.1:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def bench_sessions(conn, n_sessions, seed=0):
+    """Start n sessions on random tests; [(uid, session id, [(question id, option id), ...])]."""
+    db = LocalD1(conn)
+    rng = random.Random(seed)
+    test_ids = [r[0] for r in conn.execute('SELECT id FROM tests ORDER BY id')]
+    out = []
+    for i in range(n_sessions):
+        uid = f'ingest-{i:06d}'
+        _, body = handlers.start(db, uid, rng.choice(test_ids))
+        options = {q['id']: q['options'] for q in body['questions'] if q['options']}
+        clicks = [(q, rng.choice(o)['id']) for q, o in options.items()]
+        # A few changed answers, like a user going back
+        clicks += [(q, rng.choice(options[q])['id']) for q, _ in rng.sample(clicks, min(3, len(clicks)))]
+        out.append((uid, body['sessionId'], clicks))
+    return out
+
+
+def run_bench(path, n_sessions, max_batch, max_delay):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path, ingest_path = os.path.join(tmp, 'legacy.db'), os.path.join(tmp, 'ingest.db')
+        conn = connect(path)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+        shutil.copy(path, legacy_path)
+        conn = connect(legacy_path)
+        sessions = bench_sessions(conn, n_sessions)
+        conn.close()
+        shutil.copy(legacy_path, ingest_path)
+        events = sum(len(clicks) for _, _, clicks in sessions)
+
+        # answer.ts: three statements and one commit per click, sessions interleaved round-robin
+        conn = connect(legacy_path)
+        conn.execute('PRAGMA synchronous = FULL')
+        db = LocalD1(conn)
+        queue = [(uid, sid, *clicks[k]) for k in range(max(len(s[2]) for s in sessions))
+                 for uid, sid, clicks in sessions if k < len(clicks)]
+        start = time.perf_counter()
+        for click in queue:
+            status, body = handlers.answer(db, *click)
+            if status >= 400:
+                raise RuntimeError(body)
+        legacy_seconds = time.perf_counter() - start
+        conn.close()
+
+        options = option_index(connect(ingest_path))
+
+        async def clients():
+            service = AnswerIngest(ingest_path, options, max_batch, max_delay).start()
+
+            async def session(uid, sid, clicks):
+                for q, o in clicks:
+                    await service.answer(uid, sid, q, o)
+
+            t = time.perf_counter()
+            await asyncio.gather(*(session(*s) for s in sessions))
+            elapsed = time.perf_counter() - t
+            await service.close()
+            return elapsed, service.metrics
+
+        ingest_seconds, metrics = asyncio.run(clients())
+
+        query = 'SELECT session_id, question_id, option_id, score FROM answers WHERE session_id >= ? ORDER BY 1, 2'
+        first = min(s[1] for s in sessions)
+        tables = [connect(p).execute(query, (first,)).fetchall() for p in (legacy_path, ingest_path)]
+
+    summary = metrics.summary()
+    print(f"{n_sessions} concurrent sessions, {events} answer events")
+    print(f"  answer.ts port: {3 * events} statements, {events} commits, {legacy_seconds:.2f}s "
+          f"({events / legacy_seconds:,.0f} events/s)")
+    print(f"  ingest:         {len({s[1] for s in sessions})} session reads, {summary['flushes']} commits, "
+          f"{ingest_seconds:.2f}s ({events / ingest_seconds:,.0f} events/s)")
+    print(f"  rows/flush mean {summary['rows_per_flush']['mean']:.1f} max {summary['rows_per_flush']['max']}, "
+          f"flush ms p50 {summary['flush_ms']['p50']} p95 {summary['flush_ms']['p95']}, "
+          f"ack ms p50 {summary['ack_ms']['p50']} p95 {summary['ack_ms']['p95']} p99 {summary['ack_ms']['p99']}")
+    print(f"  coalesced {summary['coalesced']}; answers tables {'identical' if tables[0] == tables[1] else 'DIFFERENT'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Coalescing answer ingestion into WAL SQLite')
+    parser.add_argument('db')
+    parser.add_argument('--bench', action='store_true', help='compare with per-click writes on copies of db')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--max-batch', type=int, default=512, help='pending events that trigger a flush')
+    parser.add_argument('--max-delay', type=float, default=5.0, help='ms the oldest pending event may wait')
+    parser.add_argument('--port', type=int, default=8788)
+    args = parser.parse_args()
+
+    if args.bench:
+        run_bench(args.db, args.sessions, args.max_batch, args.max_delay / 1000)
+        return
+
+    async def run():
+        conn = connect(args.db)
+        options = option_index(conn)
+        conn.close()
+        await serve(AnswerIngest(args.db, options, args.max_batch, args.max_delay / 1000).start(), args.port)
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
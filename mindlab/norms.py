@@ -0,0 +1,252 @@
+"""Population norms per test and scale, for percentile ranks.
+
+Built from the stored `results` rows into one histogram per scale:
+sorted distinct scores with their counts plus the running cumulative
+count, so a percentile rank is one binary search. Scale scores are small
+integers (or rounded means), so the histogram is exact and a few hundred
+bins at most; past MAX_BINS it is compressed into equal-weight centroids
+like a t-digest. Histograms of different databases add bin by bin, so
+shards build their own norms and `merge` combines them.
+
+Norms live in build/norms.json keyed by slug and scale key (database ids
+differ between shards), together with the highest results.id folded in
+per source database. `build` only reads results rows above that id;
+rescoring updates rows in place, so rebuild with --full after a rescore.
+
+The percentile rank is the mid-rank: the share of stored scores below the
+score plus half the share equal to it, in percent.
+
+Usage:
+    python -m mindlab.norms build local.db [--full] [--out build/norms.json]
+    python -m mindlab.norms merge shard1.json shard2.json --out build/norms.json
+    python -m mindlab.norms show [--norms build/norms.json] [slug ...]
+"""
+import argparse
+import json
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.pipeline import write_atomic
+
+NORMS_PATH = os.path.join(ROOT_DIR, 'build', 'norms.json')
+NORMS_VERSION = 1
+MAX_BINS = 2048
+BATCH_SIZE = 100_000
+
+
+@dataclass
+class ScoreHistogram:
+    """Sorted bin values with counts; cumulative counts are kept in sync."""
+    values: np.ndarray
+    counts: np.ndarray
+
+    def __post_init__(self):
+        self.values = np.asarray(self.values, dtype=np.float64)
+        self.counts = np.asarray(self.counts, dtype=np.int64)
+        self.cumulative = np.cumsum(self.counts)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0), np.zeros(0, dtype=np.int64))
+
+    @classmethod
+    def from_scores(cls, scores, counts=None):
+        values, inverse = np.unique(np.asarray(scores, dtype=np.float64), return_inverse=True)
+        weights = np.ones(len(inverse), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        return cls(values, np.bincount(inverse, weights=weights, minlength=len(values)).astype(np.int64))
+
+    @property
+    def n(self):
+        return int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    def merge(self, other):
+        """A new histogram holding both populations."""
+        merged = ScoreHistogram.from_scores(np.concatenate([self.values, other.values]),
+                                            np.concatenate([self.counts, other.counts]))
+        return merged.compress() if len(merged.values) > MAX_BINS else merged
+
+    def compress(self, max_bins=MAX_BINS):
+        """Merge adjacent bins into about max_bins equal-weight centroids."""
+        if len(self.values) <= max_bins:
+            return self
+        group = np.minimum((self.cumulative - self.counts) * max_bins // self.n, max_bins - 1)
+        counts = np.bincount(group, weights=self.counts, minlength=max_bins)
+        sums = np.bincount(group, weights=self.values * self.counts, minlength=max_bins)
+        keep = counts > 0
+        return ScoreHistogram(sums[keep] / counts[keep], counts[keep].astype(np.int64))
+
+    def percentiles(self, scores):
+        """Mid-rank percentile of each score, vectorized; NaN on an empty histogram."""
+        scores = np.asarray(scores, dtype=np.float64)
+        if not self.n:
+            return np.full(scores.shape, np.nan)
+        below = np.searchsorted(self.values, scores, side='left')
+        upto = np.searchsorted(self.values, scores, side='right')
+        cum = np.concatenate([[0], self.cumulative])
+        return 100.0 * (cum[below] + 0.5 * (cum[upto] - cum[below])) / self.n
+
+    def percentile(self, score):
+        return float(self.percentiles(score))
+
+    def quantile(self, q):
+        """Smallest bin value with at least q of the population at or below it."""
+        if not self.n:
+            return None
+        k = int(np.searchsorted(self.cumulative, q * self.n, side='left'))
+        return float(self.values[min(k, len(self.values) - 1)])
+
+    def to_dict(self):
+        return {'values': [v.item() if not v.is_integer() else int(v) for v in self.values],
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['values'], data['counts'])
+
+
+class Norms:
+    """{slug: {scale key: ScoreHistogram}} plus the results.id folded in per source."""
+
+    def __init__(self, histograms=None, sources=None):
+        self.histograms = histograms or {}
+        self.sources = sources or {}
+
+    def get(self, slug, key):
+        return self.histograms.get(slug, {}).get(key)
+
+    def for_test(self, compiled):
+        """Histograms aligned with the compiled test's scales (None where missing)."""
+        return [self.get(compiled.slug, key) for key in compiled.scale_keys]
+
+    def add(self, slug, key, histogram):
+        current = self.get(slug, key)
+        self.histograms.setdefault(slug, {})[key] = current.merge(histogram) if current else histogram
+
+    def merge(self, other):
+        for slug, scales in other.histograms.items():
+            for key, histogram in scales.items():
+                self.add(slug, key, histogram)
+        for source, last_id in other.sources.items():
+            if source in self.sources:
+                raise ValueError(f'{source} is in both norms; merging would count it twice')
+            self.sources[source] = last_id
+        return self
+
+    def to_dict(self):
+        return {
+            'version': NORMS_VERSION,
+            'sources': self.sources,
+            'tests': {slug: {key: h.to_dict() for key, h in scales.items()}
+                      for slug, scales in self.histograms.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get('version') != NORMS_VERSION:
+            return cls()
+        return cls({slug: {key: ScoreHistogram.from_dict(h) for key, h in scales.items()}
+                    for slug, scales in data.get('tests', {}).items()}, dict(data.get('sources', {})))
+
+
+def load_norms(path=NORMS_PATH):
+    if not os.path.exists(path):
+        return Norms()
+    with open(path, 'r', encoding='utf-8') as f:
+        return Norms.from_dict(json.load(f))
+
+
+def save_norms(norms, path=NORMS_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write_atomic(path, json.dumps(norms.to_dict(), ensure_ascii=False) + '\n')
+
+
+def source_key(path):
+    return os.path.realpath(path)
+
+
+def build(conn, source, norms, definitions=None):
+    """Fold results rows above the source's last id into norms. Returns rows read."""
+    definitions = definitions or load_definitions()
+    scale_of = {}
+    for slug, ids in read_catalog(conn, definitions).items():
+        for scale, scale_id in zip(definitions[slug]['scales'], ids.scale_ids):
+            if scale_id is not None:
+                scale_of[scale_id] = (slug, scale['key'])
+
+    last_id = norms.sources.get(source, 0)
+    cursor = conn.execute('SELECT id, scale_id, score FROM results WHERE id > ? ORDER BY id', (last_id,))
+    parts, rows = [], 0
+    while True:
+        batch = cursor.fetchmany(BATCH_SIZE)
+        if not batch:
+            break
+        data = np.array(batch, dtype=np.float64)
+        parts.append(data[:, 1:])
+        last_id = int(data[-1, 0])
+        rows += len(batch)
+    if not parts:
+        return 0
+
+    # One pass over all (scale_id, score) pairs
+    pairs, counts = np.unique(np.concatenate(parts), axis=0, return_counts=True)
+    scale_ids, start = np.unique(pairs[:, 0], return_index=True)
+    bounds = list(start) + [len(pairs)]
+    for k, scale_id in enumerate(scale_ids.astype(np.int64).tolist()):
+        if scale_id in scale_of:
+            lo, hi = bounds[k], bounds[k + 1]
+            norms.add(*scale_of[scale_id], ScoreHistogram(pairs[lo:hi, 1], counts[lo:hi]).compress())
+    norms.sources[source] = last_id
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build, merge and inspect population norms per scale')
+    sub = parser.add_subparsers(dest='command', required=True)
+    b = sub.add_parser('build', help='fold new results rows of a database into the norms')
+    b.add_argument('db')
+    b.add_argument('--out', default=NORMS_PATH)
+    b.add_argument('--full', action='store_true', help='start from empty norms')
+    m = sub.add_parser('merge', help='combine norms built on separate databases')
+    m.add_argument('inputs', nargs='+')
+    m.add_argument('--out', default=NORMS_PATH)
+    s = sub.add_parser('show', help='print quantiles and time percentile lookups')
+    s.add_argument('slugs', nargs='*')
+    s.add_argument('--norms', default=NORMS_PATH)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        norms = Norms() if args.full else load_norms(args.out)
+        conn = connect(args.db)
+        rows = build(conn, source_key(args.db), norms)
+        conn.close()
+        save_norms(norms, args.out)
+        print(f"Folded {rows} results rows into {args.out} in {time.perf_counter() - start:.2f}s")
+    elif args.command == 'merge':
+        norms = Norms()
+        for path in args.inputs:
+            norms.merge(load_norms(path))
+        save_norms(norms, args.out)
+        print(f"Merged {len(args.inputs)} norms into {args.out} ({len(norms.sources)} sources)")
+    else:
+        norms = load_norms(args.norms)
+        for slug, scales in norms.histograms.items():
+            if args.slugs and slug not in args.slugs:
+                continue
+            for key, h in scales.items():
+                probes = np.random.default_rng(0).uniform(h.values[0], h.values[-1], 100_000)
+                t = time.perf_counter()
+                h.percentiles(probes)
+                rate = len(probes) / (time.perf_counter() - t)
+                print(f"{slug:12s} {key:24s} n={h.n:>8d} bins={len(h.values):>5d}  "
+                      f"p25={h.quantile(0.25):g} p50={h.quantile(0.5):g} p75={h.quantile(0.75):g}  "
+                      f"{rate / 1e6:,.1f}M lookups/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Incremental maintenance pipeline for the JSON test definitions.
+
+Replaces the rewrite-everything flow of update_tests.py, fix_tests.py and
+update_scl90.py. Every fix is an idempotent patch; after patching, each
+section of each definition is hashed and compared with the manifest, and
+only files with a changed section are written back. Files are serialized
+exactly like the old scripts (json.dump with indent=4), so unchanged
+sections stay byte-identical.
+
+The slugs that changed are printed and added to a pending list per
+consumer in the manifest: `changed` for the admin sync and
+`changed_rescore` for mindlab.rescore. Each list accumulates across runs,
+including runs limited with --slug, until its own consumer clears it:
+--clear-changed empties `changed` after a sync, and `rescore --changed`
+removes the tests it re-scored from `changed_rescore`, so neither can
+hide a pending test from the other. With --changed-out the pending sync
+list is written to a file. Pass it to the
+admin sync as POST /api/admin/sync-tests?slugs=a,b to resync only those
+tests.
+
+Usage:
+    python -m mindlab.pipeline [--patch NAME ...] [--dry-run] [--changed-out FILE]
+    python -m mindlab.pipeline --clear-changed
+"""
+import argparse
+import hashlib
+import json
+import os
+
+from mindlab.definitions import ROOT_DIR, SECTIONS, definition_path, definition_slugs
+
+MANIFEST_PATH = os.path.join(ROOT_DIR, 'apps', 'web', 'src', 'data', 'tests-manifest.json')
+MANIFEST_VERSION = 1
+
+# Manifest key of each consumer's pending list
+CHANGED_KEYS = {'sync': 'changed', 'rescore': 'changed_rescore'}
+
+# `meta` covers every top-level field outside the listed sections
+HASHED_SECTIONS = ('meta', 'scales') + SECTIONS
+
+
+def serialize(definition):
+    return json.dumps(definition, ensure_ascii=False, indent=4)
+
+
+def content_hash(value):
+    canonical = json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def section_hashes(definition):
+    meta = {k: v for k, v in definition.items() if k not in HASHED_SECTIONS}
+    hashes = {'meta': content_hash(meta)}
+    for section in HASHED_SECTIONS[1:]:
+        hashes[section] = content_hash(definition.get(section, []))
+    return hashes
+
+
+def load_manifest(path=MANIFEST_PATH):
+    if not os.path.exists(path):
+        return {'version': MANIFEST_VERSION, 'tests': {}, **{key: [] for key in CHANGED_KEYS.values()}}
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {'version': MANIFEST_VERSION, 'tests': {}, **{key: [] for key in CHANGED_KEYS.values()}}
+    return manifest
+
+
+def pending(manifest, consumer='sync'):
+    """Slugs changed since `consumer` last cleared its list."""
+    return manifest.get(CHANGED_KEYS[consumer], [])
+
+
+def write_atomic(path, text):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# ---------------------------------------------------------------------------
+# Patches: (slug, definition) -> None, mutating in place. Each must be
+# idempotent so that a second run finds nothing to write.
+# ---------------------------------------------------------------------------
+
+def patch_analysis_updates(slug, definition):
+    from update_tests import ANALYSIS_UPDATES
+
+    updates = ANALYSIS_UPDATES.get(slug, {})
+    for section in ('cutoffs', 'analysis_templates'):
+        if section in updates:
+            definition[section] = updates[section]
+
+
+def patch_mbi_scales(slug, definition):
+    # Scale keys must match the cutoff keys or finish.ts reports 'Unknown'
+    if slug != 'mbi':
+        return
+    definition['scales'] = [
+        {"key": "emotional_exhaustion", "name": "Emotional Exhaustion", "nameFa": "خستگی هیجانی"},
+        {"key": "depersonalization", "name": "Depersonalization", "nameFa": "مسخ شخصیت"},
+        {"key": "personal_accomplishment", "name": "Personal Accomplishment", "nameFa": "موفقیت فردی"}
+    ]
+    renames = {'exhaustion': 'emotional_exhaustion', 'accomplishment': 'personal_accomplishment'}
+    for q in definition['questions']:
+        if q.get('scaleKey') in renames:
+            q['scaleKey'] = renames[q['scaleKey']]
+
+
+def patch_enrich_total(slug, definition):
+    if slug == 'enrich' and not any(s['key'] == 'total' for s in definition['scales']):
+        definition['scales'].append({"key": "total", "name": "Total", "nameFa": "نمره کل"})
+
+
+def patch_whoqol_total(slug, definition):
+    if slug != 'whoqol-bref':
+        return
+    cutoff_keys = {c['scaleKey'] for c in definition.get('cutoffs', [])}
+    scale_keys = {s['key'] for s in definition['scales']}
+    if 'total' in cutoff_keys - scale_keys:
+        definition['scales'].append({"key": "total", "name": "Total", "nameFa": "نمره کل"})
+
+
+def patch_scl90_texts(slug, definition):
+    from update_scl90 import FULL_QUESTIONS
+
+    if slug != 'scl-90-r':
+        return
+    for q, text in zip(definition['questions'], FULL_QUESTIONS):
+        q['text'] = text
+
+
+# Declared aggregations (see mindlab.aggregates): the 'total' scales are
+# composites of their subscales instead of scales without questions
+AGGREGATES = {
+    'scl-90-r': {'gsi': {'type': 'gsi', 'round': 2}},
+    'whoqol-bref': {'total': {'type': 'composite',
+                              'scales': ['physical', 'psychological', 'social', 'environment', 'overall']}},
+    'moci': {'total': {'type': 'composite', 'scales': ['checking', 'cleaning', 'slowness', 'doubting']}},
+    'enrich': {'total': {'type': 'composite', 'scales': ['idealistic', 'satisfaction', 'communication', 'conflict']}},
+    'lsas': {'total': {'type': 'composite', 'scales': ['fear', 'avoidance']}},
+    'ies-r': {'total': {'type': 'composite', 'scales': ['intrusion', 'avoidance', 'hyperarousal']}},
+}
+
+
+def patch_aggregates(slug, definition):
+    for scale in definition['scales']:
+        spec = AGGREGATES.get(slug, {}).get(scale['key'])
+        if spec:
+            scale['aggregate'] = spec
+
+
+PATCHES = {
+    'analysis_updates': patch_analysis_updates,
+    'mbi_scales': patch_mbi_scales,
+    'enrich_total': patch_enrich_total,
+    'whoqol_total': patch_whoqol_total,
+    'scl90_texts': patch_scl90_texts,
+    'aggregates': patch_aggregates,
+}
+
+
+def run(patches=None, slugs=None, dry_run=False, manifest_path=MANIFEST_PATH):
+    """Apply patches and write back only what changed.
+
+    Returns {slug: [changed sections]} for every test whose content differs
+    from the manifest (or from disk, for tests the manifest has not seen).
+    """
+    patch_fns = [PATCHES[name] for name in (patches or PATCHES)]
+    manifest = load_manifest(manifest_path)
+    changed = {}
+
+    for slug in slugs or definition_slugs():
+        path = definition_path(slug)
+        with open(path, 'r', encoding='utf-8') as f:
+            original = f.read()
+        definition = json.loads(original)
+        before = section_hashes(definition)
+
+        for fn in patch_fns:
+            fn(slug, definition)
+
+        after = section_hashes(definition)
+        known = manifest['tests'].get(slug, {}).get('sections', before)
+        sections = [s for s in HASHED_SECTIONS if after[s] != known.get(s)]
+        text = serialize(definition)
+
+        if sections:
+            changed[slug] = sections
+        if dry_run:
+            continue
+        if text != original:
+            write_atomic(path, text)
+        manifest['tests'][slug] = {
+            'file': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+            'sections': after,
+        }
+
+    if not dry_run:
+        for consumer, key in CHANGED_KEYS.items():
+            manifest[key] = sorted(set(pending(manifest, consumer)) | set(changed))
+        write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=4))
+    return changed
+
+
+def clear_changed(slugs=None, consumer='sync', manifest_path=MANIFEST_PATH):
+    """Drop slugs (all when None) from one consumer's pending list; returns what is left."""
+    manifest = load_manifest(manifest_path)
+    key = CHANGED_KEYS[consumer]
+    manifest[key] = [] if slugs is None else [s for s in pending(manifest, consumer) if s not in set(slugs)]
+    write_atomic(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=4))
+    return manifest[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply definition patches and rewrite only changed tests')
+    parser.add_argument('--patch', action='append', choices=sorted(PATCHES), help='run only these patches')
+    parser.add_argument('--slug', action='append', help='limit to these tests')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--changed-out', help='write the pending changed slugs as a JSON list')
+    parser.add_argument('--clear-changed', action='store_true', help="empty the manifest's pending sync list after a sync")
+    args = parser.parse_args()
+
+    if args.clear_changed:
+        clear_changed()
+        print("Cleared the pending sync list")
+        return
+
+    changed = run(args.patch, args.slug, args.dry_run)
+    to_sync = sorted(set(pending(load_manifest())) | set(changed))
+
+    for slug, sections in changed.items():
+        print(f"{'Would update' if args.dry_run else 'Updated'} {slug}: {', '.join(sections)}")
+    if not changed:
+        print("No changes")
+    if to_sync:
+        print(f"\nSync: POST /api/admin/sync-tests?slugs={','.join(to_sync)}")
+
+    if args.changed_out:
+        with open(args.changed_out, 'w', encoding='utf-8') as f:
+            json.dump(to_sync, f)
+
+
+if __name__ == '__main__':
+    main()
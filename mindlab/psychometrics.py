@@ -0,0 +1,253 @@
+"""Item statistics and reliability over the stored answers.
+
+Streams the answers of each test's finished sessions once, in keyset
+pages of session ids, pivots every page into a sessions x items matrix
+and folds it into per-scale accumulators, so memory depends on the page
+size and the number of items, never on the number of answers:
+
+    co-moments        count, means and centered cross-products of the
+                      scale's items over complete cases, merged page by
+                      page with the pairwise update of Chan et al.
+    endorsements      answer counts per item and option
+    floor/ceiling     complete cases at the lowest/highest possible total
+
+From those, per scale: Cronbach's alpha, alpha if an item is deleted,
+corrected item-total correlations (item against the rest of its scale),
+option endorsement frequencies, and item and scale floor/ceiling rates.
+
+Reverse-scored items carry descending option scores in the JSON. An item
+counts as reverse-keyed when its direction is the minority of its test
+(moci and eat-26 list most items descending). A reverse-keyed item with a
+negative corrected item-total correlation is flagged as likely
+mis-keyed; any other item with a negative correlation is flagged too.
+
+Sessions moved by mindlab.archive are read from the archive
+(mindlab.archive.stored_batches); --archive points at its root.
+
+Usage:
+    python -m mindlab.psychometrics local.db [slug ...] [--page 5000] [--archive build/archive] [--json report.json]
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from mindlab.archive import ARCHIVE_DIR, Archive, stored_batches
+from mindlab.definitions import load_definitions
+from mindlab.localdb import connect, read_catalog
+from mindlab.scoring import compile_test
+
+# Instruments whose reverse-keyed items get an explicit verdict in the report
+REVERSE_KEYED_TESTS = ('ces-d', 'stai', 'enrich', 'moci', 'whoqol-bref')
+WEAK_ITEM_TOTAL = 0.2
+
+
+class CoMoments:
+    """Running count, mean vector and centered cross-product matrix."""
+
+    def __init__(self, k):
+        self.n = 0
+        self.mean = np.zeros(k)
+        self.m2 = np.zeros((k, k))
+
+    def update(self, x):
+        """Fold the rows of x (n x k) in."""
+        n_b = len(x)
+        if not n_b:
+            return
+        x = np.asarray(x, dtype=np.float64)
+        mean_b = x.mean(axis=0)
+        centered = x - mean_b
+        m2_b = centered.T @ centered
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.m2 += m2_b + np.outer(delta, delta) * (self.n * n_b / n)
+        self.mean += delta * (n_b / n)
+        self.n = n
+
+    def covariance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else np.full(self.m2.shape, np.nan)
+
+
+def cronbach_alpha(cov):
+    k = len(cov)
+    total = cov.sum()
+    if k < 2 or not total > 0:
+        return float('nan')
+    return k / (k - 1) * (1 - np.trace(cov) / total)
+
+
+def item_total_correlations(cov):
+    """Correlation of each item with the sum of the other items of the scale."""
+    row = cov.sum(axis=1)
+    var_item = np.diag(cov)
+    var_rest = cov.sum() - 2 * row + var_item
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (row - var_item) / np.sqrt(var_item * var_rest)
+
+
+def alpha_if_deleted(cov):
+    keep = np.ones(len(cov), dtype=bool)
+    out = []
+    for i in range(len(cov)):
+        keep[i] = False
+        out.append(cronbach_alpha(cov[np.ix_(keep, keep)]))
+        keep[i] = True
+    return np.array(out)
+
+
+def reverse_keyed(definition):
+    """Question orders scored against the majority direction of their test."""
+    direction = {}
+    for q in definition['questions']:
+        scores = [o['score'] for o in q['options']]
+        if len(scores) > 1 and scores[0] != scores[-1]:
+            direction[q['order']] = scores[0] > scores[-1]
+    descending = sum(direction.values())
+    majority = descending > len(direction) - descending
+    return {order for order, desc in direction.items() if desc != majority}
+
+
+class TestAccumulator:
+    """Per-scale accumulators for one compiled test."""
+
+    def __init__(self, definition, compiled):
+        self.compiled = compiled
+        self.definition = definition
+        self.n_sessions = 0
+        self.endorsed = np.zeros(compiled.option_scores.shape, dtype=np.int64)
+        self.scales = []
+        for j, key in enumerate(compiled.scale_keys):
+            items = np.flatnonzero(compiled.weights[:, j])
+            if len(items):
+                low = self._item_extreme(items, np.min)
+                high = self._item_extreme(items, np.max)
+                self.scales.append({'key': key, 'items': items, 'moments': CoMoments(len(items)),
+                                    'min': int(low.sum()), 'max': int(high.sum()), 'floor': 0, 'ceiling': 0})
+
+    def _item_extreme(self, items, reduce):
+        c = self.compiled
+        return np.array([reduce(c.option_scores[i, :c.option_counts[i]]) for i in items])
+
+    def update(self, scores, answered):
+        c = self.compiled
+        self.n_sessions += len(scores)
+        # Option endorsements by matching the stored score; with duplicate
+        # scores within an item the first option is credited
+        credited = np.zeros(scores.shape, dtype=bool)
+        for k in range(c.option_scores.shape[1]):
+            hit = answered & ~credited & (k < c.option_counts)[None, :] & (scores == c.option_scores[None, :, k])
+            self.endorsed[:, k] += hit.sum(axis=0)
+            credited |= hit
+        for scale in self.scales:
+            items = scale['items']
+            complete = answered[:, items].all(axis=1)
+            x = scores[complete][:, items]
+            scale['moments'].update(x)
+            totals = x.sum(axis=1)
+            scale['floor'] += int((totals == scale['min']).sum())
+            scale['ceiling'] += int((totals == scale['max']).sum())
+
+    def report(self):
+        c = self.compiled
+        reverse = reverse_keyed(self.definition)
+        orders = c.item_orders.tolist()
+        scales = []
+        for scale in self.scales:
+            items = scale['items']
+            n = scale['moments'].n
+            cov = scale['moments'].covariance()
+            r_it = item_total_correlations(cov) if n > 1 else np.full(len(items), np.nan)
+            deleted = alpha_if_deleted(cov) if n > 1 else np.full(len(items), np.nan)
+            item_rows = []
+            for pos, i in enumerate(items):
+                counts = self.endorsed[i, :c.option_counts[i]]
+                answered = int(counts.sum())
+                freq = (counts / answered).round(4).tolist() if answered else [0.0] * len(counts)
+                flag = None
+                if np.isfinite(r_it[pos]) and r_it[pos] < 0:
+                    flag = 'likely mis-keyed' if orders[i] in reverse else 'negative item-total correlation'
+                elif np.isfinite(r_it[pos]) and r_it[pos] < WEAK_ITEM_TOTAL:
+                    flag = 'weak'
+                item_rows.append({
+                    'order': orders[i],
+                    'reverse': orders[i] in reverse,
+                    'mean': round(float(scale['moments'].mean[pos]), 3) if n else None,
+                    'item_total_r': finite(r_it[pos]),
+                    'alpha_if_deleted': finite(deleted[pos]),
+                    'endorsement': freq,
+                    'floor': freq[int(np.argmin(c.option_scores[i, :c.option_counts[i]]))] if answered else None,
+                    'ceiling': freq[int(np.argmax(c.option_scores[i, :c.option_counts[i]]))] if answered else None,
+                    'flag': flag,
+                })
+            scales.append({
+                'scale': scale['key'],
+                'complete_cases': n,
+                'alpha': finite(cronbach_alpha(cov)) if n > 1 else None,
+                'floor_rate': round(scale['floor'] / n, 4) if n else None,
+                'ceiling_rate': round(scale['ceiling'] / n, 4) if n else None,
+                'items': item_rows,
+            })
+        return {'test': c.slug, 'sessions': self.n_sessions, 'reverse_keyed': sorted(reverse), 'scales': scales}
+
+
+def finite(value):
+    value = float(value)
+    return round(value, 4) if np.isfinite(value) else None
+
+
+def analyze(conn, definitions, page=5000, archive=None):
+    """{slug: report} for every synced test, one streaming pass over its answers and archived sessions."""
+    reports = {}
+    for slug, ids in read_catalog(conn, definitions).items():
+        compiled = compile_test(definitions[slug])
+        acc = TestAccumulator(definitions[slug], compiled)
+        for _, scores, answered in stored_batches(conn, compiled, ids.test_id, archive, page):
+            acc.update(scores.astype(np.int64), answered)
+        reports[slug] = acc.report()
+    return reports
+
+
+def print_report(report):
+    print(f"\n{report['test']}  ({report['sessions']} sessions, reverse-keyed: "
+          f"{', '.join(f'q{o}' for o in report['reverse_keyed']) or 'none'})")
+    for scale in report['scales']:
+        alpha = '-' if scale['alpha'] is None else f"{scale['alpha']:.3f}"
+        print(f"  {scale['scale']:24s} alpha {alpha:>6s}  n {scale['complete_cases']:>7d}  "
+              f"floor {scale['floor_rate'] or 0:.1%}  ceiling {scale['ceiling_rate'] or 0:.1%}")
+        for item in scale['items']:
+            if item['flag'] and (item['flag'] != 'weak' or item['reverse']):
+                r = '-' if item['item_total_r'] is None else f"{item['item_total_r']:+.3f}"
+                print(f"      q{item['order']:<3d} r_it {r}  {'reverse, ' if item['reverse'] else ''}{item['flag']}")
+    if report['test'] in REVERSE_KEYED_TESTS:
+        flagged = [i['order'] for s in report['scales'] for i in s['items']
+                   if i['reverse'] and i['flag'] == 'likely mis-keyed']
+        print(f"  reverse-keyed check: {', '.join(f'q{o}' for o in flagged) + ' look mis-keyed' if flagged else 'ok'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Item statistics and reliability from the stored answers')
+    parser.add_argument('path')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--page', type=int, default=5000, help='sessions per streamed page')
+    parser.add_argument('--archive', default=ARCHIVE_DIR, help='mindlab.archive root of archived sessions')
+    parser.add_argument('--json', help='write the full report to this file')
+    args = parser.parse_args()
+
+    conn = connect(args.path)
+    start = time.perf_counter()
+    reports = analyze(conn, load_definitions(args.slugs or None), args.page, Archive(args.archive))
+    elapsed = time.perf_counter() - start
+    conn.close()
+
+    for report in reports.values():
+        print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    print(f"\nAnalyzed {sum(r['sessions'] for r in reports.values())} sessions in {elapsed:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
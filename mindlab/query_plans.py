@@ -0,0 +1,193 @@
+"""EXPLAIN QUERY PLAN report for the handler statements.
+
+Runs the exact SQL of sessions/start.ts, sessions/finish.ts and
+admin/export.ts (see mindlab/statements.py) against a local database built
+by mindlab.localdb, times each statement and flags plans that scan a table,
+sort through a temp b-tree, or leave a range predicate out of the index
+search. With --candidate-indexes the report is repeated after creating
+CANDIDATE_INDEXES, so the effect of a proposed migration is visible before
+it ships.
+
+Usage:
+    python -m mindlab.query_plans local.db [--repeat 200] [--candidate-indexes] [--json]
+"""
+import argparse
+import json
+import re
+import time
+
+from mindlab import statements as sql
+from mindlab.localdb import connect
+
+CANDIDATE_INDEXES = (
+    # finish.ts joins answers to question_scales filtered by scale_id
+    'CREATE INDEX IF NOT EXISTS idx_question_scales_scale ON question_scales(scale_id, question_id)',
+    # finish.ts looks cutoffs up with min_score <= ? AND max_score >= ?
+    'CREATE INDEX IF NOT EXISTS idx_cutoffs_scale_range ON cutoffs(scale_id, min_score, max_score)',
+    # start.ts looks for the latest unfinished session of a user and test
+    'CREATE INDEX IF NOT EXISTS idx_sessions_user_test ON sessions(user_uid, test_id, finished_at, created_at)',
+)
+
+RANGE_RE = re.compile(r'(\w+)\s*(?:<=|>=|<|>)\s*\?')
+
+
+def sample_context(conn, slug='scl-90-r'):
+    """Ids of a representative unfinished session of the largest test."""
+    test_id = conn.execute('SELECT id FROM tests WHERE slug = ?', (slug,)).fetchone()[0]
+    row = conn.execute('SELECT id, user_uid FROM sessions WHERE test_id = ? AND finished_at IS NULL LIMIT 1',
+                       (test_id,)).fetchone() or (0, 'user-0000000')
+    question_ids = [r[0] for r in conn.execute('SELECT id FROM questions WHERE test_id = ? ORDER BY order_index', (test_id,))]
+    option = conn.execute('SELECT id, question_id FROM options WHERE question_id = ? LIMIT 1', (question_ids[0],)).fetchone()
+    scale_ids = [r[0] for r in conn.execute('SELECT id FROM scales WHERE test_id = ?', (test_id,))]
+    level = conn.execute('SELECT label FROM cutoffs WHERE scale_id IN (%s) LIMIT 1' % ','.join('?' * len(scale_ids)),
+                         scale_ids).fetchone()
+    return {
+        'test_id': test_id,
+        'session_id': row[0],
+        'uid': row[1],
+        'question_ids': question_ids,
+        'question_id': option[1],
+        'option_id': option[0],
+        'scale_id': scale_ids[0],
+        'n_scales': len(scale_ids),
+        'score': 10,
+        'level': level[0] if level else 'Unknown',
+        'n_tests': conn.execute('SELECT COUNT(*) FROM tests').fetchone()[0],
+        'n_all_scales': conn.execute('SELECT COUNT(*) FROM scales').fetchone()[0],
+        'n_all_questions': conn.execute('SELECT COUNT(*) FROM questions').fetchone()[0],
+    }
+
+
+# (handler, name, sql, params(ctx), executions per request(ctx))
+CASES = (
+    ('start', 'test_exists', sql.START_TEST_EXISTS, lambda c: (c['test_id'],), lambda c: 1),
+    ('start', 'existing_session', sql.START_EXISTING_SESSION, lambda c: (c['test_id'], c['uid']), lambda c: 1),
+    ('start', 'existing_answers', sql.START_EXISTING_ANSWERS, lambda c: (c['session_id'],), lambda c: 1),
+    ('start', 'questions', sql.START_QUESTIONS, lambda c: (c['test_id'],), lambda c: 1),
+    ('start', 'options', None, lambda c: tuple(c['question_ids']), lambda c: 1),
+    ('finish', 'session', sql.FINISH_SESSION, lambda c: (c['session_id'], c['uid']), lambda c: 1),
+    ('finish', 'scales', sql.FINISH_SCALES, lambda c: (c['test_id'],), lambda c: 1),
+    ('finish', 'answers', sql.FINISH_ANSWERS, lambda c: (c['session_id'],), lambda c: 1),
+    ('finish', 'scale_score', sql.FINISH_SCALE_SCORE, lambda c: (c['session_id'], c['scale_id']), lambda c: c['n_scales']),
+    ('finish', 'cutoff', sql.FINISH_CUTOFF, lambda c: (c['scale_id'], c['score'], c['score']), lambda c: c['n_scales']),
+    ('finish', 'insert_result', sql.FINISH_INSERT_RESULT,
+     lambda c: (c['session_id'], c['scale_id'], c['score'], 'x'), lambda c: c['n_scales']),
+    ('finish', 'template', sql.FINISH_TEMPLATE, lambda c: (c['test_id'], c['scale_id'], c['level']), lambda c: c['n_scales']),
+    ('finish', 'overall_template', sql.FINISH_OVERALL_TEMPLATE, lambda c: (c['test_id'], c['level']), lambda c: 1),
+    ('finish', 'risk_rules', sql.FINISH_RISK_RULES, lambda c: (c['test_id'],), lambda c: 1),
+    ('finish', 'save_report', sql.FINISH_SAVE_REPORT, lambda c: (c['session_id'], '{}'), lambda c: 1),
+    ('finish', 'mark_finished', sql.FINISH_MARK_FINISHED, lambda c: (c['session_id'],), lambda c: 1),
+    ('export', 'tests', sql.EXPORT_TESTS, lambda c: (), lambda c: 1),
+    ('export', 'scales', sql.EXPORT_SCALES, lambda c: (c['test_id'],), lambda c: c['n_tests']),
+    ('export', 'cutoffs', sql.EXPORT_CUTOFFS, lambda c: (c['scale_id'],), lambda c: c['n_all_scales']),
+    ('export', 'questions', sql.EXPORT_QUESTIONS, lambda c: (c['test_id'],), lambda c: c['n_tests']),
+    ('export', 'options', sql.EXPORT_OPTIONS, lambda c: (c['question_id'],), lambda c: c['n_all_questions']),
+    ('export', 'scale_mappings', sql.EXPORT_SCALE_MAPPINGS, lambda c: (c['question_id'],), lambda c: c['n_all_questions']),
+)
+
+
+def plan_warnings(statement, details):
+    warnings = []
+    for detail in details:
+        if detail.startswith('SCAN ') and 'CONSTANT ROW' not in detail:
+            warnings.append(f'full scan: {detail}')
+        if 'USE TEMP B-TREE' in detail:
+            warnings.append(f'temp sort: {detail}')
+    ranged = set(RANGE_RE.findall(statement))
+    searched = ' '.join(d for d in details if d.startswith('SEARCH '))
+    for column in sorted(ranged):
+        if searched and column not in searched:
+            warnings.append(f'range on {column} filtered after the index search')
+    return warnings
+
+
+def time_statement(conn, statement, params, repeat):
+    writes = not statement.lstrip().upper().startswith('SELECT')
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if writes:
+            conn.execute('SAVEPOINT plan')
+        conn.execute(statement, params).fetchall()
+        if writes:
+            conn.execute('ROLLBACK TO plan')
+            conn.execute('RELEASE plan')
+    return (time.perf_counter() - start) / repeat
+
+
+def explain(conn, repeat=200, ctx=None):
+    ctx = ctx or sample_context(conn)
+    report = []
+    for handler, name, statement, params_fn, count_fn in CASES:
+        statement = statement or sql.start_options(len(ctx['question_ids']))
+        params = params_fn(ctx)
+        details = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {statement}', params)]
+        seconds = time_statement(conn, statement, params, repeat)
+        count = count_fn(ctx)
+        report.append({
+            'handler': handler,
+            'statement': name,
+            'plan': details,
+            'warnings': plan_warnings(statement, details),
+            'us_per_call': round(seconds * 1e6, 2),
+            'calls_per_request': count,
+            'us_per_request': round(seconds * 1e6 * count, 2),
+        })
+    return report
+
+
+def explain_with_candidates(conn, repeat=200):
+    """explain() with CANDIDATE_INDEXES present; indexes it created are dropped again."""
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    created = []
+    for statement in CANDIDATE_INDEXES:
+        name = statement.split(' ON ')[0].split()[-1]
+        if name not in existing:
+            conn.execute(statement)
+            created.append(name)
+    conn.execute('ANALYZE')
+    try:
+        return explain(conn, repeat)
+    finally:
+        for name in created:
+            conn.execute(f'DROP INDEX {name}')
+        conn.execute('ANALYZE')
+
+
+def print_report(report, title):
+    print(f"== {title}")
+    for handler in dict.fromkeys(r['handler'] for r in report):
+        rows = [r for r in report if r['handler'] == handler]
+        total = sum(r['us_per_request'] for r in rows)
+        calls = sum(r['calls_per_request'] for r in rows)
+        print(f"\n{handler}: {calls} statements, {total / 1000:.2f} ms per request")
+        for r in rows:
+            print(f"  {r['statement']:18s} {r['us_per_call']:9.1f} us x {r['calls_per_request']:<5d}")
+            for detail in r['plan']:
+                print(f"      {detail}")
+            for warning in r['warnings']:
+                print(f"      ! {warning}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Explain and time the handler statements on a local database')
+    parser.add_argument('path')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--candidate-indexes', action='store_true', help='also report with CANDIDATE_INDEXES created')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    conn = connect(args.path)
+    reports = {'baseline': explain(conn, args.repeat)}
+    if args.candidate_indexes:
+        reports['candidate_indexes'] = explain_with_candidates(conn, args.repeat)
+
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+    else:
+        for title, report in reports.items():
+            print_report(report, title)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Result report builder with memoized analysis sections.
+
+Builds the same ResultReport object as finish.ts from a scored row of
+mindlab.scoring. The analysis block (overall template and per-scale
+highlights) depends only on the scale order and the level of each scale,
+so it is rendered and serialized once per distinct level tuple and kept
+in a bounded LRU cache; finish.ts instead runs one template query per
+scale per session. render_json() splices the cached JSON text into the
+report, which skips re-encoding the long template texts. Cached sections
+are shared between reports and must not be mutated.
+
+Usage:
+    python -m mindlab.reports [--sessions N] [--cache-size N] [slug ...]
+"""
+import argparse
+import time
+from collections import OrderedDict
+
+from mindlab.definitions import load_definitions
+from mindlab.handlers import DEFAULT_WARNING, RISK_RE, iso_now, to_json
+from mindlab.scoring import compile_test, option_matrix_scores, random_choices, scale_results, score_matrix
+
+TEMPLATE_FIELDS = ('title', 'summary', 'details', 'recommendations')
+
+COMPARE = {
+    '>=': lambda a, b: a >= b, '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b, '<': lambda a, b: a < b,
+    '==': lambda a, b: a == b, '=': lambda a, b: a == b,
+}
+
+
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, build):
+        """Cached value for key, calling build() on a miss."""
+        if key in self.data:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+        self.misses += 1
+        value = build()
+        if self.maxsize > 0:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ReportRenderer:
+    """Renders finish.ts reports for one test.
+
+    `scale_ids` maps scale positions to database ids (scale keys stand in
+    without it) and `test` overrides the report's test block, whose id is
+    otherwise None. finish.ts matches templates on `level`, which holds
+    the Persian labelFa after sync while level_label holds the English
+    label, so no template ever matches; template_field='levelFa' matches
+    on the English label instead. `norms` (mindlab.norms.Norms) adds
+    percentile ranks to the scale results.
+    """
+
+    def __init__(self, definition, compiled=None, scale_ids=None, test=None, cache_size=4096,
+                 template_field='level', norms=None):
+        self.compiled = compiled or compile_test(definition)
+        self.scale_ids = scale_ids
+        self.norms = norms.for_test(self.compiled) if norms else None
+        self.test = test or {
+            'id': None,
+            'slug': definition['slug'],
+            'name': definition['nameFa'],
+            'category': definition['category'],
+        }
+        self.disclaimer = definition.get('warning') or DEFAULT_WARNING
+        self.cache = LRUCache(cache_size)
+        self.template_field = template_field
+
+        keys = set(self.compiled.scale_keys)
+        # First template in insertion order, like LIMIT 1 without ORDER BY.
+        # A template whose scaleKey has no scale is stored with scale_id NULL
+        # and matches every scale.
+        self.by_scale, self.by_level = {}, {}
+        for t in definition.get('analysis_templates', []):
+            fields = {k: t.get(k) for k in TEMPLATE_FIELDS}
+            self.by_level.setdefault(t.get('level_label'), fields)
+            for key in (keys if t.get('scaleKey') not in keys else (t['scaleKey'],)):
+                self.by_scale.setdefault((key, t.get('level_label')), fields)
+
+        # Only `q<N>_score <op> <n>` conditions can fire in finish.ts
+        columns = {int(order): i for i, order in enumerate(self.compiled.item_orders)}
+        self.rules = []
+        for rule in definition.get('risk_rules', []):
+            match = RISK_RE.search(rule['condition'])
+            if match and int(match.group(1)) in columns:
+                self.rules.append((columns[int(match.group(1))], COMPARE[match.group(2)], int(match.group(3)),
+                                   {'message': rule['message'], 'severity': rule['severity']}))
+
+        # The finish.ts scales query is served by idx_scales_unique(test_id, name),
+        # so results come back sorted by name
+        names = self.compiled.scale_names
+        self.name_order = sorted(range(len(names)), key=lambda j: (names[j], j))
+
+    def _analysis(self, keyed):
+        results = [sr for _, sr in keyed]
+        highlights, overall = [], None
+        for key, sr in keyed:
+            template = self.by_scale.get((key, sr[self.template_field]))
+            if template:
+                if len(results) == 1:
+                    overall = template
+                else:
+                    highlights.append({
+                        'title': f"{sr['scale_name']}: {template['title']}",
+                        'summary': template['summary'],
+                        'details': template['details'],
+                        'recommendations': template['recommendations'],
+                    })
+        if not overall and not highlights and results:
+            overall = self.by_level.get(results[0][self.template_field])
+        return {'overall': overall, 'highlights': highlights}
+
+    def _cached(self, keyed):
+        def build():
+            analysis = self._analysis(keyed)
+            return analysis, to_json(analysis)
+
+        return self.cache.get(tuple((k, sr[self.template_field]) for k, sr in keyed), build)
+
+    def analysis(self, keyed):
+        """Analysis block for [(scale key, scale result)] in report order."""
+        return self._cached(keyed)[0]
+
+    def risk_flags(self, item_scores, answered):
+        return [flag for column, compare, threshold, flag in self.rules
+                if answered[column] and compare(int(item_scores[column]), threshold)]
+
+    def render(self, batch, row, item_scores=None, answered=None, order=None, total=None, completed_at=None):
+        """ResultReport for one row of a ScoredBatch.
+
+        `order` lists scale positions in report order (default: by name,
+        like finish.ts); `item_scores`/`answered` feed the risk rules.
+        """
+        results = scale_results(self.compiled, batch, row, self.scale_ids, self.norms)
+        keyed = [(self.compiled.scale_keys[j], results[j]) for j in (order or self.name_order)]
+        flags = self.risk_flags(item_scores, answered) if item_scores is not None else []
+        return {
+            'test': self.test,
+            'scores': {
+                'total': int(batch.total[row]) if total is None else total,
+                'scales': [sr for _, sr in keyed],
+            },
+            'analysis': self.analysis(keyed),
+            'riskFlags': flags,
+            'disclaimer': self.disclaimer,
+            'completedAt': completed_at or iso_now(),
+        }
+
+    def render_json(self, batch, row, item_scores=None, answered=None, order=None, total=None, completed_at=None):
+        """to_json(render(...)), splicing in the cached serialized analysis block."""
+        results = scale_results(self.compiled, batch, row, self.scale_ids, self.norms)
+        keyed = [(self.compiled.scale_keys[j], results[j]) for j in (order or self.name_order)]
+        flags = self.risk_flags(item_scores, answered) if item_scores is not None else []
+        scores = {'total': int(batch.total[row]) if total is None else total, 'scales': [sr for _, sr in keyed]}
+        return (f'{{"test":{to_json(self.test)},"scores":{to_json(scores)},"analysis":{self._cached(keyed)[1]},'
+                f'"riskFlags":{to_json(flags)},"disclaimer":{to_json(self.disclaimer)},'
+                f'"completedAt":{to_json(completed_at or iso_now())}}}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render finish.ts reports for random sessions and report cache stats')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--cache-size', type=int, default=4096)
+    parser.add_argument('--english-templates', action='store_true',
+                        help='match templates on the English label, so the analysis block is filled')
+    args = parser.parse_args()
+
+    completed_at = iso_now()
+    for slug, definition in load_definitions(args.slugs or None).items():
+        compiled = compile_test(definition)
+        choices = random_choices(compiled, args.sessions, skip_rate=0.02)
+        scores, answered = option_matrix_scores(compiled, choices)
+        batch = score_matrix(compiled, scores)
+
+        timings = {}
+        for size in (0, args.cache_size):
+            renderer = ReportRenderer(definition, compiled, cache_size=size,
+                                      template_field='levelFa' if args.english_templates else 'level')
+            start = time.perf_counter()
+            for row in range(args.sessions):
+                if size:
+                    renderer.render_json(batch, row, scores[row], answered[row], completed_at=completed_at)
+                else:
+                    to_json(renderer.render(batch, row, scores[row], answered[row], completed_at=completed_at))
+            timings[size] = time.perf_counter() - start
+
+        mismatches = sum(
+            renderer.render_json(batch, row, scores[row], answered[row], completed_at=completed_at)
+            != to_json(renderer.render(batch, row, scores[row], answered[row], completed_at=completed_at))
+            for row in range(min(args.sessions, 500)))
+
+        stats = renderer.cache.stats()
+        print(f"{slug:12s} {args.sessions / timings[args.cache_size]:>9,.0f} reports/s "
+              f"(uncached {args.sessions / timings[0]:>9,.0f}/s)  hits {stats['hits']:>7d}  "
+              f"misses {stats['misses']:>6d}  evictions {stats['evictions']:>6d}  hit rate {stats['hit_rate']:.1%}  mismatches {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""Re-score stored sessions after a definition change.
+
+When a cutoff or scale mapping changes, the results rows and the scores
+and analysis inside result_reports.report_json of every finished session
+of that test are stale. This job streams finished sessions in id order,
+chunk by chunk, scores each chunk in a process pool with the batch scorer
+and writes back only the rows that actually changed, one transaction per
+chunk. Each transaction also records the last session id in
+rescore_checkpoints under a job key derived from the definition's content
+hash, so an interrupted run resumes where it stopped and a later
+definition change starts over.
+
+Scoring follows finish.ts: stored answer scores are summed per scale, the
+level comes from the JSON cutoffs with the sync column swap, and the
+analysis block comes from mindlab.reports, memoized per level tuple.
+Templates are matched on finish.ts's `level` unless --english-templates
+is given; use the same setting as the run that wrote the reports (e.g.
+mindlab.compact seed), or every report's analysis is rewritten. Reports
+moved to compact_reports by mindlab.compact are decoded and re-encoded
+in place. --changed takes the tests pending rescore in the pipeline
+manifest and removes them from that list once they are re-scored; the
+admin sync keeps its own list.
+
+Sessions moved by mindlab.archive have no answers rows left. They are
+scored from the archive under --archive, and skipped if it does not hold
+them, so their stored results are never overwritten from an empty
+answer set.
+
+Usage:
+    python -m mindlab.rescore local.db [slug ...] [--changed] [--workers 4] [--chunk 5000] [--restart] [--archive DIR]
+                                      [--english-templates]
+"""
+import argparse
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from mindlab.definitions import load_definitions
+from mindlab.handlers import to_json
+from mindlab.localdb import connect, read_catalog
+from mindlab.pipeline import clear_changed, content_hash, load_manifest, pending
+from mindlab.reports import ReportRenderer
+from mindlab.scoring import compile_test, interpretation, scale_results, score_matrix
+
+CHECKPOINT_TABLE = """
+CREATE TABLE IF NOT EXISTS rescore_checkpoints (
+    job TEXT NOT NULL,
+    test_id INTEGER NOT NULL,
+    last_session_id INTEGER NOT NULL,
+    updated_at TEXT DEFAULT (datetime('now')),
+    PRIMARY KEY (job, test_id)
+)
+"""
+
+SESSION_PAGE = """
+SELECT id FROM sessions
+WHERE test_id = ? AND finished_at IS NOT NULL AND id > ?
+ORDER BY id LIMIT ?
+"""
+
+# The three range reads below share the (test_id, finished, id range) filter
+CHUNK_ANSWERS = """
+SELECT a.session_id, q.order_index, a.score
+FROM sessions s
+JOIN answers a ON a.session_id = s.id
+LEFT JOIN questions q ON q.id = a.question_id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.id > ? AND s.id <= ?
+"""
+
+CHUNK_RESULTS = """
+SELECT r.session_id, r.scale_id, r.score, r.interpretation
+FROM sessions s
+JOIN results r ON r.session_id = s.id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.id > ? AND s.id <= ?
+"""
+
+CHUNK_REPORTS = """
+SELECT rr.session_id, rr.report_json
+FROM sessions s
+JOIN result_reports rr ON rr.session_id = s.id
+WHERE s.test_id = ? AND s.finished_at IS NOT NULL AND s.id > ? AND s.id <= ?
+"""
+
+UPSERT_RESULT = """
+INSERT INTO results (session_id, scale_id, score, interpretation) VALUES (?, ?, ?, ?)
+ON CONFLICT(session_id, scale_id) DO UPDATE SET score = excluded.score, interpretation = excluded.interpretation
+"""
+
+UPDATE_REPORT = 'UPDATE result_reports SET report_json = ? WHERE session_id = ?'
+
+SAVE_CHECKPOINT = """
+INSERT INTO rescore_checkpoints (job, test_id, last_session_id) VALUES (?, ?, ?)
+ON CONFLICT(job, test_id) DO UPDATE SET last_session_id = excluded.last_session_id, updated_at = datetime('now')
+"""
+
+
+def job_key(definition, template_field='level'):
+    key = content_hash(definition)[:16]
+    return key if template_field == 'level' else f'{key}-{template_field}'
+
+
+class Scorer:
+    """Compiled test plus the report renderer finish.ts output is rebuilt with."""
+
+    def __init__(self, definition, scale_ids, template_field='level'):
+        self.compiled = compile_test(definition)
+        self.scale_ids = scale_ids
+        self.renderer = ReportRenderer(definition, self.compiled, scale_ids, template_field=template_field)
+
+    def score_chunk(self, sessions, session_ids, orders, scores, existing, reports):
+        """Score one chunk; return (result rows, report rows, changes per scale key)."""
+        compiled = self.compiled
+        rows = np.searchsorted(sessions, session_ids)
+        cols = compiled.item_index(orders)
+        keep = cols >= 0
+        matrix = np.zeros((len(sessions), compiled.n_items), dtype=np.int64)
+        matrix[rows[keep], cols[keep]] = scores[keep]
+        batch = score_matrix(compiled, matrix)
+        # Answers to questions outside the definition still count toward the total
+        totals = np.bincount(rows, weights=scores, minlength=len(sessions)).astype(np.int64)
+
+        result_rows, report_rows, changed = [], [], Counter()
+        for i, session_id in enumerate(sessions.tolist()):
+            results = scale_results(compiled, batch, i, self.scale_ids)
+            for key, sr in zip(compiled.scale_keys, results):
+                row = (sr['score'], interpretation(sr))
+                if existing.get((session_id, sr['scale_id'])) != row:
+                    result_rows.append((session_id, sr['scale_id']) + row)
+                    changed[key] += 1
+
+            if session_id in reports:
+                report = json.loads(reports[session_id])
+                # finish.ts lists scales in whatever order its query returned
+                # them; keep the stored order so only real changes rewrite the row
+                stored = [sr.get('scale_id') for sr in report.get('scores', {}).get('scales', [])]
+                keyed = sorted(zip(compiled.scale_keys, results),
+                               key=lambda kr: stored.index(kr[1]['scale_id']) if kr[1]['scale_id'] in stored else len(stored))
+                report['scores'] = {'total': int(totals[i]), 'scales': [sr for _, sr in keyed]}
+                report['analysis'] = self.renderer.analysis(keyed)
+                text = to_json(report)
+                if text != reports[session_id]:
+                    report_rows.append((text, session_id))
+        return result_rows, report_rows, changed
+
+
+_SCORERS = {}
+
+
+def _init_worker(scorers):
+    _SCORERS.update(scorers)
+
+
+def _score(slug, *args):
+    return _SCORERS[slug].score_chunk(*args)
+
+
+def read_chunks(conn, test_id, after=0, chunk=5000, store=None, archived=None):
+    """Yield (last_id, sessions, session_ids, orders, scores, existing, reports) per chunk.
+
+    With a mindlab.compact.ReportStore, compacted reports are decoded into `reports` too.
+    Archived sessions take their answers from `archived` (mindlab.archive.ArchivedAnswers)
+    and are dropped from `sessions` when it does not hold them.
+    """
+    # mindlab.archive imports this module
+    from mindlab.archive import archived_in_range
+
+    while True:
+        sessions = np.array([r[0] for r in conn.execute(SESSION_PAGE, (test_id, after, chunk))], dtype=np.int64)
+        if not len(sessions):
+            return
+        last = int(sessions[-1])
+        params = (test_id, after, last)
+
+        answers = conn.execute(CHUNK_ANSWERS, params).fetchall()
+        data = np.array([(s, -1 if o is None else o, sc) for s, o, sc in answers], dtype=np.int64).reshape(-1, 3)
+        moved = archived_in_range(conn, params)
+        if len(moved):
+            found, *rows = archived.rows(moved) if archived else (moved[:0],) * 4
+            data = np.concatenate([data[~np.isin(data[:, 0], moved)], np.column_stack(rows).reshape(-1, 3)])
+            sessions = sessions[~np.isin(sessions, np.setdiff1d(moved, found))]
+        existing = {(s, scale): (score, interp) for s, scale, score, interp in conn.execute(CHUNK_RESULTS, params)}
+        reports = dict(conn.execute(CHUNK_REPORTS, params).fetchall())
+        if store:
+            reports.update(store.chunk(params))
+
+        yield last, sessions, data[:, 0], data[:, 1], data[:, 2], existing, reports
+        after = last
+
+
+def write_chunk(conn, job, test_id, last, result_rows, report_rows, store=None):
+    conn.execute('BEGIN')
+    try:
+        conn.executemany(UPSERT_RESULT, result_rows)
+        conn.executemany(UPDATE_REPORT, report_rows)
+        if store:
+            store.rewrite(report_rows)
+        conn.execute(SAVE_CHECKPOINT, (job, test_id, last))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def rescore(conn, definitions, workers=os.cpu_count(), chunk=5000, restart=False, progress=print, archive=None,
+            template_field='level'):
+    """Re-score every finished session of the given tests.
+
+    `archive` (mindlab.archive.Archive) supplies the answers of archived
+    sessions; without it they are skipped. `template_field` is passed to
+    ReportRenderer.
+
+    Returns {slug: {'sessions', 'results_changed': {scale key: rows}, 'reports_changed', 'seconds'}}.
+    """
+    # mindlab.compact and mindlab.archive import this module
+    from mindlab.archive import ArchivedAnswers
+    from mindlab.compact import ReportStore
+
+    conn.execute(CHECKPOINT_TABLE)
+    store = ReportStore(conn)
+    catalog = read_catalog(conn, definitions)
+    scorers = {slug: Scorer(definitions[slug], ids.scale_ids, template_field) for slug, ids in catalog.items()}
+
+    pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(scorers,)) if workers else None
+    summary = {}
+    try:
+        for slug, ids in catalog.items():
+            job = job_key(definitions[slug], template_field)
+            if restart:
+                conn.execute('DELETE FROM rescore_checkpoints WHERE job = ? AND test_id = ?', (job, ids.test_id))
+            row = conn.execute('SELECT last_session_id FROM rescore_checkpoints WHERE job = ? AND test_id = ?',
+                               (job, ids.test_id)).fetchone()
+            after = row[0] if row else 0
+            if after:
+                progress(f"{slug}: resuming after session {after}")
+
+            stats = {'sessions': 0, 'results_changed': Counter(), 'reports_changed': 0}
+            start = time.perf_counter()
+            pending = deque()
+
+            def drain(limit):
+                # Results are written in submission order so checkpoints only move forward
+                while len(pending) > limit:
+                    last, n, future = pending.popleft()
+                    result_rows, report_rows, changed = future.result() if pool else future
+                    write_chunk(conn, job, ids.test_id, last, result_rows, report_rows, store)
+                    stats['sessions'] += n
+                    stats['results_changed'].update(changed)
+                    stats['reports_changed'] += len(report_rows)
+                    elapsed = time.perf_counter() - start
+                    progress(f"{slug}: {stats['sessions']} sessions, {stats['sessions'] / elapsed:,.0f} sessions/s, "
+                             f"{sum(stats['results_changed'].values())} results and "
+                             f"{stats['reports_changed']} reports changed")
+
+            archived = ArchivedAnswers(archive, scorers[slug].compiled) if archive and archive.prune(slug) else None
+            for last, *args in read_chunks(conn, ids.test_id, after, chunk, store, archived):
+                work = pool.submit(_score, slug, *args) if pool else scorers[slug].score_chunk(*args)
+                pending.append((last, len(args[0]), work))
+                drain(2 * (workers or 0))
+            drain(0)
+
+            stats['results_changed'] = {key: stats['results_changed'][key] for key in scorers[slug].compiled.scale_keys}
+            stats['seconds'] = time.perf_counter() - start
+            summary[slug] = stats
+    finally:
+        if pool:
+            pool.shutdown()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-score stored sessions against the current definitions')
+    parser.add_argument('path')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--changed', action='store_true', help="the tests listed as changed in the pipeline manifest")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='0 scores in-process')
+    parser.add_argument('--chunk', type=int, default=5000, help='sessions per chunk')
+    parser.add_argument('--restart', action='store_true', help='ignore saved checkpoints')
+    parser.add_argument('--archive', help='mindlab.archive root holding archived answers (default build/archive)')
+    parser.add_argument('--english-templates', action='store_true',
+                        help='match templates on the English label, as compact seed --english-templates does')
+    args = parser.parse_args()
+
+    slugs = args.slugs or None
+    if args.changed:
+        slugs = pending(load_manifest(), 'rescore')
+        if not slugs:
+            print('No changed tests in the manifest')
+            return
+    definitions = load_definitions(slugs)
+
+    from mindlab.archive import ARCHIVE_DIR, Archive
+
+    conn = connect(args.path)
+    summary = rescore(conn, definitions, args.workers, args.chunk, args.restart,
+                      archive=Archive(args.archive or ARCHIVE_DIR),
+                      template_field='levelFa' if args.english_templates else 'level')
+    conn.close()
+    if args.changed:
+        clear_changed(summary, 'rescore')
+
+    print()
+    for slug, stats in summary.items():
+        rate = stats['sessions'] / max(stats['seconds'], 1e-9)
+        print(f"{slug:12s} {stats['sessions']:>8d} sessions in {stats['seconds']:6.2f}s ({rate:,.0f}/s), "
+              f"{stats['reports_changed']} reports changed")
+        for key, n in stats['results_changed'].items():
+            print(f"    {key:28s} {n:>8d} results changed")
+
+
+if __name__ == '__main__':
+    main()
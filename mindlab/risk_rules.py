@@ -0,0 +1,366 @@
+"""Risk-rule compiler with batch evaluation.
+
+finish.ts matches `risk_rules.condition_expr` with a single regex
+(`q<N>_score <op> <n>`) and an `answers.find` per rule; anything else is
+silently false, including the `q9 >= 1` form the JSON definitions use.
+Here a condition is parsed once per test into an AST and compiled into
+column lookups over a dense per-session vector [item scores..., scale
+scores...], so a rule evaluates over a whole answer matrix at once.
+
+Grammar (keywords are case-insensitive):
+
+    expr     := and_expr (('or' | '||') and_expr)*
+    and_expr := unary (('and' | '&&') unary)*
+    unary    := 'not' unary | '(' expr ')' | value OP value
+    value    := term (('+' | '-') term)*
+    term     := '-' term | NUMBER | q<N>[_score] | <scale key>[_score]
+              | sum(items) | count(items OP ['-'] NUMBER) | answered(items)
+    items    := q<N> | q<N>..q<M>, separated by commas
+    OP       := >= | > | <= | < | == | = | !=
+
+A comparison on a single unanswered item is false, as in finish.ts; sum()
+and count() treat unanswered items as 0 like SUM(a.score) does.
+
+Usage:
+    python -m mindlab.risk_rules [--sessions N] [slug ...]
+"""
+import argparse
+import re
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.definitions import load_definitions
+from mindlab.scoring import compile_test, option_matrix_scores, random_choices, score_matrix
+
+
+class RiskRuleError(ValueError):
+    pass
+
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+(?:\.\d+)?)
+      | (?P<op>>=|<=|==|!=|>|<|=)
+      | (?P<logic>&&|\|\|)
+      | (?P<range>\.\.)
+      | (?P<punct>[(),+-])
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.X)
+
+ITEM_RE = re.compile(r'q(\d+)(?:_score)?$', re.I)
+
+COMPARE = {
+    '>=': np.greater_equal, '>': np.greater,
+    '<=': np.less_equal, '<': np.less,
+    '==': np.equal, '=': np.equal, '!=': np.not_equal,
+}
+
+
+def tokenize(text):
+    tokens, pos = [], 0
+    text = text.strip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            raise RiskRuleError(f"Unexpected input at {pos}: {text[pos:pos + 10]!r}")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'name' and value.lower() in ('and', 'or', 'not'):
+            kind, value = 'logic', value.lower()
+        elif kind == 'logic':
+            value = 'and' if value == '&&' else 'or'
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+# AST nodes are tuples: ('or', a, b), ('and', a, b), ('not', a),
+# ('cmp', op, left, right), ('add', sign, left, right), ('num', x),
+# ('item', order), ('scale', key), ('sum', orders), ('count', orders, op, x),
+# ('answered', orders)
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, kind=None, value=None):
+        if self.pos >= len(self.tokens):
+            return None
+        tok = self.tokens[self.pos]
+        if (kind and tok[0] != kind) or (value and tok[1] != value):
+            return None
+        return tok
+
+    def take(self, kind=None, value=None):
+        tok = self.peek(kind, value)
+        if tok is None:
+            found = self.tokens[self.pos][1] if self.pos < len(self.tokens) else 'end of rule'
+            raise RiskRuleError(f"Expected {value or kind} but found {found!r} in {self.text!r}")
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        node = self.expr()
+        if self.pos != len(self.tokens):
+            raise RiskRuleError(f"Trailing input {self.tokens[self.pos][1]!r} in {self.text!r}")
+        return node
+
+    def expr(self):
+        node = self.and_expr()
+        while self.peek('logic', 'or'):
+            self.take()
+            node = ('or', node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.unary()
+        while self.peek('logic', 'and'):
+            self.take()
+            node = ('and', node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek('logic', 'not'):
+            self.take()
+            return ('not', self.unary())
+        if self.peek('punct', '('):
+            # Parenthesised boolean expression; arithmetic grouping is not needed
+            self.take()
+            node = self.expr()
+            self.take('punct', ')')
+            return node
+        left = self.value()
+        op = self.take('op')[1]
+        return ('cmp', op, left, self.value())
+
+    def value(self):
+        node = self.term()
+        while self.peek('punct', '+') or self.peek('punct', '-'):
+            sign = self.take()[1]
+            node = ('add', sign, node, self.term())
+        return node
+
+    def term(self):
+        if self.peek('punct', '-'):
+            self.take()
+            node = self.term()
+            return ('num', -node[1]) if node[0] == 'num' else ('add', '-', ('num', 0.0), node)
+        if self.peek('number'):
+            return ('num', float(self.take()[1]))
+        name = self.take('name')[1]
+        lowered = name.lower()
+        if lowered in ('sum', 'count', 'answered') and self.peek('punct', '('):
+            self.take()
+            orders = self.items()
+            if lowered == 'count':
+                op = self.take('op')[1]
+                threshold = self.number()
+                self.take('punct', ')')
+                return ('count', orders, op, threshold)
+            self.take('punct', ')')
+            return (lowered, orders)
+        m = ITEM_RE.match(name)
+        if m:
+            return ('item', int(m.group(1)))
+        return ('scale', name[:-6] if name.endswith('_score') else name)
+
+    def number(self):
+        if self.peek('punct', '-'):
+            self.take()
+            return -float(self.take('number')[1])
+        return float(self.take('number')[1])
+
+    def items(self):
+        orders = []
+        while True:
+            first = self.item_ref()
+            if self.peek('range'):
+                self.take()
+                last = self.item_ref()
+                if last < first:
+                    raise RiskRuleError(f"Empty item range q{first}..q{last} in {self.text!r}")
+                orders.extend(range(first, last + 1))
+            else:
+                orders.append(first)
+            if not self.peek('punct', ','):
+                return orders
+            self.take()
+
+    def item_ref(self):
+        name = self.take('name')[1]
+        m = ITEM_RE.match(name)
+        if not m:
+            raise RiskRuleError(f"Expected an item like q9, found {name!r} in {self.text!r}")
+        return int(m.group(1))
+
+
+def parse(condition):
+    return Parser(condition).parse()
+
+
+def references(node):
+    """Item orders and scale keys referenced by an AST."""
+    items, scales = set(), set()
+
+    def walk(n):
+        kind = n[0]
+        if kind == 'item':
+            items.add(n[1])
+        elif kind == 'scale':
+            scales.add(n[1])
+        elif kind in ('sum', 'count', 'answered'):
+            items.update(n[1])
+        elif kind in ('or', 'and'):
+            walk(n[1])
+            walk(n[2])
+        elif kind == 'not':
+            walk(n[1])
+        elif kind in ('cmp', 'add'):
+            walk(n[2])
+            walk(n[3])
+
+    walk(node)
+    return items, scales
+
+
+def compile_node(node, columns, n_items):
+    """Compile an AST into fn(vector, answered) -> array.
+
+    `columns` maps ('item', order) / ('scale', key) to a column of the dense
+    vector; answered has one column per item. Value nodes return
+    (values, valid) pairs, boolean nodes return a bool array.
+    """
+    kind = node[0]
+
+    def column(ref):
+        if ref not in columns:
+            label = f'q{ref[1]}' if ref[0] == 'item' else ref[1]
+            raise RiskRuleError(f"Unknown {ref[0]} {label!r}")
+        return columns[ref]
+
+    if kind == 'num':
+        x = node[1]
+        return lambda v, a: (np.full(len(v), x), np.ones(len(v), dtype=bool))
+    if kind == 'item':
+        col = column(node)
+        return lambda v, a: (v[:, col], a[:, col])
+    if kind == 'scale':
+        col = column(node)
+        return lambda v, a: (v[:, col], np.ones(len(v), dtype=bool))
+    if kind in ('sum', 'count', 'answered'):
+        cols = np.array([column(('item', order)) for order in node[1]], dtype=np.int64)
+        if kind == 'sum':
+            return lambda v, a: (v[:, cols].sum(axis=1), np.ones(len(v), dtype=bool))
+        if kind == 'answered':
+            return lambda v, a: (a[:, cols].sum(axis=1).astype(np.float64), np.ones(len(v), dtype=bool))
+        compare, threshold = COMPARE[node[2]], node[3]
+        return lambda v, a: ((compare(v[:, cols], threshold) & a[:, cols]).sum(axis=1).astype(np.float64),
+                             np.ones(len(v), dtype=bool))
+    if kind == 'add':
+        left, right = compile_node(node[2], columns, n_items), compile_node(node[3], columns, n_items)
+        sign = 1.0 if node[1] == '+' else -1.0
+
+        def add(v, a):
+            (lv, lok), (rv, rok) = left(v, a), right(v, a)
+            return lv + sign * rv, lok & rok
+        return add
+    if kind == 'cmp':
+        compare = COMPARE[node[1]]
+        left, right = compile_node(node[2], columns, n_items), compile_node(node[3], columns, n_items)
+
+        def cmp(v, a):
+            (lv, lok), (rv, rok) = left(v, a), right(v, a)
+            return compare(lv, rv) & lok & rok
+        return cmp
+    if kind == 'not':
+        inner = compile_node(node[1], columns, n_items)
+        return lambda v, a: ~inner(v, a)
+    if kind in ('and', 'or'):
+        left, right = compile_node(node[1], columns, n_items), compile_node(node[2], columns, n_items)
+        combine = np.logical_and if kind == 'and' else np.logical_or
+        return lambda v, a: combine(left(v, a), right(v, a))
+    raise RiskRuleError(f"Unknown node {kind!r}")
+
+
+@dataclass
+class CompiledRule:
+    condition: str
+    message: str
+    severity: str
+    ast: tuple
+    fn: object
+
+
+class CompiledRules:
+    """All risk rules of one test, evaluated together over a session batch."""
+
+    def __init__(self, definition, compiled=None):
+        self.compiled = compiled or compile_test(definition)
+        n_items = self.compiled.n_items
+        self.columns = {('item', int(order)): i for i, order in enumerate(self.compiled.item_orders)}
+        self.columns.update({('scale', key): n_items + j for j, key in enumerate(self.compiled.scale_keys)})
+
+        self.rules = []
+        for rule in definition.get('risk_rules', []):
+            try:
+                ast = parse(rule['condition'])
+                fn = compile_node(ast, self.columns, n_items)
+            except RiskRuleError as e:
+                raise RiskRuleError(f"{definition['slug']}: {rule['condition']!r}: {e}") from None
+            self.rules.append(CompiledRule(rule['condition'], rule['message'], rule['severity'], ast, fn))
+
+    def vector(self, scores, scale_scores):
+        """Dense per-session vector: item scores followed by scale scores."""
+        return np.hstack([np.asarray(scores, dtype=np.float64), np.asarray(scale_scores, dtype=np.float64)])
+
+    def evaluate(self, scores, answered, scale_scores=None):
+        """Boolean matrix sessions x rules."""
+        if scale_scores is None:
+            scale_scores = score_matrix(self.compiled, scores, answered).scale_scores
+        vector = self.vector(scores, scale_scores)
+        answered = np.asarray(answered, dtype=bool)
+        triggered = np.zeros((len(vector), len(self.rules)), dtype=bool)
+        for j, rule in enumerate(self.rules):
+            triggered[:, j] = rule.fn(vector, answered)
+        return triggered
+
+    def flags(self, triggered, row):
+        """RiskFlag objects of finish.ts for one evaluated row."""
+        return [{'message': rule.message, 'severity': rule.severity}
+                for j, rule in enumerate(self.rules) if triggered[row, j]]
+
+
+def compile_rules(definitions=None):
+    definitions = definitions or load_definitions()
+    return {slug: CompiledRules(d) for slug, d in definitions.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile risk rules and screen random sessions')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--sessions', type=int, default=100000)
+    args = parser.parse_args()
+
+    for slug, definition in load_definitions(args.slugs or None).items():
+        rules = CompiledRules(definition)
+        if not rules.rules:
+            continue
+        choices = random_choices(rules.compiled, args.sessions, skip_rate=0.02)
+        scores, answered = option_matrix_scores(rules.compiled, choices)
+
+        start = time.perf_counter()
+        triggered = rules.evaluate(scores, answered)
+        elapsed = time.perf_counter() - start
+
+        for j, rule in enumerate(rules.rules):
+            print(f"{slug:12s} {rule.severity:9s} {rule.condition!r}: "
+                  f"{int(triggered[:, j].sum())}/{args.sessions} flagged")
+        print(f"{'':12s} screened in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""Vectorized batch scorer for the JSON test definitions.
+
+Reproduces POST /api/sessions/finish: every answer counts toward the total,
+each scale sums the answers of the questions mapped to it in
+question_scales, and the level comes from the first cutoff (in insertion
+order) whose [min, max] range holds the scale score. Sync stores
+cutoff.labelFa in cutoffs.label and cutoff.label in cutoffs.description,
+so finish.ts reports `level` in Persian and `levelFa` in English; this
+module keeps that mapping. Reverse-keyed items need no special handling:
+their options already carry descending scores in the JSON, and answers
+store the option score as-is.
+
+Usage:
+    python -m mindlab.scoring [--sessions N] [slug ...]
+"""
+import argparse
+import random
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from mindlab.aggregates import compile_aggregation, has_aggregates
+from mindlab.definitions import load_definitions
+
+UNKNOWN_LEVEL = 'Unknown'
+
+
+@dataclass
+class CutoffBands:
+    """Cutoff table of one scale compiled for np.searchsorted.
+
+    `bounds` holds every distinct min/max. A score equal to bounds[k] takes
+    point_band[k]; a score strictly between bounds[k-1] and bounds[k] takes
+    gap_band[k]. Bands index into `levels`/`levels_fa`, -1 meaning no cutoff
+    matched. Precomputing both arrays keeps finish.ts's first-match rule
+    exact even when ranges overlap or leave gaps.
+    """
+    bounds: np.ndarray
+    point_band: np.ndarray
+    gap_band: np.ndarray
+    levels: list
+    levels_fa: list
+
+    def band(self, scores):
+        scores = np.asarray(scores, dtype=np.float64)
+        n = len(self.bounds)
+        if n == 0:
+            return np.full(scores.shape, -1, dtype=np.int32)
+        k = np.searchsorted(self.bounds, scores, side='left')
+        at = np.minimum(k, n - 1)
+        on_bound = (k < n) & (self.bounds[at] == scores)
+        return np.where(on_bound, self.point_band[at], self.gap_band[k])
+
+    def label(self, band):
+        # Mirrors `cutoff?.label || 'Unknown'` and `cutoff?.description || level`
+        if band < 0:
+            return UNKNOWN_LEVEL, UNKNOWN_LEVEL
+        level = self.levels[band] or UNKNOWN_LEVEL
+        return level, self.levels_fa[band] or level
+
+
+def compile_bands(cutoffs):
+    """Compile [{'min', 'max', 'label', 'labelFa'}, ...] in insertion order."""
+    ranges = [(c['min'], c['max']) for c in cutoffs]
+
+    def first_match(x):
+        for i, (lo, hi) in enumerate(ranges):
+            if lo <= x <= hi:
+                return i
+        return -1
+
+    bounds = sorted({v for r in ranges for v in r})
+    point_band = [first_match(b) for b in bounds]
+    gap_band = [-1]
+    gap_band += [first_match((a + b) / 2) for a, b in zip(bounds, bounds[1:])]
+    gap_band += [-1]
+
+    return CutoffBands(
+        bounds=np.array(bounds, dtype=np.float64),
+        point_band=np.array(point_band, dtype=np.int32),
+        gap_band=np.array(gap_band, dtype=np.int32),
+        levels=[c.get('labelFa') for c in cutoffs],
+        levels_fa=[c.get('label') for c in cutoffs],
+    )
+
+
+@dataclass
+class CompiledTest:
+    slug: str
+    scale_keys: list
+    scale_names: list
+    item_orders: np.ndarray
+    option_scores: np.ndarray
+    option_counts: np.ndarray
+    weights: np.ndarray
+    bands: list
+    # mindlab.aggregates.Aggregation when compiled with aggregates=True
+    aggregation: object = None
+
+    @property
+    def n_items(self):
+        return len(self.item_orders)
+
+    @property
+    def n_scales(self):
+        return len(self.scale_keys)
+
+    def item_index(self, orders):
+        """Map question order numbers to matrix columns (-1 if unknown)."""
+        lookup = np.full(int(self.item_orders.max()) + 2, -1, dtype=np.int64)
+        lookup[self.item_orders] = np.arange(self.n_items)
+        orders = np.asarray(orders, dtype=np.int64)
+        valid = (orders >= 0) & (orders < len(lookup))
+        return np.where(valid, lookup[np.where(valid, orders, 0)], -1)
+
+
+def compile_test(definition, aggregates=False):
+    """Compile one definition into a question x scale weight matrix and cutoff bands.
+
+    With aggregates=True, scales declaring an "aggregate" (see
+    mindlab.aggregates) are scored with it instead of finish.ts's SUM.
+    """
+    scales = definition['scales']
+    scale_pos = {s['key']: i for i, s in enumerate(scales)}
+    questions = definition['questions']
+
+    n_options = max((len(q['options']) for q in questions), default=0)
+    option_scores = np.zeros((len(questions), n_options), dtype=np.int64)
+    option_counts = np.zeros(len(questions), dtype=np.int64)
+    weights = np.zeros((len(questions), len(scales)), dtype=np.float64)
+
+    for i, q in enumerate(questions):
+        scores = [o['score'] for o in q['options']]
+        option_scores[i, :len(scores)] = scores
+        option_counts[i] = len(scores)
+        # Sync skips the question_scales row when scaleKey has no scale
+        if q.get('scaleKey') in scale_pos:
+            weights[i, scale_pos[q['scaleKey']]] = 1.0
+
+    cutoffs_by_scale = {s['key']: [] for s in scales}
+    for c in definition.get('cutoffs', []):
+        if c['scaleKey'] in cutoffs_by_scale:
+            cutoffs_by_scale[c['scaleKey']].append(c)
+
+    return CompiledTest(
+        slug=definition['slug'],
+        scale_keys=[s['key'] for s in scales],
+        scale_names=[s['nameFa'] for s in scales],
+        item_orders=np.array([q['order'] for q in questions], dtype=np.int64),
+        option_scores=option_scores,
+        option_counts=option_counts,
+        weights=weights,
+        bands=[compile_bands(cutoffs_by_scale[s['key']]) for s in scales],
+        aggregation=compile_aggregation(definition) if aggregates and has_aggregates(definition) else None,
+    )
+
+
+def compile_all(definitions=None, aggregates=False):
+    definitions = definitions or load_definitions()
+    return {slug: compile_test(d, aggregates) for slug, d in definitions.items()}
+
+
+def option_matrix_scores(compiled, choices):
+    """Turn a sessions x items matrix of chosen option positions into scores.
+
+    Unanswered items are -1 and score 0, exactly like a missing answers row.
+    Returns (scores, answered).
+    """
+    choices = np.asarray(choices, dtype=np.int64)
+    answered = (choices >= 0) & (choices < compiled.option_counts)
+    safe = np.where(answered, choices, 0)
+    scores = compiled.option_scores[np.arange(compiled.n_items)[None, :], safe]
+    return np.where(answered, scores, 0), answered
+
+
+def answer_matrix(compiled, session_ids, orders, scores):
+    """Pivot answer rows (session_id, question order, score) into a dense matrix.
+
+    Returns (sessions, scores, answered) where `sessions` holds the distinct
+    session ids in ascending order, one matrix row each. Rows for unknown
+    question orders are dropped.
+    """
+    session_ids = np.asarray(session_ids, dtype=np.int64)
+    cols = compiled.item_index(orders)
+    keep = cols >= 0
+    sessions, rows = np.unique(session_ids[keep], return_inverse=True)
+
+    matrix = np.zeros((len(sessions), compiled.n_items), dtype=np.int64)
+    answered = np.zeros((len(sessions), compiled.n_items), dtype=bool)
+    matrix[rows, cols[keep]] = np.asarray(scores, dtype=np.int64)[keep]
+    answered[rows, cols[keep]] = True
+    return sessions, matrix, answered
+
+
+@dataclass
+class ScoredBatch:
+    total: np.ndarray
+    scale_scores: np.ndarray
+    bands: np.ndarray
+
+
+def score_matrix(compiled, scores, answered=None):
+    """Score a sessions x items matrix in one matrix product.
+
+    Declared aggregations produce float scale scores and need `answered`
+    (all items count as answered without it).
+    """
+    scores = np.asarray(scores)
+    total = scores.sum(axis=1, dtype=np.int64)
+    if compiled.aggregation is not None:
+        if answered is None:
+            answered = np.ones(scores.shape, dtype=bool)
+        scale_scores = compiled.aggregation.apply(scores, answered)
+    else:
+        # Integer sums stay exact in float64 far beyond any instrument's range
+        scale_scores = np.rint(scores.astype(np.float64) @ compiled.weights).astype(np.int64)
+    bands = np.empty(scale_scores.shape, dtype=np.int32)
+    for j, scale_bands in enumerate(compiled.bands):
+        bands[:, j] = scale_bands.band(scale_scores[:, j])
+    return ScoredBatch(total=total, scale_scores=scale_scores, bands=bands)
+
+
+def scale_results(compiled, batch, row, scale_ids=None, norms=None):
+    """ScaleResult objects of finish.ts for one scored row.
+
+    `scale_ids` maps scale positions to database ids; without it the scale
+    key stands in for scale_id. `norms` (Norms.for_test of mindlab.norms)
+    adds a `percentile` rank to every scale that has a histogram.
+    """
+    results = []
+    for j, key in enumerate(compiled.scale_keys):
+        level, level_fa = compiled.bands[j].label(int(batch.bands[row, j]))
+        result = {
+            'scale_id': scale_ids[j] if scale_ids else key,
+            'scale_name': compiled.scale_names[j],
+            'score': score_value(batch.scale_scores[row, j]),
+            'level': level,
+            'levelFa': level_fa,
+        }
+        if norms and norms[j] is not None and norms[j].n:
+            result['percentile'] = round(norms[j].percentile(batch.scale_scores[row, j]), 1)
+        results.append(result)
+    return results
+
+
+def score_value(value):
+    """Python number for a scale score; whole numbers become int, as JSON.stringify prints them."""
+    value = value.item()
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def interpretation(result):
+    """The `results.interpretation` column written by finish.ts."""
+    return f"{result['level']}: {result['levelFa']}"
+
+
+def reference_score(definition, answers):
+    """Row-at-a-time port of finish.ts, used to cross-check the batch path.
+
+    `answers` maps question order to the stored answer score.
+    """
+    total = sum(answers.values())
+    results = []
+    for scale in definition['scales']:
+        score = sum(answers.get(q['order'], 0) for q in definition['questions']
+                    if q.get('scaleKey') == scale['key'])
+        cutoff = next((c for c in definition.get('cutoffs', [])
+                       if c['scaleKey'] == scale['key'] and c['min'] <= score <= c['max']), None)
+        level = (cutoff and cutoff.get('labelFa')) or UNKNOWN_LEVEL
+        results.append({
+            'scale_id': scale['key'],
+            'scale_name': scale['nameFa'],
+            'score': score,
+            'level': level,
+            'levelFa': (cutoff and cutoff.get('label')) or level,
+        })
+    return total, results
+
+
+def random_choices(compiled, n_sessions, skip_rate=0.0, seed=0):
+    """Random option positions for benchmarking; -1 marks a skipped item."""
+    rng = np.random.default_rng(seed)
+    choices = (rng.random((n_sessions, compiled.n_items)) * compiled.option_counts).astype(np.int64)
+    if skip_rate:
+        choices[rng.random(choices.shape) < skip_rate] = -1
+    return choices
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch-score random sessions and cross-check against finish.ts semantics')
+    parser.add_argument('slugs', nargs='*')
+    parser.add_argument('--sessions', type=int, default=100000)
+    parser.add_argument('--check', type=int, default=500, help='sessions per test verified row by row')
+    args = parser.parse_args()
+
+    definitions = load_definitions(args.slugs or None)
+    for slug, definition in definitions.items():
+        compiled = compile_test(definition)
+        choices = random_choices(compiled, args.sessions, skip_rate=0.02)
+        scores, answered = option_matrix_scores(compiled, choices)
+
+        start = time.perf_counter()
+        batch = score_matrix(compiled, scores)
+        elapsed = time.perf_counter() - start
+
+        mismatches = 0
+        for row in random.Random(0).sample(range(args.sessions), min(args.check, args.sessions)):
+            answers = {int(compiled.item_orders[i]): int(scores[row, i])
+                       for i in np.flatnonzero(answered[row])}
+            total, expected = reference_score(definition, answers)
+            if total != int(batch.total[row]) or expected != scale_results(compiled, batch, row):
+                mismatches += 1
+
+        rows = int(answered.sum())
+        print(f"{slug:12s} {rows:>10d} answers in {elapsed * 1000:8.1f} ms "
+              f"({rows / max(elapsed, 1e-9) / 1e6:6.1f}M rows/s), mismatches: {mismatches}")
+
+
+if __name__ == '__main__':
+    main()
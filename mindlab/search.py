@@ -0,0 +1,304 @@
+"""Full-text search over the bilingual test catalog.
+
+The admin pages and the maintenance scripts find a question by scanning
+whole JSON files. update_scl90.py overwrites items by position, for
+example, and fix_tests.py matches scale keys by hand. This indexer puts
+every catalog text into an SQLite FTS5 index under build/search.db:
+
+    test       name, nameFa, description(Fa), categoryFa, warning
+    scale      name, nameFa
+    question   text                     located by order and scaleKey
+    option     text                     question order and option position
+    cutoff     label, labelFa           scaleKey and min-max
+    template   title, summary, details, recommendations, disclaimer
+    risk       message
+
+Persian text is normalized before indexing and before querying:
+
+- Arabic yeh/alef maksura and kaf become Persian ی and ک.
+- Hamza-carrying alefs become ا.
+- Persian and Arabic digits become ASCII.
+- Harakat and tatweel are dropped.
+
+The tokenizer splits on a zero-width non-joiner. A word written with
+ZWNJ (می‌کنم) is therefore indexed split, and joined in a second column,
+so "می کنم", "می‌کنم" and "میکنم" all find it.
+
+Updates are incremental. Each definition's sections are hashed with
+mindlab.pipeline.section_hashes. Only sections whose hash differs from
+the one stored in the index are re-indexed, and deleted tests are
+dropped.
+
+Query terms are ANDed prefix matches unless --raw passes an FTS5
+expression through. Results are ranked by bm25.
+
+Usage:
+    python -m mindlab.search index [--rebuild]
+    python -m mindlab.search query "آرامش" [--kind question] [--slug stai] [--lang fa] [--limit 20] [--json]
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from dataclasses import asdict, dataclass
+
+from mindlab.definitions import ROOT_DIR, definition_slugs, load_definition
+from mindlab.pipeline import section_hashes
+
+INDEX_PATH = os.path.join(ROOT_DIR, 'build', 'search.db')
+# Bump when normalization or the entry layout changes; the index is rebuilt
+INDEX_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  id INTEGER PRIMARY KEY,
+  slug TEXT NOT NULL,
+  section TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  item INTEGER,
+  option INTEGER,
+  scale TEXT,
+  label TEXT,
+  field TEXT NOT NULL,
+  lang TEXT NOT NULL,
+  text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_entries_section ON entries(slug, section);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(body, joined, tokenize = 'unicode61 remove_diacritics 2');
+CREATE TABLE IF NOT EXISTS indexed_sections (
+  slug TEXT NOT NULL,
+  section TEXT NOT NULL,
+  hash TEXT NOT NULL,
+  PRIMARY KEY (slug, section)
+);
+"""
+
+SEARCH = """
+SELECT e.slug, e.kind, e.item, e.option, e.scale, e.label, e.field, e.lang, e.text,
+       snippet(entries_fts, 0, '[', ']', '…', 10), bm25(entries_fts)
+FROM entries_fts
+JOIN entries e ON e.id = entries_fts.rowid
+WHERE entries_fts MATCH ?{filters}
+ORDER BY bm25(entries_fts)
+LIMIT ?
+"""
+INSERT_ENTRY = """
+INSERT INTO entries (slug, section, kind, item, option, scale, label, field, lang, text)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+ZWNJ = '‌'
+CHARACTER_MAP = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ك': 'ک',
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه', 'ۀ': 'ه', 'ؤ': 'و',
+    **{chr(0x06f0 + d): str(d) for d in range(10)},
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+    'ـ': None, '‍': None, '‎': None, '‏': None,
+    **{chr(c): None for c in range(0x064b, 0x0660)}, 'ٰ': None,
+})
+PERSIAN_RE = re.compile('[؀-ۿ]')
+JOINED_RE = re.compile(rf'\w+(?:{ZWNJ}\w+)+')
+
+# Text fields of the definition and of each analysis template
+TEST_FIELDS = ('name', 'nameFa', 'description', 'descriptionFa', 'categoryFa', 'warning')
+TEMPLATE_FIELDS = ('title', 'summary', 'details', 'recommendations', 'disclaimer')
+
+
+def normalize(text):
+    """Persian-normalized text with ZWNJ as a word break."""
+    return text.translate(CHARACTER_MAP).replace(ZWNJ, ' ')
+
+
+def index_columns(text):
+    """(normalized text, ZWNJ-joined forms of its compound words)"""
+    text = text.translate(CHARACTER_MAP)
+    return text.replace(ZWNJ, ' '), ' '.join(w.replace(ZWNJ, '') for w in JOINED_RE.findall(text))
+
+
+def language(text):
+    return 'fa' if PERSIAN_RE.search(text) else 'en'
+
+
+def section_entries(definition, section):
+    """Yield (kind, item, option, scale, label, field, text) for one hashed section."""
+    if section == 'meta':
+        for field in TEST_FIELDS:
+            yield 'test', None, None, None, None, field, definition.get(field)
+    elif section == 'scales':
+        for scale in definition.get('scales', []):
+            for field in ('name', 'nameFa'):
+                yield 'scale', None, None, scale['key'], None, field, scale.get(field)
+    elif section == 'questions':
+        for q in definition.get('questions', []):
+            yield 'question', q['order'], None, q.get('scaleKey'), None, 'text', q.get('text')
+            for i, option in enumerate(q.get('options', []), 1):
+                yield 'option', q['order'], i, q.get('scaleKey'), None, 'text', option.get('text')
+    elif section == 'cutoffs':
+        for c in definition.get('cutoffs', []):
+            for field in ('label', 'labelFa'):
+                yield 'cutoff', None, None, c['scaleKey'], f"{c['min']}-{c['max']}", field, c.get(field)
+    elif section == 'analysis_templates':
+        for t in definition.get('analysis_templates', []):
+            for field in TEMPLATE_FIELDS:
+                yield 'template', None, None, t.get('scaleKey'), t.get('level_label'), field, t.get(field)
+    elif section == 'risk_rules':
+        for r in definition.get('risk_rules', []):
+            yield 'risk', None, None, None, r.get('condition'), 'message', r.get('message')
+
+
+def connect_index(path=INDEX_PATH):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, isolation_level=None)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != INDEX_VERSION:
+        conn.executescript('DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS entries_fts; '
+                           'DROP TABLE IF EXISTS indexed_sections;')
+        conn.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _drop(conn, slug, section=None):
+    where, params = ('slug = ? AND section = ?', (slug, section)) if section else ('slug = ?', (slug,))
+    conn.execute(f'DELETE FROM entries_fts WHERE rowid IN (SELECT id FROM entries WHERE {where})', params)
+    conn.execute(f'DELETE FROM entries WHERE {where}', params)
+    conn.execute(f'DELETE FROM indexed_sections WHERE {where}', params)
+
+
+def update(conn, slugs=None, rebuild=False):
+    """Re-index the sections whose content hash changed; returns {slug: [sections]} re-indexed.
+
+    `slugs` limits which tests are re-indexed; only tests whose definition
+    file is gone are dropped from the index.
+    """
+    existing = definition_slugs()
+    slugs = slugs or existing
+    stored = {}
+    for slug, section, digest in conn.execute('SELECT slug, section, hash FROM indexed_sections'):
+        stored.setdefault(slug, {})[section] = digest
+    changed = {}
+    conn.execute('BEGIN')
+    try:
+        if rebuild:
+            conn.execute('DELETE FROM entries_fts')
+            conn.execute('DELETE FROM entries')
+            conn.execute('DELETE FROM indexed_sections')
+            stored = {}
+        for slug in set(stored) - set(existing):
+            _drop(conn, slug)
+            changed[slug] = ['deleted']
+        for slug in slugs:
+            definition = load_definition(slug)
+            for section, digest in section_hashes(definition).items():
+                if stored.get(slug, {}).get(section) == digest:
+                    continue
+                _drop(conn, slug, section)
+                for kind, item, option, scale, label, field, text in section_entries(definition, section):
+                    if not text:
+                        continue
+                    cursor = conn.execute(INSERT_ENTRY, (slug, section, kind, item, option, scale, label, field,
+                                                         language(text), text))
+                    conn.execute('INSERT INTO entries_fts (rowid, body, joined) VALUES (?, ?, ?)',
+                                 (cursor.lastrowid, *index_columns(text)))
+                conn.execute('INSERT INTO indexed_sections (slug, section, hash) VALUES (?, ?, ?)',
+                             (slug, section, digest))
+                changed.setdefault(slug, []).append(section)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    if changed:
+        conn.execute("INSERT INTO entries_fts (entries_fts) VALUES ('optimize')")
+    return changed
+
+
+@dataclass
+class Match:
+    slug: str
+    kind: str
+    item: int
+    option: int
+    scale: str
+    label: str
+    field: str
+    lang: str
+    text: str
+    snippet: str
+    rank: float
+
+    @property
+    def location(self):
+        parts = [self.slug]
+        if self.item is not None:
+            parts.append(f'q{self.item}' + (f' option {self.option}' if self.option else ''))
+        if self.scale:
+            parts.append(f'[{self.scale}]')
+        if self.label:
+            parts.append(self.label)
+        return ' '.join(parts) + f' {self.kind}.{self.field}'
+
+
+def fts_query(text):
+    """AND of prefix terms over the normalized query words."""
+    words = normalize(text).split()
+    return ' '.join('"' + w.replace('"', '""') + '"*' for w in words)
+
+
+def search(conn, query, kind=None, slug=None, lang=None, limit=20, raw=False):
+    """[Match] for a query, best first."""
+    expression = query if raw else fts_query(query)
+    if not expression:
+        return []
+    filters, params = '', [expression]
+    for column, value in (('kind', kind), ('slug', slug), ('lang', lang)):
+        if value:
+            filters += f' AND e.{column} = ?'
+            params.append(value)
+    rows = conn.execute(SEARCH.format(filters=filters), params + [limit]).fetchall()
+    return [Match(*row) for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Full-text search over the test catalog')
+    parser.add_argument('--db', default=INDEX_PATH)
+    sub = parser.add_subparsers(dest='command', required=True)
+    i = sub.add_parser('index', help='update the index from the JSON definitions')
+    i.add_argument('--rebuild', action='store_true')
+    q = sub.add_parser('query', help='search the catalog')
+    q.add_argument('query')
+    q.add_argument('--kind', choices=('test', 'scale', 'question', 'option', 'cutoff', 'template', 'risk'))
+    q.add_argument('--slug')
+    q.add_argument('--lang', choices=('fa', 'en'))
+    q.add_argument('--limit', type=int, default=20)
+    q.add_argument('--raw', action='store_true', help='pass the query through as an FTS5 expression')
+    q.add_argument('--json', action='store_true')
+    q.add_argument('--no-update', action='store_true', help='skip the incremental update before searching')
+    args = parser.parse_args()
+
+    conn = connect_index(args.db)
+    if args.command == 'index' or not args.no_update:
+        start = time.perf_counter()
+        changed = update(conn, rebuild=args.command == 'index' and args.rebuild)
+        elapsed = (time.perf_counter() - start) * 1000
+        if args.command == 'index':
+            for slug, sections in changed.items():
+                print(f"{slug:14s} {', '.join(sections)}")
+            entries = conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            print(f"{entries} entries, {sum(map(len, changed.values()))} sections re-indexed in {elapsed:.1f}ms")
+    if args.command == 'query':
+        start = time.perf_counter()
+        matches = search(conn, args.query, args.kind, args.slug, args.lang, args.limit, args.raw)
+        elapsed = (time.perf_counter() - start) * 1000
+        if args.json:
+            print(json.dumps([{**asdict(m), 'location': m.location} for m in matches], ensure_ascii=False, indent=1))
+        else:
+            for m in matches:
+                print(f"{m.location:48s} {m.snippet}")
+            print(f"{len(matches)} matches in {elapsed:.2f}ms")
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,704 @@
+"""User-hash sharding of the session tables over several SQLite databases.
+
+The catalog (tests, scales, questions, options, cutoffs, templates, risk
+rules) is a few hundred kilobytes. The per-user tables (sessions,
+answers, results, result_reports, ai_analyses, user_profiles) grow without
+bound. Every shard therefore holds a full copy of the catalog, with the
+ids preserved, so joins to it stay local. A user's rows live on exactly
+one shard.
+
+Users map to one of BUCKETS hash buckets (crc32 of user_uid), and buckets
+map to shards in directory.db next to the shard files:
+
+    buckets(bucket, shard, target, watermark)   the routing table
+    shards(id, path)
+    sequences(name, next)                       global session ids
+
+The handlers run unchanged. `Router.call(uid, handler, ...)` hands them a
+D1 wrapper on the user's shard. Session ids must stay unique across
+shards because they move with their user. The wrapper therefore replaces
+the AUTOINCREMENT insert of sessions/start with an id reserved from the
+directory in blocks. Child rows (answers, results, ...) keep
+shard-local ids.
+
+Admin aggregates are scatter-gather: the same GROUP BY runs on every
+shard in parallel, and the partial rows are merged per key (sum, min,
+max). COUNT(DISTINCT user_uid) also merges by sum, because a user lives
+on one shard.
+
+The rebalancer moves whole buckets online, in batches of users taken in
+user_uid order. A moving bucket has a `target` and a `watermark`. Users
+at or below the watermark are already served by the target. Per batch:
+
+    BEGIN IMMEDIATE on the source      blocks writers of the source shard
+    copy the batch's rows to the target (INSERT OR REPLACE, idempotent)
+    raise the watermark in the directory
+    delete the batch on the source and COMMIT
+
+A writer re-checks its route once it holds the shard's write lock and
+retries on the new shard when the bucket moved meanwhile. A crash leaves
+either unrouted copies on the target, which the retry overwrites, or
+rows on the source below the watermark, which `resume` deletes.
+
+Usage:
+    python -m mindlab.shards split local.db [--shards 4] [--root build/shards]
+    python -m mindlab.shards stats [--check local.db]
+    python -m mindlab.shards route <user_uid> ...
+    python -m mindlab.shards add-shard
+    python -m mindlab.shards rebalance [--batch 200] [--traffic 2]
+    python -m mindlab.shards check
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from mindlab import handlers
+from mindlab import statements as sql
+from mindlab.compact import RESTORE_REPORTS, ReportStore
+from mindlab.d1 import LocalD1, Meta
+from mindlab.definitions import ROOT_DIR
+from mindlab.localdb import apply_migrations, connect, remove_database
+from mindlab.transfer import CATALOG_TABLES, SESSION_TABLES, export_tables, table_columns
+
+SHARD_DIR = os.path.join(ROOT_DIR, 'build', 'shards')
+DIRECTORY_NAME = 'directory.db'
+BUCKETS = 256
+SESSION_ID_BLOCK = 1000
+BATCH_USERS = 200
+
+CHILD_TABLES = ('answers', 'results', 'result_reports', 'ai_analyses')
+
+DIRECTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, path TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS buckets (
+  bucket INTEGER PRIMARY KEY,
+  shard INTEGER NOT NULL REFERENCES shards(id),
+  target INTEGER REFERENCES shards(id),
+  watermark TEXT
+);
+CREATE TABLE IF NOT EXISTS sequences (name TEXT PRIMARY KEY, next INTEGER NOT NULL);
+"""
+
+SHARD_INSERT_SESSION = 'INSERT INTO sessions (id, test_id, user_uid) VALUES (?, ?, ?)'
+ANSWER_EXISTS = 'SELECT 1 FROM answers WHERE session_id = ? AND question_id = ?'
+RESERVE_IDS = 'UPDATE sequences SET next = next + ? WHERE name = ? RETURNING next'
+
+# Users of a set of buckets in (after, upto], in user_uid order, from both
+# per-user tables so users with only a profile move too. Both reads walk
+# an index from `after`.
+MOVE_USERS = """
+SELECT user_uid FROM (
+  SELECT user_uid FROM (SELECT DISTINCT user_uid FROM sessions WHERE user_uid > ?1 AND user_uid <= ?2
+                        AND shard_bucket(user_uid) IN ({buckets}) ORDER BY user_uid LIMIT ?3)
+  UNION
+  SELECT user_uid FROM (SELECT user_uid FROM user_profiles WHERE user_uid > ?1 AND user_uid <= ?2
+                        AND shard_bucket(user_uid) IN ({buckets}) ORDER BY user_uid LIMIT ?3)
+) ORDER BY user_uid LIMIT ?3
+"""
+
+# Scatter-gather admin aggregates: (statement, merge per column).
+# 'key' columns group; the others combine with sum/min/max.
+AGGREGATES = {
+    'tests': ("""
+        SELECT t.slug, COUNT(*), SUM(s.finished_at IS NOT NULL), COUNT(DISTINCT s.user_uid)
+        FROM sessions s JOIN tests t ON t.id = s.test_id
+        GROUP BY t.slug
+    """, ('key', 'sum', 'sum', 'sum')),
+    'scales': ("""
+        SELECT r.scale_id, COUNT(*), SUM(r.score), SUM(r.score * r.score), MIN(r.score), MAX(r.score)
+        FROM results r
+        GROUP BY r.scale_id
+    """, ('key', 'sum', 'sum', 'sum', 'min', 'max')),
+    'levels': ("""
+        SELECT sc.test_id, r.interpretation, COUNT(*)
+        FROM results r JOIN scales sc ON sc.id = r.scale_id
+        GROUP BY sc.test_id, r.interpretation
+    """, ('key', 'key', 'sum')),
+    'daily': ("""
+        SELECT substr(finished_at, 1, 10), COUNT(*), COUNT(DISTINCT user_uid)
+        FROM sessions WHERE finished_at IS NOT NULL
+        GROUP BY 1
+    """, ('key', 'sum', 'sum')),
+}
+
+MERGE = {'sum': lambda a, b: (a or 0) + (b or 0), 'min': min, 'max': max}
+
+
+def bucket_of(uid):
+    return zlib.crc32(uid.encode('utf-8')) % BUCKETS
+
+
+def connect_shard(path, check_same_thread=True):
+    conn = connect(path, check_same_thread=check_same_thread)
+    conn.create_function('shard_bucket', 1, bucket_of, deterministic=True)
+    return conn
+
+
+def merge(parts, ops):
+    """Combine partial GROUP BY rows from several shards, sorted by key."""
+    keys = [i for i, op in enumerate(ops) if op == 'key']
+    merged = {}
+    for rows in parts:
+        for row in rows:
+            key = tuple(row[i] for i in keys)
+            if key not in merged:
+                merged[key] = list(row)
+                continue
+            current = merged[key]
+            for i, op in enumerate(ops):
+                if op != 'key' and row[i] is not None:
+                    current[i] = row[i] if current[i] is None else MERGE[op](current[i], row[i])
+    return [tuple(merged[k]) for k in sorted(merged, key=lambda k: tuple((v is None, v) for v in k))]
+
+
+def copy_rows(source, target, table, where, params, keep_id=True):
+    """INSERT OR REPLACE the rows of `table` matching `where` from source into target."""
+    columns = [name for name, _ in table_columns(source, table)]
+    present = {name for name, _ in table_columns(target, table)}
+    names = [c for c in columns if c in present and (keep_id or c != 'id')]
+    rows = source.execute(f"SELECT {', '.join(names)} FROM {table} WHERE {where}", params).fetchall()
+    if rows:
+        target.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(names)}) "
+                           f"VALUES ({', '.join('?' * len(names))})", rows)
+    return len(rows)
+
+
+def copy_compact_reports(source, target, where, params):
+    """Decode compacted reports of the source into the target's result_reports; the target compacts anew."""
+    store = ReportStore(source)
+    if not store.enabled:
+        return 0
+    rows = [(s, store.decode(d, c, body), created) for s, d, c, body, created in source.execute(
+        f'SELECT session_id, dictionary_id, codec, body, created_at FROM compact_reports WHERE {where}', params)]
+    target.executemany(RESTORE_REPORTS, rows)
+    return len(rows)
+
+
+def replicate_catalog(source, targets):
+    """Replace the catalog tables of every target with the source's, ids preserved."""
+    tables = [t for t in CATALOG_TABLES if table_columns(source, t)]
+    data = {t: (columns, [r for rows in batches for r in rows]) for t, columns, batches in export_tables(source, tables)}
+    for conn in targets:
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.execute('BEGIN')
+        try:
+            for table in reversed(tables):
+                conn.execute(f'DELETE FROM {table}')
+            for table in tables:
+                columns, rows = data[table]
+                names = [name for name, _ in columns]
+                conn.executemany(f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", rows)
+            for table in tables:
+                problems = conn.execute(f'PRAGMA foreign_key_check({table})').fetchall()
+                if problems:
+                    raise ValueError(f'{table}: {len(problems)} rows violate foreign keys, e.g. {problems[0]}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.execute('PRAGMA foreign_keys = ON')
+    return {t: len(data[t][1]) for t in tables}
+
+
+def create_shard(path, catalog_source):
+    remove_database(path)
+    conn = connect_shard(path)
+    apply_migrations(conn)
+    replicate_catalog(catalog_source, [conn])
+    return conn
+
+
+class Directory:
+    """The bucket -> shard map, reloaded whenever another connection commits to it."""
+
+    def __init__(self, root=SHARD_DIR):
+        self.root = root
+        self.conn = connect(os.path.join(root, DIRECTORY_NAME), check_same_thread=False)
+        self.conn.executescript(DIRECTORY_SCHEMA)
+        self.version = None
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+            if version == self.version:
+                return
+            self.version = version
+            self.shards = dict(self.conn.execute('SELECT id, path FROM shards ORDER BY id'))
+            self.buckets = [None] * BUCKETS
+            for bucket, shard, target, watermark in self.conn.execute('SELECT bucket, shard, target, watermark FROM buckets'):
+                self.buckets[bucket] = (shard, target, watermark)
+
+    def write(self, statement, params=()):
+        """Update the map; data_version ignores this connection's own commits, so reload on the next read."""
+        with self.lock:
+            self.conn.execute(statement, params)
+            self.version = None
+
+    def route(self, uid):
+        self.refresh()
+        shard, target, watermark = self.buckets[bucket_of(uid)]
+        if target is not None and watermark is not None and uid <= watermark:
+            return target
+        return shard
+
+    def path(self, shard):
+        return os.path.join(self.root, self.shards[shard])
+
+    def reserve(self, name, n):
+        """Reserve n ids; returns the first."""
+        with self.lock:
+            return self.conn.execute(RESERVE_IDS, (n, name)).fetchone()[0] - n
+
+    def moving(self):
+        """{(source, target): (buckets, watermark)} of unfinished bucket moves."""
+        self.refresh()
+        out = {}
+        for bucket, (shard, target, watermark) in enumerate(self.buckets):
+            if target is not None:
+                out.setdefault((shard, target), ([], watermark))[0].append(bucket)
+        return out
+
+
+class ShardD1(LocalD1):
+    """LocalD1 on one shard, with sessions/start's insert given a global id."""
+
+    def __init__(self, conn, router):
+        super().__init__(conn)
+        self.router = router
+
+    def run(self, statement, *params):
+        if statement == sql.START_INSERT_SESSION:
+            session_id = self.router.new_session_id()
+            return Meta(session_id, super().run(SHARD_INSERT_SESSION, session_id, *params).changes)
+        return super().run(statement, *params)
+
+    def batch(self, statements):
+        if not self.conn.in_transaction:
+            return super().batch(statements)
+        # Router.call already holds the shard's write transaction
+        self.conn.execute('SAVEPOINT batch')
+        try:
+            metas = [self.run(s, *params) for s, params in statements]
+            self.conn.execute('RELEASE batch')
+        except Exception:
+            self.conn.execute('ROLLBACK TO batch')
+            self.conn.execute('RELEASE batch')
+            raise
+        return metas
+
+
+class Router:
+    """Routes handler calls by user_uid and scatters admin aggregates over every shard."""
+
+    def __init__(self, root=SHARD_DIR):
+        self.directory = Directory(root)
+        self.conns = {}
+        self.readers = {}
+        self.ids = (0, 0)
+        self.id_lock = threading.Lock()
+
+    def conn(self, shard):
+        if shard not in self.conns:
+            self.conns[shard] = connect_shard(self.directory.path(shard))
+        return self.conns[shard]
+
+    def shard_of(self, uid):
+        return self.directory.route(uid)
+
+    def db(self, uid):
+        return ShardD1(self.conn(self.shard_of(uid)), self)
+
+    def new_session_id(self):
+        with self.id_lock:
+            next_id, end = self.ids
+            if next_id >= end:
+                next_id = self.directory.reserve('sessions', SESSION_ID_BLOCK)
+                end = next_id + SESSION_ID_BLOCK
+            self.ids = (next_id + 1, end)
+            return next_id
+
+    def call(self, uid, handler, *args, write=False):
+        """handler(db, uid, *args) on the user's shard.
+
+        Writes run in one IMMEDIATE transaction, entered only once the
+        route is re-checked under the shard's write lock. Reads re-run
+        when the user moved while they ran.
+        """
+        while True:
+            shard = self.shard_of(uid)
+            db = ShardD1(self.conn(shard), self)
+            if not write:
+                result = handler(db, uid, *args)
+                if self.shard_of(uid) == shard:
+                    return result
+                continue
+            db.conn.execute('BEGIN IMMEDIATE')
+            try:
+                if self.shard_of(uid) != shard:
+                    db.conn.execute('ROLLBACK')
+                    continue
+                result = handler(db, uid, *args)
+                db.conn.execute('COMMIT')
+                return result
+            except Exception:
+                if db.conn.in_transaction:
+                    db.conn.execute('ROLLBACK')
+                raise
+
+    def gather(self, statement, ops, params=()):
+        """Run statement on every shard in parallel and merge the partial rows."""
+        self.directory.refresh()
+        shards = list(self.directory.shards)
+        for shard in shards:
+            if shard not in self.readers:
+                self.readers[shard] = connect_shard(self.directory.path(shard), check_same_thread=False)
+        with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+            parts = list(pool.map(lambda s: self.readers[s].execute(statement, params).fetchall(), shards))
+        return merge(parts, ops)
+
+    def close(self):
+        for conn in list(self.conns.values()) + list(self.readers.values()):
+            conn.close()
+        self.directory.conn.close()
+
+
+def split(source, root=SHARD_DIR, n_shards=4):
+    """Spread an existing database over n_shards new shards. Returns {table: rows} copied."""
+    os.makedirs(root, exist_ok=True)
+    remove_database(os.path.join(root, DIRECTORY_NAME))
+    shards = [create_shard(os.path.join(root, f'shard-{i:02d}.db'), source) for i in range(n_shards)]
+    owner = [b % n_shards for b in range(BUCKETS)]
+    session_shard, counts = {}, {}
+    for conn in shards:
+        conn.execute('PRAGMA foreign_keys = OFF')
+        conn.execute('BEGIN')
+    try:
+        for table, columns, batches in export_tables(source, SESSION_TABLES):
+            names = [name for name, _ in columns]
+            statement = f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+            uid_at = names.index('user_uid') if 'user_uid' in names else None
+            session_at = names.index('session_id') if 'session_id' in names else None
+            counts[table] = 0
+            for rows in batches:
+                per_shard = [[] for _ in shards]
+                for row in rows:
+                    if uid_at is not None:
+                        shard = owner[bucket_of(row[uid_at])]
+                        if table == 'sessions':
+                            session_shard[row[0]] = shard
+                    else:
+                        shard = session_shard.get(row[session_at])
+                        if shard is None:
+                            continue  # orphan of a deleted session
+                    per_shard[shard].append(row)
+                for conn, part in zip(shards, per_shard):
+                    conn.executemany(statement, part)
+                    counts[table] += len(part)
+        store = ReportStore(source)
+        if store.enabled:
+            for session_id, d, c, body, created in source.execute(
+                    'SELECT session_id, dictionary_id, codec, body, created_at FROM compact_reports'):
+                shard = session_shard.get(session_id)
+                if shard is not None:
+                    shards[shard].execute(RESTORE_REPORTS, (session_id, store.decode(d, c, body), created))
+                    counts['result_reports'] += 1
+        for conn in shards:
+            conn.execute('COMMIT')
+    except Exception:
+        for conn in shards:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        raise
+    for conn in shards:
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('ANALYZE')
+        conn.close()
+
+    directory = connect(os.path.join(root, DIRECTORY_NAME))
+    directory.executescript(DIRECTORY_SCHEMA)
+    directory.execute('BEGIN')
+    directory.executemany('INSERT INTO shards (id, path) VALUES (?, ?)',
+                          [(i, f'shard-{i:02d}.db') for i in range(n_shards)])
+    directory.executemany('INSERT INTO buckets (bucket, shard) VALUES (?, ?)', list(enumerate(owner)))
+    next_session = source.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM sessions').fetchone()[0]
+    directory.execute("INSERT INTO sequences (name, next) VALUES ('sessions', ?)", (next_session,))
+    directory.execute('COMMIT')
+    directory.close()
+    return counts
+
+
+def add_shard(root=SHARD_DIR):
+    """Create an empty shard holding the catalog of shard 0; returns its id."""
+    directory = Directory(root)
+    shard = max(directory.shards) + 1
+    name = f'shard-{shard:02d}.db'
+    source = connect_shard(directory.path(min(directory.shards)))
+    create_shard(os.path.join(root, name), source).close()
+    source.close()
+    directory.conn.execute('INSERT INTO shards (id, path) VALUES (?, ?)', (shard, name))
+    directory.conn.close()
+    return shard
+
+
+class Rebalancer:
+    """Moves buckets between shards, BATCH_USERS users per source transaction."""
+
+    def __init__(self, root=SHARD_DIR, batch=BATCH_USERS):
+        self.directory = Directory(root)
+        self.batch = batch
+        self.conns = {}
+        self.moved = {'users': 0}
+
+    def conn(self, shard):
+        if shard not in self.conns:
+            self.conns[shard] = connect_shard(self.directory.path(shard))
+        return self.conns[shard]
+
+    def plan(self):
+        """Bucket moves evening out buckets per shard with the fewest moves; {bucket: target}."""
+        self.directory.refresh()
+        owned = {s: [] for s in self.directory.shards}
+        for bucket, (shard, target, _) in enumerate(self.directory.buckets):
+            owned[target if target is not None else shard].append(bucket)
+        moves = {}
+        while True:
+            big = max(owned, key=lambda s: len(owned[s]))
+            small = min(owned, key=lambda s: len(owned[s]))
+            if len(owned[big]) - len(owned[small]) <= 1:
+                return moves
+            bucket = owned[big].pop()
+            owned[small].append(bucket)
+            moves[bucket] = small
+
+    def start(self, moves):
+        conn = self.directory.conn
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany("UPDATE buckets SET target = ?, watermark = '' WHERE bucket = ? AND target IS NULL",
+                         [(target, bucket) for bucket, target in moves.items()])
+        conn.execute('COMMIT')
+        self.directory.version = None
+
+    def _users(self, conn, buckets, after, upto):
+        statement = MOVE_USERS.format(buckets=','.join(str(b) for b in buckets))
+        return [r[0] for r in conn.execute(statement, (after, upto, self.batch))]
+
+    def _delete(self, conn, users):
+        marks = ','.join('?' * len(users))
+        sessions = f'SELECT id FROM sessions WHERE user_uid IN ({marks})'
+        for table in CHILD_TABLES + (('compact_reports',) if ReportStore(conn).enabled else ()):
+            conn.execute(f'DELETE FROM {table} WHERE session_id IN ({sessions})', users)
+        conn.execute(f'DELETE FROM sessions WHERE user_uid IN ({marks})', users)
+        conn.execute(f'DELETE FROM user_profiles WHERE user_uid IN ({marks})', users)
+
+    def resume(self, source, buckets, watermark):
+        """Delete source rows left below the watermark by an interrupted batch."""
+        conn = self.conn(source)
+        while watermark and (users := self._users(conn, buckets, '', watermark)):
+            conn.execute('BEGIN IMMEDIATE')
+            self._delete(conn, users)
+            conn.execute('COMMIT')
+
+    def step(self, source, target, buckets, watermark):
+        """Move the next batch of users; returns the new watermark, or None when done."""
+        src, dst = self.conn(source), self.conn(target)
+        src.execute('BEGIN IMMEDIATE')
+        try:
+            users = self._users(src, buckets, watermark, '\U0010ffff')
+            if not users:
+                src.execute('ROLLBACK')
+                return None
+            marks = ','.join('?' * len(users))
+            sessions = f'SELECT id FROM sessions WHERE user_uid IN ({marks})'
+            dst.execute('PRAGMA foreign_keys = OFF')
+            dst.execute('BEGIN IMMEDIATE')
+            try:
+                copy_rows(src, dst, 'user_profiles', f'user_uid IN ({marks})', users)
+                # REPLACE of a session already copied by a failed attempt
+                # drops its stale children before they are copied again
+                for session_id, in src.execute(sessions, users):
+                    for table in CHILD_TABLES:
+                        dst.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+                copy_rows(src, dst, 'sessions', f'user_uid IN ({marks})', users)
+                for table in CHILD_TABLES:
+                    copy_rows(src, dst, table, f'session_id IN ({sessions})', users, keep_id=False)
+                copy_compact_reports(src, dst, f'session_id IN ({sessions})', users)
+                dst.execute('COMMIT')
+            except Exception:
+                dst.execute('ROLLBACK')
+                raise
+            finally:
+                dst.execute('PRAGMA foreign_keys = ON')
+            self.directory.write('UPDATE buckets SET watermark = ? WHERE bucket IN ({})'.format(
+                ','.join(str(b) for b in buckets)), (users[-1],))
+            self._delete(src, users)
+            src.execute('COMMIT')
+        except Exception:
+            if src.in_transaction:
+                src.execute('ROLLBACK')
+            raise
+        self.moved['users'] += len(users)
+        return users[-1]
+
+    def run(self, progress=None):
+        """Finish every pending move."""
+        for (source, target), (buckets, watermark) in self.directory.moving().items():
+            self.resume(source, buckets, watermark)
+            while (next_mark := self.step(source, target, buckets, watermark)) is not None:
+                watermark = next_mark
+                if progress:
+                    progress(source, target, self.moved['users'])
+            self.directory.write(
+                'UPDATE buckets SET shard = target, target = NULL, watermark = NULL WHERE bucket IN ({})'.format(
+                    ','.join(str(b) for b in buckets)))
+        for conn in self.conns.values():
+            conn.execute('ANALYZE')
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+        self.directory.conn.close()
+
+
+def misplaced(router):
+    """Users with rows on a shard that does not route to them; {shard: count}."""
+    out = {}
+    for shard in router.directory.shards:
+        users = router.conn(shard).execute(
+            'SELECT user_uid FROM sessions UNION SELECT user_uid FROM user_profiles').fetchall()
+        out[shard] = sum(router.shard_of(u) != shard for u, in users)
+    return out
+
+
+def shard_sizes(router):
+    return {shard: router.conn(shard).execute(
+        'SELECT (SELECT COUNT(*) FROM sessions), (SELECT COUNT(*) FROM answers), '
+        '(SELECT COUNT(DISTINCT user_uid) FROM sessions)').fetchone() for shard in router.directory.shards}
+
+
+def traffic(root, stop, users, test_ids, created, errors):
+    """Start a session and answer one question per iteration, for random existing users."""
+    router = Router(root)
+    rng = random.Random(threading.get_ident())
+    try:
+        while not stop.is_set():
+            uid = rng.choice(users)
+            status, body = router.call(uid, handlers.start, rng.choice(test_ids), write=True)
+            question = body['questions'][0]
+            status, _ = router.call(uid, handlers.answer, body['sessionId'], question['id'],
+                                    question['options'][0]['id'], write=True)
+            if status != 200:
+                errors.append((uid, body['sessionId'], status))
+            created.append((uid, body['sessionId'], question['id']))
+    finally:
+        router.close()
+
+
+def print_sizes(router):
+    router.directory.refresh()
+    for shard, (sessions, answers, users) in shard_sizes(router).items():
+        buckets = sum(b[0] == shard for b in router.directory.buckets)
+        print(f"  shard {shard}: {buckets:>3d} buckets  {users:>6d} users  {sessions:>7d} sessions  {answers:>8d} answers")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='User-hash sharding of the session tables')
+    parser.add_argument('--root', default=SHARD_DIR)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('split', help='spread an existing database over new shards')
+    p.add_argument('db')
+    p.add_argument('--shards', type=int, default=4)
+    p = sub.add_parser('stats', help='scatter-gather the admin aggregates')
+    p.add_argument('--check', help='single database to compare the merged rows with')
+    p = sub.add_parser('route', help='print the shard of each user')
+    p.add_argument('uids', nargs='+')
+    sub.add_parser('add-shard', help='add an empty shard holding the catalog')
+    p = sub.add_parser('rebalance', help='even out buckets per shard, moving users online')
+    p.add_argument('--batch', type=int, default=BATCH_USERS)
+    p.add_argument('--traffic', type=int, default=0, help='threads writing through the router meanwhile')
+    sub.add_parser('check', help='verify every user lives on its routed shard')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        source = connect(args.db)
+        start = time.perf_counter()
+        counts = split(source, args.root, args.shards)
+        source.close()
+        print(f"Split {args.db} over {args.shards} shards in {time.perf_counter() - start:.2f}s: "
+              + ', '.join(f'{t} {n}' for t, n in counts.items()))
+        router = Router(args.root)
+        print_sizes(router)
+        router.close()
+        return
+
+    if args.command == 'add-shard':
+        print(f"Added shard {add_shard(args.root)}; run rebalance to move buckets onto it")
+        return
+
+    router = Router(args.root)
+    if args.command == 'route':
+        for uid in args.uids:
+            print(f"{uid}  bucket {bucket_of(uid)}  shard {router.shard_of(uid)}")
+
+    elif args.command == 'stats':
+        single = connect_shard(args.check) if args.check else None
+        for name, (statement, ops) in AGGREGATES.items():
+            start = time.perf_counter()
+            rows = router.gather(statement, ops)
+            gathered = time.perf_counter() - start
+            line = f"{name:7s} {len(rows):>5d} rows  gathered in {gathered * 1000:7.1f}ms"
+            if single:
+                start = time.perf_counter()
+                expected = merge([single.execute(statement).fetchall()], ops)
+                line += (f"  single db {(time.perf_counter() - start) * 1000:7.1f}ms  "
+                         f"{'identical' if expected == rows else 'DIFFERENT'}")
+            print(line)
+        if single:
+            single.close()
+
+    elif args.command == 'check':
+        print_sizes(router)
+        bad = misplaced(router)
+        print(f"Misplaced users: {sum(bad.values())}" + (f" {bad}" if any(bad.values()) else ''))
+
+    elif args.command == 'rebalance':
+        rebalancer = Rebalancer(args.root, args.batch)
+        moves = rebalancer.plan()
+        rebalancer.start(moves)
+        print(f"Moving {len(moves)} buckets")
+        stop, created, errors, threads = threading.Event(), [], [], []
+        if args.traffic:
+            users = [u for u, in router.conn(0).execute('SELECT DISTINCT user_uid FROM sessions LIMIT 2000')]
+            test_ids = [t for t, in router.conn(0).execute('SELECT id FROM tests')]
+            threads = [threading.Thread(target=traffic, args=(args.root, stop, users, test_ids, created, errors))
+                       for _ in range(args.traffic)]
+            for t in threads:
+                t.start()
+        start = time.perf_counter()
+        rebalancer.run()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for t in threads:
+            t.join()
+        print(f"Moved {rebalancer.moved['users']} users in {elapsed:.2f}s "
+              f"({rebalancer.moved['users'] / max(elapsed, 1e-9):,.0f} users/s)")
+        rebalancer.close()
+        if args.traffic:
+            lost = sum(router.db(uid).first(ANSWER_EXISTS, session_id, question_id) is None
+                       for uid, session_id, question_id in created)
+            print(f"Concurrent traffic: {len(created)} sessions started and answered, "
+                  f"{len(errors)} errors, {lost} answers not found on the user's shard")
+        print_sizes(router)
+        bad = misplaced(router)
+        print(f"Misplaced users: {sum(bad.values())}")
+    router.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""SQL issued by the Pages Functions.
+
+The statements are copied verbatim from apps/web/functions/api, so the
+local tools exercise the exact statements D1 runs. Keep them in sync when
+a handler's queries change.
+"""
+
+# sessions/start.ts
+START_TEST_EXISTS = """
+      SELECT id FROM tests WHERE id = ?
+    """
+START_EXISTING_SESSION = """
+        SELECT id FROM sessions
+        WHERE test_id = ? AND user_uid = ? AND finished_at IS NULL
+        ORDER BY created_at DESC
+        LIMIT 1
+      """
+START_EXISTING_ANSWERS = """
+          SELECT question_id, option_id FROM answers WHERE session_id = ?
+        """
+START_INSERT_SESSION = """
+          INSERT INTO sessions (test_id, user_uid)
+          VALUES (?, ?)
+        """
+START_QUESTIONS = """
+      SELECT q.id, q.text, q.order_index
+      FROM questions q
+      WHERE q.test_id = ?
+      ORDER BY q.order_index
+    """
+
+
+def start_options(n_questions):
+    placeholders = ','.join('?' * n_questions)
+    return f"""
+        SELECT id, question_id, text, order_index
+        FROM options
+        WHERE question_id IN ({placeholders})
+        ORDER BY question_id, order_index
+      """
+
+
+# sessions/answer.ts
+ANSWER_SESSION = """
+      SELECT id, finished_at FROM sessions WHERE id = ? AND user_uid = ?
+    """
+ANSWER_OPTION = """
+      SELECT score FROM options WHERE id = ? AND question_id = ?
+    """
+ANSWER_UPSERT = """
+      INSERT INTO answers (session_id, question_id, option_id, score)
+      VALUES (?, ?, ?, ?)
+      ON CONFLICT(session_id, question_id) DO UPDATE SET
+        option_id = excluded.option_id,
+        score = excluded.score,
+        answered_at = datetime('now')
+    """
+
+# sessions/finish.ts
+FINISH_SESSION = """
+            SELECT s.id, s.test_id, s.finished_at,
+                   t.name as test_name, t.slug as test_slug, t.category as test_category, t.warning
+            FROM sessions s
+            JOIN tests t ON s.test_id = t.id
+            WHERE s.id = ? AND s.user_uid = ?
+        """
+FINISH_SCALES = """
+            SELECT id, name FROM scales WHERE test_id = ?
+        """
+FINISH_ANSWERS = """
+            SELECT a.question_id, a.option_id, a.score, q.order_index, q.text as question_text
+            FROM answers a
+            JOIN questions q ON a.question_id = q.id
+            WHERE a.session_id = ?
+            ORDER BY q.order_index
+        """
+FINISH_SCALE_SCORE = """
+                SELECT COALESCE(SUM(a.score), 0) as total_score
+                FROM answers a
+                JOIN question_scales qs ON a.question_id = qs.question_id
+                WHERE a.session_id = ? AND qs.scale_id = ?
+            """
+FINISH_CUTOFF = """
+                SELECT label, description FROM cutoffs
+                WHERE scale_id = ? AND min_score <= ? AND max_score >= ?
+                LIMIT 1
+            """
+FINISH_INSERT_RESULT = """
+                INSERT INTO results (session_id, scale_id, score, interpretation)
+                VALUES (?, ?, ?, ?)
+            """
+FINISH_TEMPLATE = """
+                SELECT title, summary, details, recommendations
+                FROM analysis_templates
+                WHERE test_id = ? AND (scale_id = ? OR scale_id IS NULL) AND level_label = ?
+                LIMIT 1
+            """
+FINISH_OVERALL_TEMPLATE = """
+                    SELECT title, summary, details, recommendations
+                    FROM analysis_templates
+                    WHERE test_id = ? AND level_label = ?
+                    LIMIT 1
+                """
+FINISH_RISK_RULES = """
+            SELECT condition_expr, message, severity FROM risk_rules WHERE test_id = ?
+        """
+FINISH_SAVE_REPORT = """
+            INSERT INTO result_reports (session_id, report_json, created_at)
+            VALUES (?, ?, datetime('now'))
+            ON CONFLICT(session_id) DO UPDATE SET report_json = excluded.report_json
+        """
+FINISH_MARK_FINISHED = """
+            UPDATE sessions SET finished_at = datetime('now') WHERE id = ?
+        """
+
+# admin/export.ts
+EXPORT_TESTS = """
+      SELECT id, name, description, category, warning FROM tests ORDER BY name
+    """
+EXPORT_SCALES = """
+        SELECT id, name, description FROM scales WHERE test_id = ?
+      """
+EXPORT_CUTOFFS = """
+          SELECT min_score, max_score, label, description FROM cutoffs WHERE scale_id = ?
+        """
+EXPORT_QUESTIONS = """
+        SELECT id, text, order_index FROM questions WHERE test_id = ? ORDER BY order_index
+      """
+EXPORT_OPTIONS = """
+          SELECT text, score, order_index FROM options WHERE question_id = ? ORDER BY order_index
+        """
+EXPORT_SCALE_MAPPINGS = """
+          SELECT scale_id FROM question_scale_map WHERE question_id = ?
+        """
+
+# tests.ts
+TESTS_LIST = """
+      SELECT id, name, description, category, warning
+      FROM tests
+      ORDER BY name
+    """
+
+# tests/[id].ts; its option query is start_options()
+TEST_DETAIL = """
+      SELECT id, name, description, category, warning
+      FROM tests
+      WHERE id = ?
+    """
+TEST_DETAIL_QUESTIONS = """
+      SELECT id, text, order_index
+      FROM questions
+      WHERE test_id = ?
+      ORDER BY order_index
+    """
+
+# me/sessions.ts
+ME_SESSIONS = """
+      SELECT 
+        s.id,
+        s.test_id,
+        t.name as test_name,
+        t.category,
+        s.created_at,
+        s.finished_at,
+        (SELECT COALESCE(SUM(score), 0) FROM answers WHERE session_id = s.id) as total_score
+      FROM sessions s
+      JOIN tests t ON s.test_id = t.id
+      WHERE s.user_uid = ?
+      ORDER BY s.created_at DESC
+    """
+
+# me/sessions/[id].ts
+ME_SESSION = """
+      SELECT 
+        s.id,
+        s.test_id,
+        t.name as test_name,
+        t.description as test_description,
+        t.category,
+        t.warning,
+        s.created_at,
+        s.finished_at
+      FROM sessions s
+      JOIN tests t ON s.test_id = t.id
+      WHERE s.id = ? AND s.user_uid = ?
+    """
+ME_SESSION_RESULTS = """
+      SELECT 
+        r.id,
+        r.score,
+        r.interpretation,
+        sc.name as scale_name,
+        sc.description as scale_description
+      FROM results r
+      JOIN scales sc ON r.scale_id = sc.id
+      WHERE r.session_id = ?
+    """
+ME_SESSION_TOTAL = """
+      SELECT COALESCE(SUM(score), 0) as total FROM answers WHERE session_id = ?
+    """
+ME_SESSION_ANSWERS = """
+      SELECT 
+        a.id,
+        a.score,
+        q.text as question_text,
+        q.order_index,
+        o.text as answer_text
+      FROM answers a
+      JOIN questions q ON a.question_id = q.id
+      JOIN options o ON a.option_id = o.id
+      WHERE a.session_id = ?
+      ORDER BY q.order_index
+    """
+ME_SESSION_REPORT = """
+      SELECT report_json FROM result_reports WHERE session_id = ?
+    """
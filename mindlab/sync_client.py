@@ -0,0 +1,400 @@
+"""Concurrent admin sync of the test definitions over the D1 HTTP API.
+
+POST /api/admin/sync-tests runs syncTestMinimal for one test after
+another, and each test costs a SELECT, an UPDATE/INSERT, a delete batch,
+scale, question and question_scales batches, option batches of 50 and
+three more batches, each waiting for the previous one because later
+statements bind the ids the earlier ones returned.
+
+This client sends each test as ONE batch instead: the test row is upserted
+by slug and every child row looks its parent up through the unique
+indexes (tests.slug, scales(test_id, name), questions(test_id,
+order_index)) in multi-row INSERT ... SELECT FROM (VALUES ...) statements,
+so no statement needs an id from an earlier response. Statements are
+packed up to D1's 100 bound parameters, and the batch runs as one
+transaction, which makes a retry after a failure safe.
+
+Tests are pushed concurrently, bounded by a semaphore, over a pool of
+keep-alive connections, with exponential backoff and jitter on connection
+errors, 429 and 5xx. Only definitions whose content hash differs from the
+last successful push to the same URL (kept in build/sync-state.json) are
+sent, unless --all is given.
+
+--serve runs against mindlab.d1_server in-process on a fresh database, and
+--legacy replays the syncTestMinimal request sequence for comparison.
+
+Usage:
+    python -m mindlab.sync_client --url URL [--concurrency 8] [--all] [slug ...]
+    python -m mindlab.sync_client --serve local.db [--latency 20] [--fail-rate 0.05] [--legacy]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from mindlab.definitions import ROOT_DIR, load_definitions
+from mindlab.pipeline import content_hash, write_atomic
+
+STATE_PATH = os.path.join(ROOT_DIR, 'build', 'sync-state.json')
+MAX_PARAMS = 100
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+TEST_ID = 'SELECT id FROM tests WHERE slug = ?'
+
+# Same deletes as syncTestMinimal, keyed by slug instead of a fetched id
+DELETES = (
+    f'DELETE FROM question_scales WHERE question_id IN (SELECT id FROM questions WHERE test_id = ({TEST_ID}))',
+    f'DELETE FROM options WHERE question_id IN (SELECT id FROM questions WHERE test_id = ({TEST_ID}))',
+    f'DELETE FROM questions WHERE test_id = ({TEST_ID})',
+    f'DELETE FROM cutoffs WHERE scale_id IN (SELECT id FROM scales WHERE test_id = ({TEST_ID}))',
+    f'DELETE FROM scales WHERE test_id = ({TEST_ID})',
+    f'DELETE FROM analysis_templates WHERE test_id = ({TEST_ID})',
+    f'DELETE FROM risk_rules WHERE test_id = ({TEST_ID})',
+)
+
+# {values} becomes "(?, ?), (?, ?), ..."; the VALUES rows drive the join in
+# listed order, so ids are assigned in definition order like the serial sync
+INSERTS = {
+    'scales': """INSERT INTO scales (test_id, name)
+        SELECT t.id, v.column1 FROM (VALUES {values}) v CROSS JOIN tests t WHERE t.slug = ?""",
+    'questions': """INSERT INTO questions (test_id, text, order_index)
+        SELECT t.id, v.column1, v.column2 FROM (VALUES {values}) v CROSS JOIN tests t WHERE t.slug = ?""",
+    'question_scales': """INSERT INTO question_scales (question_id, scale_id)
+        SELECT q.id, s.id FROM (VALUES {values}) v CROSS JOIN tests t
+        JOIN questions q ON q.test_id = t.id AND q.order_index = v.column1
+        JOIN scales s ON s.test_id = t.id AND s.name = v.column2
+        WHERE t.slug = ?""",
+    'options': """INSERT INTO options (question_id, text, score, order_index)
+        SELECT q.id, v.column2, v.column3, v.column4 FROM (VALUES {values}) v CROSS JOIN tests t
+        JOIN questions q ON q.test_id = t.id AND q.order_index = v.column1
+        WHERE t.slug = ?""",
+    'cutoffs': """INSERT INTO cutoffs (scale_id, min_score, max_score, label, description)
+        SELECT s.id, v.column2, v.column3, v.column4, v.column5 FROM (VALUES {values}) v CROSS JOIN tests t
+        JOIN scales s ON s.test_id = t.id AND s.name = v.column1
+        WHERE t.slug = ?""",
+    'analysis_templates': """INSERT INTO analysis_templates
+            (test_id, scale_id, level_label, title, summary, details, recommendations, disclaimer)
+        SELECT t.id, s.id, v.column2, v.column3, v.column4, v.column5, v.column6, v.column7
+        FROM (VALUES {values}) v CROSS JOIN tests t
+        LEFT JOIN scales s ON s.test_id = t.id AND s.name = v.column1
+        WHERE t.slug = ?""",
+    'risk_rules': """INSERT INTO risk_rules (test_id, condition_expr, message, severity)
+        SELECT t.id, v.column1, v.column2, v.column3 FROM (VALUES {values}) v CROSS JOIN tests t WHERE t.slug = ?""",
+}
+
+
+class D1Error(Exception):
+    pass
+
+
+def statement(sql, *params):
+    return {'sql': sql, 'params': list(params)}
+
+
+def packed_inserts(table, rows, slug):
+    """Multi-row INSERTs for rows of one width, each under MAX_PARAMS parameters."""
+    if not rows:
+        return []
+    width = len(rows[0])
+    per_statement = (MAX_PARAMS - 1) // width
+    out = []
+    for i in range(0, len(rows), per_statement):
+        chunk = rows[i:i + per_statement]
+        values = ', '.join(['(' + ', '.join('?' * width) + ')'] * len(chunk))
+        out.append(statement(INSERTS[table].format(values=values), *[v for row in chunk for v in row], slug))
+    return out
+
+
+def sync_statements(d):
+    """Every statement that resyncs one definition, for a single batch."""
+    slug = d['slug']
+    meta = (d['nameFa'], d['descriptionFa'], d['category'], d['analysis_type'], d['warning'])
+    names = {s['key']: s['nameFa'] for s in d['scales']}
+
+    out = [
+        statement('INSERT INTO tests (name, description, category, analysis_type, warning, slug) '
+                  'SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM tests WHERE slug = ?)', *meta, slug, slug),
+        statement('UPDATE tests SET name = ?, description = ?, category = ?, analysis_type = ?, warning = ? '
+                  'WHERE slug = ?', *meta, slug),
+    ]
+    out += [statement(sql, slug) for sql in DELETES]
+    out += packed_inserts('scales', [(s['nameFa'],) for s in d['scales']], slug)
+    out += packed_inserts('questions', [(q['text'], q['order']) for q in d['questions']], slug)
+    out += packed_inserts('question_scales', [(q['order'], names[q['scaleKey']]) for q in d['questions']
+                                              if q.get('scaleKey') in names], slug)
+    out += packed_inserts('options', [(q['order'], opt['text'], opt['score'], i)
+                                      for q in d['questions'] for i, opt in enumerate(q['options'])], slug)
+    # Same column swap as sync-tests.ts: label <- labelFa, description <- label
+    out += packed_inserts('cutoffs', [(names[c['scaleKey']], c['min'], c['max'], c['labelFa'], c['label'])
+                                      for c in d.get('cutoffs', []) if c['scaleKey'] in names], slug)
+    out += packed_inserts('analysis_templates', [(names.get(t['scaleKey']), t['level_label'], t['title'], t['summary'],
+                                                  t['details'], t['recommendations'], t.get('disclaimer'))
+                                                 for t in d.get('analysis_templates', [])], slug)
+    out += packed_inserts('risk_rules', [(r['condition'], r['message'], r['severity'])
+                                         for r in d.get('risk_rules', [])], slug)
+    return out
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to one host, reused across requests."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+        self.path = parts.path + (f'?{parts.query}' if parts.query else '')
+        self.idle = []
+        self.opened = 0
+
+    async def request(self, body, headers, timeout):
+        """POST body to the pool's URL; returns (status, parsed JSON or None)."""
+        if self.idle:
+            reader, writer = self.idle.pop()
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+            self.opened += 1
+        try:
+            head = [f'POST {self.path} HTTP/1.1', f'Host: {self.host}', 'Content-Type: application/json',
+                    f'Content-Length: {len(body)}', 'Connection: keep-alive']
+            head += [f'{k}: {v}' for k, v in headers.items()]
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+            status, response_headers = await asyncio.wait_for(self._read_head(reader), timeout)
+            length = int(response_headers.get('content-length', 0))
+            data = await asyncio.wait_for(reader.readexactly(length), timeout)
+        except BaseException:
+            writer.close()
+            raise
+        if response_headers.get('connection', '').lower() == 'close':
+            writer.close()
+        else:
+            self.idle.append((reader, writer))
+        try:
+            return status, json.loads(data) if data else None
+        except ValueError:
+            return status, None
+
+    @staticmethod
+    async def _read_head(reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError('connection closed by the server')
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return status, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class D1Client:
+    """D1 query API client with bounded concurrency and retry/backoff."""
+
+    def __init__(self, url, token=None, concurrency=8, retries=5, backoff=0.2, timeout=30.0, seed=None):
+        self.pool = ConnectionPool(url)
+        self.headers = {'Authorization': f'Bearer {token}'} if token else {}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.stats = {'requests': 0, 'retries': 0, 'statements': 0}
+
+    async def query(self, statements):
+        """Run statements as one batch; returns the per-statement results."""
+        body = json.dumps({'batch': statements}, ensure_ascii=False).encode('utf-8')
+        for attempt in range(self.retries + 1):
+            try:
+                self.stats['requests'] += 1
+                status, response = await self.pool.request(body, self.headers, self.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = f'{type(e).__name__}: {e}'
+            else:
+                if status == 200 and response and response.get('success'):
+                    self.stats['statements'] += len(statements)
+                    return response['result']
+                messages = '; '.join(e.get('message', '') for e in (response or {}).get('errors', []))
+                error = f'HTTP {status}: {messages}'
+                if status not in RETRY_STATUS:
+                    raise D1Error(error)
+            if attempt == self.retries:
+                raise D1Error(f'{error} (after {attempt + 1} attempts)')
+            self.stats['retries'] += 1
+            # Full jitter keeps concurrent retries from arriving together
+            await asyncio.sleep(self.rng.uniform(0, self.backoff * 2 ** attempt))
+
+    def close(self):
+        self.pool.close()
+
+
+async def sync_test(client, definition):
+    async with client.semaphore:
+        await client.query(sync_statements(definition))
+
+
+async def sync_test_legacy(client, d):
+    """The request sequence of syncTestMinimal, one awaited call per D1 round trip."""
+    async def one(sql, *params):
+        return (await client.query([statement(sql, *params)]))[0]
+
+    existing = (await one('SELECT id FROM tests WHERE slug = ?', d['slug']))['results']
+    meta = (d['nameFa'], d['descriptionFa'], d['category'], d['analysis_type'], d['warning'])
+    if existing:
+        test_id = existing[0]['id']
+        await one('UPDATE tests SET name = ?, description = ?, category = ?, analysis_type = ?, warning = ? WHERE id = ?',
+                  *meta, test_id)
+    else:
+        result = await one('INSERT INTO tests (name, description, category, analysis_type, warning, slug) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', *meta, d['slug'])
+        test_id = result['meta']['last_row_id']
+
+    await client.query([statement(sql.replace(f'({TEST_ID})', '?'), test_id) for sql in DELETES])
+    results = await client.query([statement('INSERT INTO scales (test_id, name) VALUES (?, ?)', test_id, s['nameFa'])
+                                  for s in d['scales']])
+    scale_ids = {s['key']: r['meta']['last_row_id'] for s, r in zip(d['scales'], results)}
+    results = await client.query([statement('INSERT INTO questions (test_id, text, order_index) VALUES (?, ?, ?)',
+                                            test_id, q['text'], q['order']) for q in d['questions']])
+    question_ids = [r['meta']['last_row_id'] for r in results]
+
+    links, options = [], []
+    for q, question_id in zip(d['questions'], question_ids):
+        if scale_ids.get(q['scaleKey']):
+            links.append(statement('INSERT INTO question_scales (question_id, scale_id) VALUES (?, ?)',
+                                   question_id, scale_ids[q['scaleKey']]))
+        for i, opt in enumerate(q['options']):
+            options.append(statement('INSERT INTO options (question_id, text, score, order_index) VALUES (?, ?, ?, ?)',
+                                     question_id, opt['text'], opt['score'], i))
+    if links:
+        await client.query(links)
+    for i in range(0, len(options), 50):
+        await client.query(options[i:i + 50])
+
+    batches = (
+        [statement('INSERT INTO cutoffs (scale_id, min_score, max_score, label, description) VALUES (?, ?, ?, ?, ?)',
+                   scale_ids.get(c['scaleKey']), c['min'], c['max'], c['labelFa'], c['label'])
+         for c in d.get('cutoffs', [])],
+        [statement('INSERT INTO analysis_templates (test_id, scale_id, level_label, title, summary, details, '
+                   'recommendations, disclaimer) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                   test_id, scale_ids.get(t['scaleKey']), t['level_label'], t['title'], t['summary'], t['details'],
+                   t['recommendations'], t.get('disclaimer')) for t in d.get('analysis_templates', [])],
+        [statement('INSERT INTO risk_rules (test_id, condition_expr, message, severity) VALUES (?, ?, ?, ?)',
+                   test_id, r['condition'], r['message'], r['severity']) for r in d.get('risk_rules', [])],
+    )
+    for batch in batches:
+        if batch:
+            await client.query(batch)
+
+
+def load_state(path=STATE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_atomic(path, json.dumps(state, indent=2, sort_keys=True) + '\n')
+
+
+async def sync_all(client, definitions, legacy=False):
+    """Push every definition; returns {slug: None or the error message}."""
+    async def run(slug, definition):
+        try:
+            if legacy:
+                await sync_test_legacy(client, definition)
+            else:
+                await sync_test(client, definition)
+            return slug, None
+        except D1Error as e:
+            return slug, str(e)
+
+    if legacy:
+        # One test after another, like the endpoint
+        return dict([await run(slug, d) for slug, d in definitions.items()])
+    return dict(await asyncio.gather(*(run(slug, d) for slug, d in definitions.items())))
+
+
+async def run_sync(url, definitions, token=None, concurrency=8, retries=5, legacy=False, seed=None):
+    client = D1Client(url, token, concurrency, retries, seed=seed)
+    try:
+        start = time.perf_counter()
+        errors = await sync_all(client, definitions, legacy)
+        elapsed = time.perf_counter() - start
+    finally:
+        client.close()
+    return errors, elapsed, dict(client.stats, connections=client.pool.opened)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push changed test definitions through the D1 HTTP API')
+    parser.add_argument('slugs', nargs='*')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--url', help='D1 query endpoint, .../accounts/<id>/d1/database/<id>/query')
+    target.add_argument('--serve', metavar='DB', help='recreate DB and sync into a local mindlab.d1_server')
+    parser.add_argument('--token-env', default='CLOUDFLARE_API_TOKEN', help='environment variable with the API token')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=5)
+    parser.add_argument('--all', action='store_true', help='push unchanged definitions too')
+    parser.add_argument('--legacy', action='store_true', help='replay the serial syncTestMinimal request sequence')
+    parser.add_argument('--latency', type=float, default=0.0, help='--serve: milliseconds per request')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='--serve: fraction of requests failing with 503')
+    args = parser.parse_args()
+
+    definitions = load_definitions(args.slugs or None)
+    server = None
+    if args.serve:
+        from mindlab.d1_server import serve
+        from mindlab.localdb import apply_migrations, connect, remove_database
+
+        remove_database(args.serve)
+        conn = connect(args.serve)
+        apply_migrations(conn)
+        conn.close()
+        server = serve(args.serve, latency=args.latency / 1000, fail_rate=args.fail_rate)
+        url = server.url
+    else:
+        url = args.url
+
+    state = load_state()
+    pushed = state.get(url, {})
+    hashes = {slug: content_hash(d) for slug, d in definitions.items()}
+    if not (args.all or args.serve):
+        definitions = {slug: d for slug, d in definitions.items() if pushed.get(slug) != hashes[slug]}
+    if not definitions:
+        print('All definitions are up to date')
+        return
+
+    errors, elapsed, stats = asyncio.run(run_sync(url, definitions, os.environ.get(args.token_env),
+                                                  args.concurrency, args.retries, args.legacy))
+    for slug, error in errors.items():
+        if error:
+            print(f"{slug}: {error}")
+        else:
+            pushed[slug] = hashes[slug]
+    if not args.serve:
+        state[url] = pushed
+        save_state(state)
+
+    synced = sum(error is None for error in errors.values())
+    print(f"Synced {synced}/{len(errors)} tests in {elapsed:.2f}s: {stats['requests']} requests "
+          f"({stats['retries']} retries), {stats['statements']} statements, {stats['connections']} connections")
+    if server:
+        server.shutdown()
+        print('Server: ' + ', '.join(f'{k} {v}' for k, v in server.stats.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Measure what interning the catalog's repeated texts would save.
+
+The same labels repeat across every instrument: Likert anchors such as
+"اصلاً" appear 177 times in the JSON files, and options.text and
+analysis_templates.disclaimer store a copy per row. This script reports,
+per text column, the rows, the distinct texts and the bytes stored inline
+against a shared table plus an integer id per row. It also compares the
+gzipped definitions with an id-referencing form (every text field
+replaced by an index into one string table shipped alongside).
+
+Nothing is migrated or synced. On the current catalog interning would
+cut options.text from 37 KB to 11 KB of D1 storage, while the
+id-referencing definitions come out larger after gzip (24,998 -> 25,885
+bytes), so the client payload would not shrink. A texts table is only
+worth adding together with handlers that read the ids and dropping the
+inline columns.
+
+Usage:
+    python -m mindlab.texts [--json FILE]
+"""
+import argparse
+import gzip
+import json
+
+from mindlab.definitions import load_definitions
+
+# (table.column, records of a definition, field)
+COLUMNS = (
+    ('options.text', lambda d: [o for q in d['questions'] for o in q['options']], 'text'),
+    ('questions.text', lambda d: d['questions'], 'text'),
+    ('cutoffs.label', lambda d: d.get('cutoffs', []), 'labelFa'),
+    ('analysis_templates.disclaimer', lambda d: d.get('analysis_templates', []), 'disclaimer'),
+    ('analysis_templates.recommendations', lambda d: d.get('analysis_templates', []), 'recommendations'),
+    ('risk_rules.message', lambda d: d.get('risk_rules', []), 'message'),
+)
+
+# Bytes SQLite needs for a small rowid reference in a record
+ID_BYTES = 2
+
+
+def column_sizes(definitions):
+    """Rows of (column, rows, distinct, inline bytes, interned bytes)."""
+    out = []
+    for name, records, field in COLUMNS:
+        values = [r[field] for d in definitions.values() for r in records(d) if isinstance(r.get(field), str)]
+        distinct = set(values)
+        inline = sum(len(v.encode('utf-8')) for v in values)
+        interned = sum(len(v.encode('utf-8')) for v in distinct) + ID_BYTES * len(values)
+        out.append((name, len(values), len(distinct), inline, interned))
+    return out
+
+
+def _replace_texts(value, ids):
+    if isinstance(value, str):
+        return ids.setdefault(value, len(ids))
+    if isinstance(value, list):
+        return [_replace_texts(v, ids) for v in value]
+    if isinstance(value, dict):
+        return {k: v if k in ('slug', 'key', 'scaleKey', 'level_label', 'condition') else _replace_texts(v, ids)
+                for k, v in value.items()}
+    return value
+
+
+def payload_sizes(definitions):
+    """(inline gzip bytes, id-referencing gzip bytes) of all definitions."""
+    def gz(value):
+        return len(gzip.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'), compresslevel=9))
+
+    ids = {}
+    referenced = {slug: _replace_texts(d, ids) for slug, d in definitions.items()}
+    return gz(definitions), gz({'texts': list(ids), 'tests': referenced})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the savings of interning repeated catalog texts')
+    parser.add_argument('--json', help='also write the measurement to this file')
+    args = parser.parse_args()
+
+    definitions = load_definitions()
+    columns = column_sizes(definitions)
+    print(f"{'column':36s} {'rows':>6s} {'distinct':>8s} {'inline':>9s} {'interned':>9s}")
+    for name, rows, distinct, inline, interned in columns:
+        print(f"{name:36s} {rows:6d} {distinct:8d} {inline:9,d} {interned:9,d}")
+
+    inline_gz, referenced_gz = payload_sizes(definitions)
+    print(f"\nDefinitions gzipped: inline {inline_gz:,} bytes, id-referencing {referenced_gz:,} bytes")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'columns': [dict(zip(('column', 'rows', 'distinct', 'inline', 'interned'), c))
+                                   for c in columns],
+                       'gzip': {'inline': inline_gz, 'referenced': referenced_gz}}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Replay recorded API requests and profile the statements each handler issues.
+
+A request log is NDJSON, one request per line:
+
+    {"method": "POST", "path": "/api/sessions/start", "uid": "u1", "body": {"testId": 3}}
+
+`record` writes one by driving simulated users through the handler ports
+of mindlab/handlers.py (catalog, test detail, start, answers, finish,
+history and an occasional admin export) on a copy of the database, so the
+ids in the log are the ones a replay on another copy of the same database
+gets. `replay` runs a log against a fresh copy through TracingD1 and
+reports per handler and per statement fingerprint (literals and IN lists
+folded, see mindlab.d1.fingerprint):
+
+    statements, rows returned, rows written and VM steps (x100, a proxy
+    for the rows D1 bills as read) per request, and wall time
+
+plus the N+1 patterns: fingerprints a handler runs more than once per
+request, ranked by the round trips a set-based query would save.
+--folded writes handler;statement stacks weighted by microseconds, the
+collapsed format flamegraph.pl and speedscope read; time spent in the
+handler outside SQL is the [handler] frame.
+
+Usage:
+    python -m mindlab.trace record local.db requests.ndjson [--users 200] [--exports 2]
+    python -m mindlab.trace replay local.db requests.ndjson [--folded trace.folded] [--top 10] [--json report.json]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+
+from mindlab import handlers
+from mindlab import statements as sql
+from mindlab.bench_lifecycle import percentiles
+from mindlab.d1 import STEP_INTERVAL, Counters, LocalD1, TracingD1, fingerprint
+from mindlab.localdb import connect
+
+ROUTES = (
+    ('GET', re.compile(r'/api/tests$'), 'tests',
+     lambda db, r, m: handlers.list_tests(db)),
+    ('GET', re.compile(r'/api/tests/(\d+)$'), 'tests/[id]',
+     lambda db, r, m: handlers.get_test(db, int(m[1]))),
+    ('POST', re.compile(r'/api/sessions/start$'), 'sessions/start',
+     lambda db, r, m: handlers.start(db, r.get('uid'), r['body'].get('testId'))),
+    ('POST', re.compile(r'/api/sessions/answer$'), 'sessions/answer',
+     lambda db, r, m: handlers.answer(db, r.get('uid'), r['body'].get('sessionId'), r['body'].get('questionId'),
+                                      r['body'].get('optionId'))),
+    ('POST', re.compile(r'/api/sessions/finish$'), 'sessions/finish',
+     lambda db, r, m: handlers.finish(db, r.get('uid'), r['body'].get('sessionId'))),
+    ('GET', re.compile(r'/api/me/sessions$'), 'me/sessions',
+     lambda db, r, m: handlers.my_sessions(db, r.get('uid'))),
+    ('GET', re.compile(r'/api/me/sessions/(\d+)$'), 'me/sessions/[id]',
+     lambda db, r, m: handlers.my_session(db, r.get('uid'), int(m[1]))),
+    ('GET', re.compile(r'/api/admin/export$'), 'admin/export',
+     lambda db, r, m: handlers.export(db)),
+)
+
+
+# Prefix of the mindlab.statements constants copied from each handler
+HANDLER_PREFIXES = {
+    'tests': 'TESTS_', 'tests/[id]': 'TEST_DETAIL', 'sessions/start': 'START_', 'sessions/answer': 'ANSWER_',
+    'sessions/finish': 'FINISH_', 'me/sessions': 'ME_SESSIONS', 'me/sessions/[id]': 'ME_SESSION',
+    'admin/export': 'EXPORT_',
+}
+
+
+def statement_names():
+    """{fingerprint: [constant names in mindlab.statements]}"""
+    names = defaultdict(list)
+    for name, value in vars(sql).items():
+        if name.isupper() and isinstance(value, str):
+            names[fingerprint(value)].append(name)
+    names[fingerprint(sql.start_options(1))].append('start_options')
+    return names
+
+
+STATEMENT_NAMES = statement_names()
+
+
+def label(handler, fp):
+    """The statements constant for fp, preferring the handler's own when several handlers share the SQL."""
+    names = STATEMENT_NAMES.get(fp)
+    if not names:
+        return fp if len(fp) <= 80 else fp[:77] + '...'
+    own = [n for n in names if n.startswith(HANDLER_PREFIXES.get(handler, '-'))]
+    return '|'.join(own or names)
+
+
+def route(request):
+    for method, pattern, name, call in ROUTES:
+        match = pattern.match(request['path'])
+        if match and request['method'] == method:
+            return name, lambda db: call(db, request, match)
+    raise ValueError(f"no handler for {request['method']} {request['path']}")
+
+
+def copy_database(src, dst):
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+def record(conn, n_users=200, n_exports=2, seed=0):
+    """Simulated traffic as a list of requests, executed against conn."""
+    db = LocalD1(conn)
+    rng = random.Random(seed)
+    test_ids = [r[0] for r in conn.execute('SELECT id FROM tests ORDER BY id')]
+    log = []
+
+    def call(method, path, uid=None, body=None):
+        request = {'method': method, 'path': path, 'uid': uid, 'body': body or {}}
+        log.append(request)
+        name, run = route(request)
+        status, response = run(db)
+        if status >= 400:
+            raise RuntimeError(f"{name} failed with {status}: {response}")
+        return response
+
+    export_at = set(rng.sample(range(n_users), min(n_exports, n_users)))
+    for i in range(n_users):
+        uid = f'trace-user-{i:06d}'
+        test_id = rng.choice(test_ids)
+        call('GET', '/api/tests')
+        call('GET', f'/api/tests/{test_id}')
+        started = call('POST', '/api/sessions/start', uid, {'testId': test_id})
+        session_id = started['sessionId']
+        for q in started['questions']:
+            if q['options']:
+                call('POST', '/api/sessions/answer', uid, {'sessionId': session_id, 'questionId': q['id'],
+                                                             'optionId': rng.choice(q['options'])['id']})
+        call('POST', '/api/sessions/finish', uid, {'sessionId': session_id})
+        call('GET', '/api/me/sessions', uid)
+        call('GET', f'/api/me/sessions/{session_id}', uid)
+        if i in export_at:
+            call('GET', '/api/admin/export', 'admin')
+    return log
+
+
+class Profile:
+    """Per-handler and per-statement aggregates of a replay."""
+
+    def __init__(self):
+        self.wall = defaultdict(list)
+        self.handlers = defaultdict(Counters)
+        self.statements = defaultdict(Counters)
+        # (handler, fingerprint) -> [requests running it, most runs in one request]
+        self.repeats = defaultdict(lambda: [0, 0])
+        self.errors = defaultdict(int)
+
+    def add(self, name, seconds, db):
+        self.wall[name].append(seconds)
+        for counters in db.by_handler.values():
+            self.handlers[name].add(counters)
+        for (_, fp), counters in db.by_statement.items():
+            self.statements[name, fp].add(counters)
+            seen = self.repeats[name, fp]
+            seen[0] += 1
+            seen[1] = max(seen[1], counters.statements)
+
+    def n_plus_one(self, top=10):
+        """Fingerprints run repeatedly within one request, by round trips a set-based query would save."""
+        rows = []
+        for (name, fp), counters in self.statements.items():
+            requests, most = self.repeats[name, fp]
+            if counters.statements > requests:
+                rows.append({
+                    'handler': name,
+                    'statement': label(name, fp),
+                    'per_request': counters.statements / requests,
+                    'max_per_request': most,
+                    'saved_round_trips': counters.statements - requests,
+                    'ms': counters.seconds * 1000,
+                })
+        rows.sort(key=lambda r: r['saved_round_trips'], reverse=True)
+        return rows[:top]
+
+    def folded(self):
+        """Collapsed stacks 'handler;statement microseconds'."""
+        lines = []
+        for (name, fp), counters in sorted(self.statements.items()):
+            lines.append(f"{name};{label(name, fp).replace(';', ',')} {round(counters.seconds * 1e6)}")
+        for name, samples in sorted(self.wall.items()):
+            own = sum(samples) - self.handlers[name].seconds
+            lines.append(f"{name};[handler] {max(round(own * 1e6), 0)}")
+        return '\n'.join(lines) + '\n'
+
+    def report(self, top=10):
+        out = {'handlers': {}, 'statements': [], 'n_plus_one': self.n_plus_one(top)}
+        for name, samples in sorted(self.wall.items(), key=lambda kv: -self.handlers[kv[0]].statements):
+            c, n = self.handlers[name], len(samples)
+            out['handlers'][name] = {
+                'requests': n,
+                'errors': self.errors[name],
+                'statements': c.statements / n,
+                'rows_returned': c.rows_returned / n,
+                'rows_written': c.rows_written / n,
+                'vm_steps': c.vm_steps * STEP_INTERVAL / n,
+                'wall_ms': percentiles(samples),
+                'total_ms': sum(samples) * 1000,
+            }
+        for (name, fp), c in sorted(self.statements.items(), key=lambda kv: -kv[1].vm_steps):
+            out['statements'].append({
+                'handler': name, 'statement': label(name, fp), 'count': c.statements, 'rows_returned': c.rows_returned,
+                'rows_written': c.rows_written, 'vm_steps': c.vm_steps * STEP_INTERVAL, 'ms': c.seconds * 1000,
+            })
+        return out
+
+
+def replay(db, requests):
+    profile = Profile()
+    for request in requests:
+        name, run = route(request)
+        db.reset()
+        db.handler = name
+        start = time.perf_counter()
+        status, _ = run(db)
+        profile.add(name, time.perf_counter() - start, db)
+        if status >= 400:
+            profile.errors[name] += 1
+    return profile
+
+
+def read_log(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_report(report):
+    print(f"{'handler':18s} {'requests':>8s} {'stmts/req':>9s} {'rows/req':>9s} {'written':>8s} "
+          f"{'vm steps/req':>12s} {'p50 ms':>8s} {'p95 ms':>8s} {'total ms':>9s}")
+    for name, h in report['handlers'].items():
+        print(f"{name:18s} {h['requests']:>8d} {h['statements']:>9.1f} {h['rows_returned']:>9.1f} "
+              f"{h['rows_written']:>8.1f} {h['vm_steps']:>12,.0f} {h['wall_ms']['p50']:>8.3f} "
+              f"{h['wall_ms']['p95']:>8.3f} {h['total_ms']:>9.1f}")
+    print('\nHeaviest statements by VM steps:')
+    for s in report['statements'][:10]:
+        print(f"  {s['handler']:18s} {s['statement'][:48]:48s} x{s['count']:<7d} {s['vm_steps']:>12,d} steps "
+              f"{s['rows_returned']:>8d} rows {s['ms']:>8.1f} ms")
+    print('\nN+1 patterns (runs per request, round trips a set-based query would save):')
+    for r in report['n_plus_one']:
+        print(f"  {r['handler']:18s} {r['statement'][:48]:48s} {r['per_request']:6.1f}/req (max {r['max_per_request']}) "
+              f"{r['saved_round_trips']:>7d} saved {r['ms']:>8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record and replay API request logs with per-statement tracing')
+    sub = parser.add_subparsers(dest='command', required=True)
+    r = sub.add_parser('record', help='simulate users on a copy of the database and write their requests')
+    r.add_argument('db')
+    r.add_argument('log')
+    r.add_argument('--users', type=int, default=200)
+    r.add_argument('--exports', type=int, default=2, help='admin exports mixed into the traffic')
+    r.add_argument('--seed', type=int, default=0)
+    p = sub.add_parser('replay', help='replay a request log on a copy of the database')
+    p.add_argument('db')
+    p.add_argument('log')
+    p.add_argument('--folded', help='write collapsed stacks for flamegraph.pl / speedscope')
+    p.add_argument('--top', type=int, default=10, help='N+1 patterns to list')
+    p.add_argument('--json', help='write the full report to this file')
+    p.add_argument('--no-steps', action='store_true', help='skip VM step counting (lower overhead)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, 'trace.db')
+        copy_database(args.db, copy)
+        conn = connect(copy)
+        if args.command == 'record':
+            log = record(conn, args.users, args.exports, args.seed)
+            with open(args.log, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(request, ensure_ascii=False) + '\n' for request in log)
+            print(f"Recorded {len(log)} requests from {args.users} users in {args.log}")
+        else:
+            requests = read_log(args.log)
+            db = TracingD1(conn, count_steps=not args.no_steps)
+            start = time.perf_counter()
+            profile = replay(db, requests)
+            print(f"Replayed {len(requests)} requests in {time.perf_counter() - start:.2f}s\n")
+            report = profile.report(args.top)
+            print_report(report)
+            if args.folded:
+                with open(args.folded, 'w', encoding='utf-8') as f:
+                    f.write(profile.folded())
+            if args.json:
+                with open(args.json, 'w', encoding='utf-8') as f:
+                    json.dump(report, f, ensure_ascii=False, indent=2)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Streaming export/import of a whole database, catalog and sessions.
+
+admin/export.ts issues one query per scale, question and option. Here
+every table is read with a single `SELECT ... ORDER BY rowid` and streamed
+out in fetchmany batches, so the number of queries is fixed by the number
+of tables and memory by the batch size.
+
+NDJSON layout (optionally gzip-compressed when the path ends in .gz):
+
+    {"format": 1, "exportedAt": "...", "tables": [...]}
+    {"table": "tests", "columns": ["id", "name", ...]}
+    [1, "...", ...]                 one line per row
+    {"table": "scales", "columns": [...]}
+    ...
+
+With --format parquet (needs pyarrow) the target is a directory holding
+one <table>.parquet file per table instead.
+
+Import replays the file into a database with the migrations applied (a
+new one starts empty, without the seed rows), preserving ids, with one
+executemany per batch inside a single transaction. Columns missing from
+the target schema are dropped.
+
+Usage:
+    python -m mindlab.transfer export local.db dump.ndjson.gz [--catalog-only] [--format parquet]
+    python -m mindlab.transfer import dump.ndjson.gz copy.db
+"""
+import argparse
+import gzip
+import json
+import os
+import time
+
+from mindlab.handlers import iso_now
+from mindlab.localdb import apply_migrations, connect
+
+FORMAT_VERSION = 1
+BATCH_SIZE = 5000
+
+# Parents before children, so foreign keys hold at every point of an import
+CATALOG_TABLES = (
+    'tests', 'scales', 'questions', 'options', 'question_scale_map', 'question_scales',
+    'cutoffs', 'analysis_templates', 'risk_rules',
+)
+SESSION_TABLES = (
+    'user_profiles', 'sessions', 'answers', 'results', 'result_reports', 'ai_analyses',
+)
+
+PARQUET_TYPES = {'INTEGER': 'int64', 'REAL': 'float64'}
+
+
+def open_text(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(path, mode, encoding='utf-8')
+
+
+def table_columns(conn, table):
+    """[(name, declared type)] or [] when the table does not exist."""
+    return [(row[1], row[2].upper()) for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def export_tables(conn, tables):
+    """Yield (table, columns, batches) for each existing table."""
+    for table in tables:
+        columns = table_columns(conn, table)
+        if not columns:
+            continue
+        names = [name for name, _ in columns]
+
+        def batches(table=table, names=names):
+            cursor = conn.execute(f"SELECT {', '.join(names)} FROM {table} ORDER BY rowid")
+            while True:
+                rows = cursor.fetchmany(BATCH_SIZE)
+                if not rows:
+                    return
+                yield rows
+
+        yield table, columns, batches()
+
+
+def export_ndjson(conn, path, tables):
+    """Write tables to NDJSON. Returns {table: rows}."""
+    counts = {}
+    present = [t for t in tables if table_columns(conn, t)]
+    with open_text(path, 'w') as f:
+        f.write(json.dumps({'format': FORMAT_VERSION, 'exportedAt': iso_now(), 'tables': present}) + '\n')
+        for table, columns, batches in export_tables(conn, present):
+            f.write(json.dumps({'table': table, 'columns': [name for name, _ in columns]}) + '\n')
+            counts[table] = 0
+            for rows in batches:
+                f.write(''.join(json.dumps(row, ensure_ascii=False) + '\n' for row in rows))
+                counts[table] += len(rows)
+    return counts
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit('Parquet needs pyarrow (pip install pyarrow); use the NDJSON format instead')
+    return pyarrow, pyarrow.parquet
+
+
+def export_parquet(conn, directory, tables):
+    """Write one Parquet file per table. Returns {table: rows}."""
+    pa, pq = _pyarrow()
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table, columns, batches in export_tables(conn, tables):
+        schema = pa.schema([(name, PARQUET_TYPES.get(decl, 'string')) for name, decl in columns])
+        counts[table] = 0
+        with pq.ParquetWriter(os.path.join(directory, f'{table}.parquet'), schema) as writer:
+            for rows in batches:
+                arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)]
+                writer.write_batch(pa.record_batch(arrays, schema=schema))
+                counts[table] += len(rows)
+    return counts
+
+
+def read_ndjson(path):
+    """Yield (table, columns, batches) from an NDJSON export."""
+    with open_text(path, 'r') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != FORMAT_VERSION:
+            raise ValueError(f"{path}: export format {header.get('format')}, expected {FORMAT_VERSION}")
+
+        line = f.readline()
+        while line:
+            section = json.loads(line)
+            state = {'next': None}
+
+            def batches(section=section, state=state):
+                batch = []
+                for line in f:
+                    if line.startswith('{'):
+                        state['next'] = line
+                        break
+                    batch.append(json.loads(line))
+                    if len(batch) == BATCH_SIZE:
+                        yield batch
+                        batch = []
+                if batch:
+                    yield batch
+
+            rows = batches()
+            yield section['table'], section['columns'], rows
+            # Drain whatever the consumer did not read before moving on
+            for _ in rows:
+                pass
+            line = state['next']
+
+
+def read_parquet(directory):
+    pa, pq = _pyarrow()
+    for table in CATALOG_TABLES + SESSION_TABLES:
+        path = os.path.join(directory, f'{table}.parquet')
+        if not os.path.exists(path):
+            continue
+        parquet = pq.ParquetFile(path)
+        columns = parquet.schema_arrow.names
+        yield table, columns, ([tuple(r.values()) for r in b.to_pylist()]
+                               for b in parquet.iter_batches(batch_size=BATCH_SIZE))
+
+
+def import_tables(conn, sections):
+    """Insert (table, columns, batches) into conn in one transaction.
+
+    Returns ({table: rows}, [tables skipped because the target schema lacks them]).
+    """
+    counts, skipped = {}, []
+    conn.execute('PRAGMA foreign_keys = OFF')
+    conn.execute('BEGIN')
+    try:
+        for table, columns, batches in sections:
+            target = {name for name, _ in table_columns(conn, table)}
+            if not target:
+                skipped.append(table)
+                continue
+            keep = [i for i, name in enumerate(columns) if name in target]
+            names = [columns[i] for i in keep]
+            statement = f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})"
+            counts[table] = 0
+            for rows in batches:
+                if len(keep) != len(columns):
+                    rows = [[row[i] for i in keep] for row in rows]
+                conn.executemany(statement, rows)
+                counts[table] += len(rows)
+        problems = conn.execute('PRAGMA foreign_key_check').fetchall()
+        if problems:
+            raise ValueError(f'{len(problems)} rows violate foreign keys, e.g. {problems[0]}')
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.execute('PRAGMA foreign_keys = ON')
+    return counts, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream a local database to NDJSON/Parquet and back')
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export')
+    exp.add_argument('db')
+    exp.add_argument('out')
+    exp.add_argument('--catalog-only', action='store_true', help='tests and their definitions, no sessions')
+    exp.add_argument('--format', choices=('ndjson', 'parquet'), default='ndjson')
+    imp = sub.add_parser('import')
+    imp.add_argument('src')
+    imp.add_argument('db', help='created with the migrations applied when it does not exist')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        conn = connect(args.db)
+        tables = CATALOG_TABLES if args.catalog_only else CATALOG_TABLES + SESSION_TABLES
+        if args.format == 'parquet':
+            counts = export_parquet(conn, args.out, tables)
+        else:
+            counts = export_ndjson(conn, args.out, tables)
+    else:
+        fresh = not os.path.exists(args.db)
+        conn = connect(args.db)
+        if fresh:
+            apply_migrations(conn)
+            # The seed migration inserts sample rows whose ids would collide
+            for table in reversed(CATALOG_TABLES + SESSION_TABLES):
+                if table_columns(conn, table):
+                    conn.execute(f'DELETE FROM {table}')
+        sections = read_parquet(args.src) if os.path.isdir(args.src) else read_ndjson(args.src)
+        counts, skipped = import_tables(conn, sections)
+        for table in skipped:
+            print(f"Skipped {table}: not in the target schema")
+        conn.execute('ANALYZE')
+    conn.close()
+
+    elapsed = time.perf_counter() - start
+    for table, n in counts.items():
+        print(f"{table:20s} {n:>10d} rows")
+    total = sum(counts.values())
+    print(f"{args.command.capitalize()}ed {total} rows in {elapsed:.2f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""Validator for the JSON test definitions.
+
+Each file is parsed once and indexed (scale keys, question orders, the
+exact set of reachable scores per scale, cutoffs and labels per scale);
+every check then runs against that index. Scales that declare an
+aggregate are checked against what the Python scorer produces: integer
+sums (including composites and PST) by their exact reachable set, means
+and ratios on the grid their "round" digits give. Reported problems:
+
+    schema            missing fields or wrong types against the interfaces in index.ts
+    unknown-scale     scaleKey in questions, cutoffs or templates with no scale
+    duplicate         repeated scale keys or question orders
+    empty-scale       scale with no questions and no aggregate; finish.ts always scores it 0
+    aggregate         aggregate declaration mindlab.aggregates cannot compile
+    cutoff-overlap    ranges that share scores; the first inserted cutoff wins
+    no-cutoffs        scale without cutoffs, reported with level 'Unknown'
+    cutoff-gap        reachable scores no cutoff covers; finish.ts reports 'Unknown'
+    cutoff-unreachable
+                      cutoff that no combination of option scores can reach
+    template-label    template whose level_label matches no cutoff label of its scale
+    template-runtime  template finish.ts never finds: it looks up level_label with
+                      cutoffs.label, where sync stores labelFa
+    risk-rule         condition that does not parse or references missing items
+    risk-rule-runtime condition finish.ts's regex cannot match, so it never fires
+
+Cutoffs, templates and risk rules that fail the schema check are left
+out of the later checks, so a malformed file yields issues, not a crash.
+
+All 15 files validate in well under 50 ms in one process; --jobs spreads
+larger sets of files over a process pool. Errors make the exit status
+non-zero (warnings too with --strict), so it can run as a pre-commit hook.
+
+Usage:
+    python -m mindlab.validate [--jobs N] [--strict] [slug ...]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+from mindlab.aggregates import AggregateError, aggregate_spec, compile_aggregation, spec_items
+from mindlab.definitions import definition_path, definition_slugs
+from mindlab.handlers import RISK_RE
+from mindlab.risk_rules import RiskRuleError, parse, references
+
+NUMBER = (int, float)
+
+# Required fields of the interfaces in apps/web/src/data/tests/index.ts
+SCHEMA = {
+    'definition': {'slug': str, 'name': str, 'nameFa': str, 'category': str, 'categoryFa': str,
+                   'description': str, 'descriptionFa': str, 'analysis_type': str, 'warning': str,
+                   'timeMinutes': NUMBER, 'scales': list, 'questions': list, 'cutoffs': list,
+                   'analysis_templates': list, 'risk_rules': list},
+    'scales': {'key': str, 'name': str, 'nameFa': str},
+    'questions': {'order': int, 'text': str, 'scaleKey': str, 'options': list},
+    'options': {'text': str, 'score': NUMBER},
+    'cutoffs': {'scaleKey': str, 'min': NUMBER, 'max': NUMBER, 'label': str, 'labelFa': str},
+    'analysis_templates': {'level_label': str, 'scaleKey': str, 'title': str, 'summary': str,
+                           'details': str, 'recommendations': str},
+    'risk_rules': {'condition': str, 'message': str, 'severity': str},
+}
+ENUMS = {
+    ('definition', 'analysis_type'): ('direct', 'profile', 'rule_based'),
+    ('risk_rules', 'severity'): ('warning', 'critical', 'emergency'),
+}
+
+
+def well_formed(kind, record):
+    """Whether a record has every SCHEMA field with its type; check_schema reports the others."""
+    return isinstance(record, dict) and all(
+        isinstance(record.get(field), expected) and not isinstance(record.get(field), bool)
+        for field, expected in SCHEMA[kind].items())
+
+
+def records(definition, section):
+    """The well-formed records of a section; the later checks only look at these."""
+    values = definition.get(section)
+    return [(i, r) for i, r in enumerate(values if isinstance(values, list) else []) if well_formed(section, r)]
+
+
+@dataclass
+class Issue:
+    slug: str
+    severity: str
+    code: str
+    message: str
+
+    def __str__(self):
+        return f"{self.slug}.json: {self.severity} [{self.code}] {self.message}"
+
+
+def reachable_scores(items):
+    """Exact set of sums over one option score per item, as a sorted list.
+
+    Runs a subset-sum convolution on a Python int used as a bitset; scores
+    are integers in every definition, anything else is rounded.
+    """
+    bits, offset = 1, 0
+    for scores in items:
+        scores = [int(round(s)) for s in scores]
+        if not scores:
+            continue
+        low = min(scores)
+        shifted = 0
+        for s in set(scores):
+            shifted |= bits << (s - low)
+        bits, offset = shifted, offset + low
+    return [offset + i for i, bit in enumerate(reversed(bin(bits)[2:])) if bit == '1']
+
+
+def spans(values, step=1):
+    """Collapse sorted numbers spaced `step` apart into 'a..b' ranges for messages."""
+    out = []
+    for v in values:
+        if out and abs(v - out[-1][1] - step) < 1e-9:
+            out[-1][1] = v
+        else:
+            out.append([v, v])
+    return ', '.join(f'{a}' if a == b else f'{a}..{b}' for a, b in out)
+
+
+class DefinitionIndex:
+    """Keys and reachable score sets of one definition."""
+
+    def __init__(self, definition):
+        self.scale_keys = [s.get('key') for s in definition.get('scales', []) if isinstance(s, dict)]
+        self.scales = set(self.scale_keys)
+        questions = [q for q in definition.get('questions', []) if isinstance(q, dict)]
+        self.orders = [q.get('order') for q in questions]
+        self.items = set(self.orders)
+        self.items_by_scale = {key: [] for key in self.scale_keys}
+        for q in questions:
+            if q.get('scaleKey') in self.items_by_scale:
+                scores = [o.get('score') for o in q.get('options', []) if isinstance(o, dict)]
+                self.items_by_scale[q['scaleKey']].append([s for s in scores if isinstance(s, NUMBER)])
+        self.cutoffs_by_scale = {key: [] for key in self.scale_keys}
+        for _, c in records(definition, 'cutoffs'):
+            if c['scaleKey'] in self.cutoffs_by_scale:
+                self.cutoffs_by_scale[c['scaleKey']].append(c)
+        self.scores_by_order = {q.get('order'): scores for q in questions
+                                for scores in [[o.get('score') for o in q.get('options', [])
+                                                if isinstance(o, dict) and isinstance(o.get('score'), NUMBER)]]}
+        self.steps = {key: 1 for key in self.scale_keys}
+        self.reachable = {}
+        scales = {s.get('key'): s for s in definition.get('scales', []) if isinstance(s, dict)}
+        for key in self.scale_keys:
+            try:
+                self.reachable[key] = self.aggregate_reachable(definition, scales, key)
+            except (AggregateError, KeyError, TypeError, ValueError):
+                # Reported by check_aggregates; fall back to the plain sum
+                self.reachable[key] = reachable_scores(self.items_by_scale[key])
+
+    def integer_items(self, definition, scales, key):
+        """Option score lists whose sum is the scale score, or None for means and ratios."""
+        scale = scales[key]
+        spec = aggregate_spec(scale)
+        kind = spec['type']
+        if kind == 'composite':
+            weights = spec.get('weights', {})
+            if spec.get('op') == 'mean' or any(float(weights.get(p, 1)) != 1 for p in spec['scales']):
+                return None
+            # Subscales sharing items are treated as independent, a superset of the real set
+            items = []
+            for part in spec['scales']:
+                part_items = self.integer_items(definition, scales, part)
+                if part_items is None:
+                    return None
+                items += part_items
+            return items
+        if kind in ('sum', 'weighted', 'pst'):
+            if 'items' not in spec and kind == 'sum':
+                return self.items_by_scale[key]
+            weights = {int(o): float(w) for o, w in spec.get('weights', {}).items()}
+            items = []
+            for order in spec_items(definition, scale, spec):
+                if kind == 'pst':
+                    items.append([0, 1])
+                    continue
+                w = weights.get(order, 1.0)
+                if w != int(w):
+                    return None
+                items.append([s * int(w) for s in self.scores_by_order[order]])
+            return items
+        return None
+
+    def aggregate_reachable(self, definition, scales, key):
+        items = self.integer_items(definition, scales, key)
+        if items is not None:
+            return reachable_scores(items)
+        # Means and ratios: every multiple of the rounding step between the extremes
+        spec = aggregate_spec(scales[key])
+        digits = spec.get('round')
+        if spec['type'] == 'composite' or digits is None:
+            return None
+        scores = [self.scores_by_order[o] for o in spec_items(definition, scales[key], spec)]
+        scores = [s for s in scores if s]
+        low = 0 if spec['type'] == 'psdi' else min((min(s) for s in scores), default=0)
+        high = max((max(s) for s in scores), default=0)
+        self.steps[key] = step = 10.0 ** -digits
+        return [round(low + i * step, digits) for i in range(int(round((high - low) / step)) + 1)]
+
+
+def check_schema(slug, definition):
+    issues = []
+
+    def check(kind, record, where):
+        if not isinstance(record, dict):
+            issues.append(Issue(slug, 'error', 'schema', f'{where}: expected an object'))
+            return
+        for field, expected in SCHEMA[kind].items():
+            if field not in record:
+                issues.append(Issue(slug, 'error', 'schema', f'{where}: missing "{field}"'))
+            elif not isinstance(record[field], expected) or isinstance(record[field], bool):
+                issues.append(Issue(slug, 'error', 'schema', f'{where}: "{field}" has type {type(record[field]).__name__}'))
+            elif (kind, field) in ENUMS and record[field] not in ENUMS[kind, field]:
+                issues.append(Issue(slug, 'error', 'schema', f'{where}: "{field}" is {record[field]!r}, '
+                                                             f'expected one of {", ".join(ENUMS[kind, field])}'))
+
+    check('definition', definition, 'definition')
+    if not isinstance(definition, dict):
+        return issues
+    for section in ('scales', 'questions', 'cutoffs', 'analysis_templates', 'risk_rules'):
+        records = definition.get(section)
+        for i, record in enumerate(records if isinstance(records, list) else []):
+            check(section, record, f'{section}[{i}]')
+            if section == 'questions' and isinstance(record, dict):
+                options = record.get('options')
+                if isinstance(options, list) and not options:
+                    issues.append(Issue(slug, 'error', 'schema', f'questions[{i}]: no options'))
+                for j, option in enumerate(options if isinstance(options, list) else []):
+                    check('options', option, f'questions[{i}].options[{j}]')
+    return issues
+
+
+def check_keys(slug, definition, index):
+    issues = []
+    for key in sorted({k for k in index.scale_keys if index.scale_keys.count(k) > 1}):
+        issues.append(Issue(slug, 'error', 'duplicate', f'scale key "{key}" is defined twice'))
+    for order in sorted({o for o in index.orders if index.orders.count(o) > 1}, key=str):
+        issues.append(Issue(slug, 'error', 'duplicate', f'question order {order} is used twice'))
+
+    for section, label in (('questions', 'order'), ('cutoffs', 'label'), ('analysis_templates', 'level_label')):
+        unknown = {}
+        for _, record in records(definition, section):
+            if record['scaleKey'] not in index.scales:
+                unknown.setdefault(record.get('scaleKey'), []).append(record.get(label))
+        for key, where in unknown.items():
+            shown = ', '.join(str(w) for w in where[:5]) + (', ...' if len(where) > 5 else '')
+            if section == 'questions':
+                effect = 'the answers count toward the total only'
+            elif section == 'cutoffs':
+                effect = 'sync drops these cutoffs'
+            else:
+                effect = 'sync stores them with scale_id NULL, matching every scale'
+            issues.append(Issue(slug, 'error', 'unknown-scale',
+                                f'{section} use scaleKey "{key}" ({label} {shown}); {effect}'))
+
+    declared = {s.get('key') for s in definition.get('scales', []) if isinstance(s, dict) and s.get('aggregate')}
+    for key in index.scale_keys:
+        if not index.items_by_scale.get(key) and key not in declared:
+            issues.append(Issue(slug, 'warning', 'empty-scale', f'scale "{key}" has no questions and always scores 0'))
+    return issues
+
+
+def check_cutoffs(slug, index):
+    issues = []
+    for key in index.scale_keys:
+        cutoffs = index.cutoffs_by_scale[key]
+        reachable = index.reachable[key]
+        if not cutoffs:
+            issues.append(Issue(slug, 'warning', 'no-cutoffs', f'scale "{key}" has no cutoffs; its level is always Unknown'))
+            continue
+
+        ordered = sorted(cutoffs, key=lambda c: (c['min'], c['max']))
+        for a, b in zip(ordered, ordered[1:]):
+            if b['min'] <= a['max']:
+                issues.append(Issue(slug, 'warning', 'cutoff-overlap',
+                                    f'scale "{key}": {a["label"]} [{a["min"]}, {a["max"]}] overlaps '
+                                    f'{b["label"]} [{b["min"]}, {b["max"]}]'))
+
+        if reachable is None:
+            continue
+        uncovered = [s for s in reachable if not any(c['min'] <= s <= c['max'] for c in cutoffs)]
+        if uncovered:
+            issues.append(Issue(slug, 'error', 'cutoff-gap',
+                                f'scale "{key}": reachable scores {spans(uncovered, index.steps[key])} match no cutoff'))
+
+        for c in cutoffs:
+            if not any(c['min'] <= s <= c['max'] for s in reachable):
+                lo, hi = (reachable[0], reachable[-1]) if reachable else (0, 0)
+                issues.append(Issue(slug, 'warning', 'cutoff-unreachable',
+                                    f'scale "{key}": {c["label"]} [{c["min"]}, {c["max"]}] is outside '
+                                    f'the reachable scores {lo}..{hi}'))
+    return issues
+
+
+def check_aggregates(slug, definition):
+    if not any(isinstance(s, dict) and s.get('aggregate') for s in definition.get('scales', [])):
+        return []
+    try:
+        compile_aggregation(definition)
+    except AggregateError as e:
+        return [Issue(slug, 'error', 'aggregate', str(e))]
+    except (KeyError, TypeError, ValueError) as e:
+        return [Issue(slug, 'error', 'aggregate', f'malformed aggregate declaration: {e!r}')]
+    return []
+
+
+def check_templates(slug, definition, index):
+    issues = []
+    templates = records(definition, 'analysis_templates')
+    labels = {key: {c['label'] for c in cutoffs} for key, cutoffs in index.cutoffs_by_scale.items()}
+    for i, t in templates:
+        if t['scaleKey'] in labels and t['level_label'] not in labels[t['scaleKey']]:
+            issues.append(Issue(slug, 'warning', 'template-label',
+                                f'analysis_templates[{i}] level_label "{t["level_label"]}" matches no cutoff '
+                                f'label of scale "{t["scaleKey"]}"'))
+
+    # Sync swaps the columns (cutoffs.label = labelFa), so the live lookup
+    # only finds templates keyed by the Persian label
+    live = {key: {c['labelFa'] for c in cutoffs} for key, cutoffs in index.cutoffs_by_scale.items()}
+    live_any = set().union(*live.values()) if live else set()
+    missed = [(i, t) for i, t in templates if t['level_label'] not in live.get(t['scaleKey'], live_any)]
+    if missed:
+        issues.append(Issue(slug, 'warning', 'template-runtime',
+                            f'{len(missed)} of {len(templates)} analysis_templates never match '
+                            f'in finish.ts, which looks up level_label with cutoffs.label (labelFa after sync); '
+                            f'first: analysis_templates[{missed[0][0]}] "{missed[0][1]["level_label"]}"'))
+    return issues
+
+
+def check_risk_rules(slug, definition, index):
+    issues = []
+    for i, rule in records(definition, 'risk_rules'):
+        condition = rule['condition']
+        try:
+            items, scales = references(parse(condition))
+        except RiskRuleError as e:
+            issues.append(Issue(slug, 'error', 'risk-rule', f'risk_rules[{i}] "{condition}": {e}'))
+            continue
+        missing = sorted(items - index.items)
+        if missing:
+            issues.append(Issue(slug, 'error', 'risk-rule',
+                                f'risk_rules[{i}] "{condition}" references missing items {", ".join(f"q{n}" for n in missing)}'))
+        for key in sorted(scales - index.scales):
+            issues.append(Issue(slug, 'error', 'risk-rule', f'risk_rules[{i}] "{condition}" references unknown scale "{key}"'))
+        if not RISK_RE.search(condition):
+            issues.append(Issue(slug, 'warning', 'risk-rule-runtime',
+                                f'risk_rules[{i}] "{condition}" never fires in finish.ts, which only matches q<N>_score <op> <n>'))
+    return issues
+
+
+def validate_file(path):
+    """All issues of one definition file."""
+    slug = os.path.basename(path)[:-5]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            definition = json.load(f)
+    except (OSError, ValueError) as e:
+        return [Issue(slug, 'error', 'schema', f'cannot load: {e}')]
+
+    issues = check_schema(slug, definition)
+    if not isinstance(definition, dict):
+        return issues
+    if definition.get('slug') != slug:
+        issues.append(Issue(slug, 'error', 'schema', f'slug "{definition.get("slug")}" does not match the file name'))
+    index = DefinitionIndex(definition)
+    issues += check_keys(slug, definition, index)
+    issues += check_aggregates(slug, definition)
+    issues += check_cutoffs(slug, index)
+    issues += check_templates(slug, definition, index)
+    issues += check_risk_rules(slug, definition, index)
+    return issues
+
+
+def validate(paths, jobs=1):
+    """{path: [Issue]} for every file, in input order."""
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(min(jobs, len(paths))) as pool:
+            return dict(zip(paths, pool.map(validate_file, paths)))
+    return {path: validate_file(path) for path in paths}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate the JSON test definitions')
+    parser.add_argument('slugs', nargs='*', help='slugs or paths (default: every definition)')
+    parser.add_argument('--jobs', type=int, default=1, help='validate files in N processes')
+    parser.add_argument('--strict', action='store_true', help='fail on warnings too')
+    parser.add_argument('--quiet', action='store_true', help='only print errors')
+    args = parser.parse_args()
+
+    paths = [s if s.endswith('.json') else definition_path(s) for s in args.slugs or definition_slugs()]
+    start = time.perf_counter()
+    results = validate(paths, args.jobs)
+    elapsed = time.perf_counter() - start
+
+    issues = [issue for file_issues in results.values() for issue in file_issues]
+    errors = sum(issue.severity == 'error' for issue in issues)
+    warnings = len(issues) - errors
+    for issue in issues:
+        if issue.severity == 'error' or not args.quiet:
+            print(issue)
+    print(f"{len(paths)} files, {errors} errors, {warnings} warnings in {elapsed * 1000:.0f} ms")
+    sys.exit(1 if errors or (args.strict and warnings) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,5 @@
-import json
-
-# Load existing file
-with open('apps/web/src/data/tests/scl-90-r.json', 'r', encoding='utf-8') as f:
-    data = json.load(f)
-
-# Full Persian SCL-90-R questions
-full_questions = [
+# Full Persian SCL-90-R questions, applied by position
+FULL_QUESTIONS = [
     "آیا از هفته گذشته تا به امروز سردردهایی داشته‌اید؟",
     "آیا عصبی بوده‌اید و از داخل بدن احساس لرزش داشته‌اید؟",
     "آیا افکار ناخوشایندی مرتباً وارد ذهن شما شده که رهایتان نکنند؟",
@@ -97,13 +91,8 @@ full_questions = [
     "آیا احساس کرده‌اید که چیز بدی قرار است اتفاق بیفتد؟",
 ]
 
-# Update questions
-for i, q in enumerate(data['questions']):
-    if i < len(full_questions):
-        q['text'] = full_questions[i]
-
-# Save file
-with open('apps/web/src/data/tests/scl-90-r.json', 'w', encoding='utf-8') as f:
-    json.dump(data, f, ensure_ascii=False, indent=4)
+if __name__ == '__main__':
+    from mindlab.pipeline import run
 
-print(f"Updated {len(full_questions)} questions")
+    changed = run(patches=['scl90_texts'], slugs=['scl-90-r'])
+    print(f"Updated {len(FULL_QUESTIONS)} questions" if changed else "No changes")
@@ -1,8 +1,3 @@
-import json
-import os
-
-TESTS_DIR = r"c:\GGNN\mindlab\apps\web\src\data\tests"
-
 # Complete analysis templates for each test
 ANALYSIS_UPDATES = {
     "bai": {
@@ -438,38 +433,11 @@ ANALYSIS_UPDATES = {
     }
 }
 
-def update_test_file(filename):
-    filepath = os.path.join(TESTS_DIR, filename)
-    slug = filename.replace('.json', '')
-    
-    if slug not in ANALYSIS_UPDATES:
-        print(f"No updates defined for {slug}")
-        return
-    
-    with open(filepath, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    
-    updates = ANALYSIS_UPDATES[slug]
-    
-    # Update cutoffs if provided
-    if 'cutoffs' in updates:
-        data['cutoffs'] = updates['cutoffs']
-    
-    # Update analysis_templates if provided
-    if 'analysis_templates' in updates:
-        data['analysis_templates'] = updates['analysis_templates']
-    
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    
-    print(f"Updated {filename}")
-
 if __name__ == '__main__':
+    from mindlab.pipeline import run
+
+    changed = run(patches=['analysis_updates'], slugs=list(ANALYSIS_UPDATES))
     for slug in ANALYSIS_UPDATES:
-        filename = f"{slug}.json"
-        if os.path.exists(os.path.join(TESTS_DIR, filename)):
-            update_test_file(filename)
-        else:
-            print(f"File not found: {filename}")
-    
+        print(f"Updated {slug}.json" if slug in changed else f"No changes for {slug}")
+
     print("\nAll tests updated!")